@@ -0,0 +1,60 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import argparse
+import glob
+import logging
+import os
+import sys
+import warnings
+
+warnings.filterwarnings('ignore')
+
+import torch
+
+from wan.modules.checkpoint import convert_checkpoint, safetensors_path
+
+DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16, 'fp32': torch.float32}
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Convert the T5, CLIP and VAE .pth files of a Wan checkpoint directory to safetensors, which are memory-mapped at startup."
+    )
+    parser.add_argument(
+        "--ckpt_dir",
+        type=str,
+        required=True,
+        help="The path to the checkpoint directory. The safetensors files are written next to the .pth files and loaded instead of them."
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default=None,
+        choices=list(DTYPES.keys()),
+        help="The dtype of the converted floating point tensors. Defaults to the dtypes of the .pth files."
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        default=False,
+        help="Whether to convert the .pth files that already have a safetensors conversion."
+    )
+    return parser.parse_args()
+
+
+def _init_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s: %(message)s",
+        handlers=[logging.StreamHandler(stream=sys.stdout)])
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    _init_logging()
+    for path in sorted(glob.glob(os.path.join(args.ckpt_dir, '*.pth'))):
+        if os.path.exists(safetensors_path(path)) and not args.overwrite:
+            logging.info(f"Skipping {path}, already converted")
+            continue
+        logging.info(f"Converting {path}")
+        path = convert_checkpoint(path, args.dtype and DTYPES[args.dtype])
+        logging.info(f"Saved {path}")
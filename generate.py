@@ -17,7 +17,16 @@ from PIL import Image
 import wan
 from wan.configs import MAX_AREA_CONFIGS, SIZE_CONFIGS, SUPPORTED_SIZES, WAN_CONFIGS
 from wan.utils.prompt_extend import DashScopePromptExpander, QwenPromptExpander
-from wan.utils.utils import cache_image, cache_video, str2bool
+from wan.utils.utils import (
+    VideoWriter,
+    cache_image,
+    cache_video,
+    parse_block_offload,
+    parse_local_attention,
+    parse_token_merging,
+    parse_vae_tiling,
+    str2bool,
+)
 
 
 EXAMPLE_PROMPT = {
@@ -243,6 +252,130 @@ def _parse_args():
         type=float,
         default=5.0,
         help="Classifier free guidance scale.")
+    parser.add_argument(
+        "--guide_schedule",
+        type=str,
+        default=None,
+        help="The classifier free guidance schedule, e.g. 'interval=0:0.6' (guide the first 60%% of the steps only), 'every=2' (run the unconditional branch on every 2nd step only) or 'scales=6,6,5,4' (per-step guidance scales). Options are separated by ';'."
+    )
+    parser.add_argument(
+        "--trim_text_context",
+        type=str2bool,
+        default=True,
+        help="Whether to let cross-attention attend to the real prompt tokens only. Set to False to reproduce the padded text context bit for bit."
+    )
+    parser.add_argument(
+        "--varlen",
+        type=str2bool,
+        default=True,
+        help="Whether to pack the video tokens of the samples into one sequence without padding and run varlen attention on it. Falls back to padded tokens for local/sparse attention, token merging and ring attention."
+    )
+    parser.add_argument(
+        "--fuse_qkv",
+        type=str2bool,
+        default=True,
+        help="Whether to pack the query/key/value projections of the DiT attention layers into a single projection when loading the model."
+    )
+    parser.add_argument(
+        "--attention_backend",
+        type=str,
+        default="auto",
+        help="The attention kernel: 'auto', 'flash3', 'flash2', 'sdpa', 'sdpa_efficient', 'sdpa_math' or 'chunked'. 'auto' picks the best one installed for each call."
+    )
+    parser.add_argument(
+        "--attention_autotune",
+        action="store_true",
+        default=False,
+        help="Whether to benchmark the installed attention kernels once per attention shape and use the fastest one. The shapes of all supported sizes of the task are benchmarked at startup. Only used with --attention_backend auto."
+    )
+    parser.add_argument(
+        "--attention_cache_file",
+        type=str,
+        default=None,
+        help="The json file of the autotuned attention kernels, reused across runs on the same host."
+    )
+    parser.add_argument(
+        "--local_attention",
+        type=str,
+        default=None,
+        help="Restrict the DiT self-attention to a 3D neighbourhood of each latent token, e.g. 'window=3,15,15' ((t, h, w) in tokens). Options 'tile=1,5,5' (query tile size), 'global_layers=0,39' (blocks keeping full attention) and 'global_steps=0:5' (steps using full attention) are separated by ';'."
+    )
+    parser.add_argument(
+        "--sparse_attention_threshold",
+        type=float,
+        default=0.0,
+        help="The head-aware sparse attention threshold. If positive, every DiT self-attention head is profiled during the first forwards and then restricted to its own frame or its own spatial location across frames if that changes its output by less than the threshold (relative error). 0 disables it."
+    )
+    parser.add_argument(
+        "--sparse_attention_profile_passes",
+        type=int,
+        default=4,
+        help="The number of DiT forwards profiled per resolution before the sparse attention heads are classified."
+    )
+    parser.add_argument(
+        "--token_merging",
+        type=str,
+        default=None,
+        help="Merge redundant latent tokens before the DiT self-attention, e.g. 'ratio=0.5' (fraction of the tokens merged). Options 'stride=1,2,2' ((t, h, w) cell a token can merge within), 'layers=0:30' (blocks merging tokens), 'steps=10:50' (steps merging tokens) and 'whole_block=true' (also merge for cross-attention and ffn) are separated by ';'."
+    )
+    parser.add_argument(
+        "--ffn_chunk_size",
+        type=int,
+        default=None,
+        help="Run the DiT ffn on chunks of this many tokens, writing the results in place, to cut the peak activation memory (e.g. 8192 for 720p runs of the 14B model)."
+    )
+    parser.add_argument(
+        "--block_offload",
+        type=str,
+        default=None,
+        help="Stream the DiT, T5 and CLIP weights block by block from pinned host memory, prefetching the next block while the current one runs, e.g. 'resident=10' (DiT blocks kept on the GPU) or 'budget=12' (GiB of GPU memory for the DiT blocks). Option 'prefetch=1' (blocks copied ahead) is separated by ';'. Replaces the whole-model moves of --offload_model."
+    )
+    parser.add_argument(
+        "--vae_tiling",
+        type=str,
+        default=None,
+        help="Encode and decode the videos on overlapping spatial tiles to bound the VAE memory, e.g. 'tile=34,60' (tile size in latent tokens of 8 pixels) or 'budget=8' (GiB for the feature maps of a tile, the tile size is derived from it). Option 'overlap=8' (latent tokens blended between tiles) is separated by ';'."
+    )
+    parser.add_argument(
+        "--vae_keep_cache",
+        action="store_true",
+        default=False,
+        help="Whether to keep the causal caches of the VAE allocated across encode/decode calls of the same resolution. Saves the allocations of repeated generations, but keeps the caches in GPU memory while the DiT runs."
+    )
+    parser.add_argument(
+        "--stream_video",
+        action="store_true",
+        default=False,
+        help="Whether to write the video while the VAE decodes it, chunk by chunk, instead of decoding the whole video first. Lowers the peak memory and overlaps encoding with decoding."
+    )
+    parser.add_argument(
+        "--batched_cfg",
+        action="store_true",
+        default=False,
+        help="Whether to run the conditional and unconditional branches of classifier free guidance in a single batched forward. Faster, but uses more GPU memory."
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        default=False,
+        help="Whether to compile the DiT blocks with torch.compile.")
+    parser.add_argument(
+        "--compile_cache_dir",
+        type=str,
+        default=None,
+        help="The directory of the persistent torch.compile cache, reused across runs.")
+    parser.add_argument(
+        "--compile_warmup",
+        action="store_true",
+        default=False,
+        help="Whether to build the compiled graphs of all supported sizes of the task before generating."
+    )
+    parser.add_argument(
+        "--cache_threshold",
+        type=float,
+        default=0.0,
+        help="The residual cache threshold. If positive, the DiT block stack is skipped on sampling steps whose input barely changed and the residual of the last computed step is reused. Larger values are faster but lower quality, 0 disables it."
+    )
 
     args = parser.parse_args()
 
@@ -263,6 +396,23 @@ def _init_logging(rank):
         logging.basicConfig(level=logging.ERROR)
 
 
+def _default_save_file(args):
+    formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+    formatted_prompt = args.prompt.replace(" ", "_").replace("/", "_")[:50]
+    suffix = '.png' if "t2i" in args.task else '.mp4'
+    return f"{args.task}_{args.size.replace('*','x') if sys.platform=='win32' else args.size}_{args.ulysses_size}_{args.ring_size}_{formatted_prompt}_{formatted_time}" + suffix
+
+
+def _video_writer(args, cfg, rank):
+    # streams the decoded frames into the video file while the VAE decodes
+    if not args.stream_video or rank != 0 or "t2i" in args.task:
+        return None
+    if args.save_file is None:
+        args.save_file = _default_save_file(args)
+    logging.info(f"Streaming generated video to {args.save_file}")
+    return VideoWriter(args.save_file, fps=cfg.sample_fps)
+
+
 def generate(args):
     rank = int(os.getenv("RANK", 0))
     world_size = int(os.getenv("WORLD_SIZE", 1))
@@ -322,6 +472,31 @@ def generate(args):
     if args.ulysses_size > 1:
         assert cfg.num_heads % args.ulysses_size == 0, f"`{cfg.num_heads=}` cannot be divided evenly by `{args.ulysses_size=}`."
 
+    cfg.trim_text_context = args.trim_text_context
+    cfg.varlen = args.varlen
+    cfg.fuse_qkv = args.fuse_qkv
+    cfg.attention_backend = args.attention_backend
+    cfg.attention_autotune = args.attention_autotune
+    cfg.attention_cache_file = args.attention_cache_file
+    cfg.local_attention = parse_local_attention(args.local_attention)
+    if cfg.local_attention is not None:
+        assert args.ulysses_size == 1 and args.ring_size == 1, f"Local attention is not supported with context parallel."
+    cfg.sparse_attention = dict(
+        threshold=args.sparse_attention_threshold,
+        profile_passes=args.sparse_attention_profile_passes
+    ) if args.sparse_attention_threshold > 0 else None
+    if cfg.sparse_attention is not None:
+        assert args.ring_size == 1, f"Sparse attention is not supported with ring attention."
+    cfg.token_merging = parse_token_merging(args.token_merging)
+    if cfg.token_merging is not None:
+        assert args.ulysses_size == 1 and args.ring_size == 1, f"Token merging is not supported with context parallel."
+    cfg.ffn_chunk_size = args.ffn_chunk_size
+    cfg.block_offload = parse_block_offload(args.block_offload)
+    if cfg.block_offload is not None:
+        assert not args.t5_fsdp and not args.dit_fsdp, f"Block offload is not supported with FSDP."
+    cfg.vae_tiling = parse_vae_tiling(args.vae_tiling)
+    cfg.vae_keep_cache = args.vae_keep_cache
+
     logging.info(f"Generation job args: {args}")
     logging.info(f"Generation model config: {cfg}")
 
@@ -366,10 +541,20 @@ def generate(args):
             dit_fsdp=args.dit_fsdp,
             use_usp=(args.ulysses_size > 1 or args.ring_size > 1),
             t5_cpu=args.t5_cpu,
+            compile=args.compile,
+            compile_cache_dir=args.compile_cache_dir,
         )
+        if (args.compile and
+                args.compile_warmup) or args.attention_autotune:
+            logging.info("Warming up the DiT...")
+            wan_t2v.warmup(
+                [SIZE_CONFIGS[size] for size in SUPPORTED_SIZES[args.task]],
+                frame_num=args.frame_num,
+                batched_cfg=args.batched_cfg)
 
         logging.info(
             f"Generating {'image' if 't2i' in args.task else 'video'} ...")
+        video_writer = _video_writer(args, cfg, rank)
         video = wan_t2v.generate(
             args.prompt,
             size=SIZE_CONFIGS[args.size],
@@ -379,7 +564,11 @@ def generate(args):
             sampling_steps=args.sample_steps,
             guide_scale=args.sample_guide_scale,
             seed=args.base_seed,
-            offload_model=args.offload_model)
+            offload_model=args.offload_model,
+            batched_cfg=args.batched_cfg,
+            cache_threshold=args.cache_threshold,
+            guide_schedule=args.guide_schedule,
+            video_writer=video_writer)
 
     elif "i2v" in args.task:
         if args.prompt is None:
@@ -423,9 +612,19 @@ def generate(args):
             dit_fsdp=args.dit_fsdp,
             use_usp=(args.ulysses_size > 1 or args.ring_size > 1),
             t5_cpu=args.t5_cpu,
+            compile=args.compile,
+            compile_cache_dir=args.compile_cache_dir,
         )
+        if (args.compile and
+                args.compile_warmup) or args.attention_autotune:
+            logging.info("Warming up the DiT...")
+            wan_i2v.warmup(
+                [SIZE_CONFIGS[size] for size in SUPPORTED_SIZES[args.task]],
+                frame_num=args.frame_num,
+                batched_cfg=args.batched_cfg)
 
         logging.info("Generating video ...")
+        video_writer = _video_writer(args, cfg, rank)
         video = wan_i2v.generate(
             args.prompt,
             img,
@@ -436,7 +635,11 @@ def generate(args):
             sampling_steps=args.sample_steps,
             guide_scale=args.sample_guide_scale,
             seed=args.base_seed,
-            offload_model=args.offload_model)
+            offload_model=args.offload_model,
+            batched_cfg=args.batched_cfg,
+            cache_threshold=args.cache_threshold,
+            guide_schedule=args.guide_schedule,
+            video_writer=video_writer)
     elif "flf2v" in args.task:
         if args.prompt is None:
             args.prompt = EXAMPLE_PROMPT[args.task]["prompt"]
@@ -481,9 +684,19 @@ def generate(args):
             dit_fsdp=args.dit_fsdp,
             use_usp=(args.ulysses_size > 1 or args.ring_size > 1),
             t5_cpu=args.t5_cpu,
+            compile=args.compile,
+            compile_cache_dir=args.compile_cache_dir,
         )
+        if (args.compile and
+                args.compile_warmup) or args.attention_autotune:
+            logging.info("Warming up the DiT...")
+            wan_flf2v.warmup(
+                [SIZE_CONFIGS[size] for size in SUPPORTED_SIZES[args.task]],
+                frame_num=args.frame_num,
+                batched_cfg=args.batched_cfg)
 
         logging.info("Generating video ...")
+        video_writer = _video_writer(args, cfg, rank)
         video = wan_flf2v.generate(
             args.prompt,
             first_frame,
@@ -495,7 +708,11 @@ def generate(args):
             sampling_steps=args.sample_steps,
             guide_scale=args.sample_guide_scale,
             seed=args.base_seed,
-            offload_model=args.offload_model)
+            offload_model=args.offload_model,
+            batched_cfg=args.batched_cfg,
+            cache_threshold=args.cache_threshold,
+            guide_schedule=args.guide_schedule,
+            video_writer=video_writer)
     elif "vace" in args.task:
         if args.prompt is None:
             args.prompt = EXAMPLE_PROMPT[args.task]["prompt"]
@@ -529,7 +746,15 @@ def generate(args):
             dit_fsdp=args.dit_fsdp,
             use_usp=(args.ulysses_size > 1 or args.ring_size > 1),
             t5_cpu=args.t5_cpu,
+            compile=args.compile,
+            compile_cache_dir=args.compile_cache_dir,
         )
+        if args.compile and args.compile_warmup:
+            logging.info("Warming up the compiled DiT...")
+            wan_vace.warmup(
+                [SIZE_CONFIGS[size] for size in SUPPORTED_SIZES[args.task]],
+                frame_num=args.frame_num,
+                batched_cfg=args.batched_cfg)
 
         src_video, src_mask, src_ref_images = wan_vace.prepare_source(
             [args.src_video], [args.src_mask], [
@@ -538,6 +763,7 @@ def generate(args):
             ], args.frame_num, SIZE_CONFIGS[args.size], device)
 
         logging.info(f"Generating video...")
+        video_writer = _video_writer(args, cfg, rank)
         video = wan_vace.generate(
             args.prompt,
             src_video,
@@ -550,17 +776,17 @@ def generate(args):
             sampling_steps=args.sample_steps,
             guide_scale=args.sample_guide_scale,
             seed=args.base_seed,
-            offload_model=args.offload_model)
+            offload_model=args.offload_model,
+            batched_cfg=args.batched_cfg,
+            cache_threshold=args.cache_threshold,
+            guide_schedule=args.guide_schedule,
+            video_writer=video_writer)
     else:
         raise ValueError(f"Unkown task type: {args.task}")
 
     if rank == 0:
         if args.save_file is None:
-            formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-            formatted_prompt = args.prompt.replace(" ", "_").replace("/",
-                                                                     "_")[:50]
-            suffix = '.png' if "t2i" in args.task else '.mp4'
-            args.save_file = f"{args.task}_{args.size.replace('*','x') if sys.platform=='win32' else args.size}_{args.ulysses_size}_{args.ring_size}_{formatted_prompt}_{formatted_time}" + suffix
+            args.save_file = _default_save_file(args)
 
         if "t2i" in args.task:
             logging.info(f"Saving generated image to {args.save_file}")
@@ -570,6 +796,9 @@ def generate(args):
                 nrow=1,
                 normalize=True,
                 value_range=(-1, 1))
+        elif video_writer is not None:
+            video_writer.close()
+            logging.info(f"Saved generated video to {args.save_file}")
         else:
             logging.info(f"Saving generated video to {args.save_file}")
             cache_video(
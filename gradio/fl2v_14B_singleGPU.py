@@ -72,7 +72,7 @@ def prompt_enc(prompt, img_first, img_last, tar_lang):
 
 def flf2v_generation(flf2vid_prompt, flf2vid_image_first, flf2vid_image_last,
                      resolution, sd_steps, guide_scale, shift_scale, seed,
-                     n_prompt):
+                     n_prompt, guide_schedule):
 
     if resolution == '------':
         print(
@@ -90,6 +90,7 @@ def flf2v_generation(flf2vid_prompt, flf2vid_image_first, flf2vid_image_last,
                 shift=shift_scale,
                 sampling_steps=sd_steps,
                 guide_scale=guide_scale,
+                guide_schedule=guide_schedule,
                 n_prompt=n_prompt,
                 seed=seed,
                 offload_model=True)
@@ -178,6 +179,10 @@ def gradio_interface():
                         label="Negative Prompt",
                         placeholder="Describe the negative prompt you want to add"
                     )
+                    guide_schedule = gr.Textbox(
+                        label="Guidance Schedule",
+                        placeholder="Optional, e.g. 'interval=0:0.6', 'every=2' or 'scales=6,6,5,4'"
+                    )
 
                 run_flf2v_button = gr.Button("Generate Video")
 
@@ -200,7 +205,8 @@ def gradio_interface():
             fn=flf2v_generation,
             inputs=[
                 flf2vid_prompt, flf2vid_image_first, flf2vid_image_last,
-                resolution, sd_steps, guide_scale, shift_scale, seed, n_prompt
+                resolution, sd_steps, guide_scale, shift_scale, seed, n_prompt,
+                guide_schedule
             ],
             outputs=[result_gallery],
         )
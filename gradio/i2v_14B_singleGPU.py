@@ -99,7 +99,7 @@ def prompt_enc(prompt, img, tar_lang):
 
 
 def i2v_generation(img2vid_prompt, img2vid_image, resolution, sd_steps,
-                   guide_scale, shift_scale, seed, n_prompt):
+                   guide_scale, shift_scale, seed, n_prompt, guide_schedule):
     # print(f"{img2vid_prompt},{resolution},{sd_steps},{guide_scale},{shift_scale},{seed},{n_prompt}")
 
     if resolution == '------':
@@ -118,6 +118,7 @@ def i2v_generation(img2vid_prompt, img2vid_image, resolution, sd_steps,
                 shift=shift_scale,
                 sampling_steps=sd_steps,
                 guide_scale=guide_scale,
+                guide_schedule=guide_schedule,
                 n_prompt=n_prompt,
                 seed=seed,
                 offload_model=True)
@@ -130,6 +131,7 @@ def i2v_generation(img2vid_prompt, img2vid_image, resolution, sd_steps,
                 shift=shift_scale,
                 sampling_steps=sd_steps,
                 guide_scale=guide_scale,
+                guide_schedule=guide_schedule,
                 n_prompt=n_prompt,
                 seed=seed,
                 offload_model=True)
@@ -210,6 +212,10 @@ def gradio_interface():
                         label="Negative Prompt",
                         placeholder="Describe the negative prompt you want to add"
                     )
+                    guide_schedule = gr.Textbox(
+                        label="Guidance Schedule",
+                        placeholder="Optional, e.g. 'interval=0:0.6', 'every=2' or 'scales=6,6,5,4'"
+                    )
 
                 run_i2v_button = gr.Button("Generate Video")
 
@@ -229,7 +235,8 @@ def gradio_interface():
             fn=i2v_generation,
             inputs=[
                 img2vid_prompt, img2vid_image, resolution, sd_steps,
-                guide_scale, shift_scale, seed, n_prompt
+                guide_scale, shift_scale, seed, n_prompt,
+                guide_schedule
             ],
             outputs=[result_gallery],
         )
@@ -33,7 +33,7 @@ def prompt_enc(prompt, tar_lang):
 
 
 def t2i_generation(txt2img_prompt, resolution, sd_steps, guide_scale,
-                   shift_scale, seed, n_prompt):
+                   shift_scale, seed, n_prompt, guide_schedule):
     global wan_t2i
     # print(f"{txt2img_prompt},{resolution},{sd_steps},{guide_scale},{shift_scale},{seed},{n_prompt}")
 
@@ -46,6 +46,7 @@ def t2i_generation(txt2img_prompt, resolution, sd_steps, guide_scale,
         shift=shift_scale,
         sampling_steps=sd_steps,
         guide_scale=guide_scale,
+        guide_schedule=guide_schedule,
         n_prompt=n_prompt,
         seed=seed,
         offload_model=True)
@@ -124,6 +125,10 @@ def gradio_interface():
                         label="Negative Prompt",
                         placeholder="Describe the negative prompt you want to add"
                     )
+                    guide_schedule = gr.Textbox(
+                        label="Guidance Schedule",
+                        placeholder="Optional, e.g. 'interval=0:0.6', 'every=2' or 'scales=6,6,5,4'"
+                    )
 
                 run_t2i_button = gr.Button("Generate Image")
 
@@ -140,7 +145,7 @@ def gradio_interface():
             fn=t2i_generation,
             inputs=[
                 txt2img_prompt, resolution, sd_steps, guide_scale, shift_scale,
-                seed, n_prompt
+                seed, n_prompt, guide_schedule
             ],
             outputs=[result_gallery],
         )
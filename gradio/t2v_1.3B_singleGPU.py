@@ -135,7 +135,8 @@ def prompt_enc(prompt, tar_lang):
 
 
 def t2v_generation(txt2vid_prompt, resolution, sd_steps, guide_scale,
-                   shift_scale, seed, n_prompt, offload_model_ui, progress=gr.Progress()):
+                   shift_scale, seed, n_prompt, offload_model_ui, guide_schedule,
+                   progress=gr.Progress()):
     # 使用懒初始化获取模型
     wan_t2v = get_wan_t2v()
     
@@ -182,6 +183,7 @@ def t2v_generation(txt2vid_prompt, resolution, sd_steps, guide_scale,
         print(f"resolution: {resolution}")
         print(f"sd_steps: {sd_steps}")
         print(f"guide_scale: {actual_guide_scale}")
+        print(f"guide_schedule: {guide_schedule}")
         print(f"shift_scale: {actual_shift}")
         print(f"seed: {seed}")
         print(f"n_prompt: {n_prompt}")
@@ -197,6 +199,7 @@ def t2v_generation(txt2vid_prompt, resolution, sd_steps, guide_scale,
             shift=actual_shift,
             sampling_steps=sd_steps,
             guide_scale=actual_guide_scale,
+            guide_schedule=guide_schedule,
             n_prompt=n_prompt,
             seed=seed,
             offload_model=actual_offload,
@@ -658,6 +661,12 @@ def gradio_interface():
                                     container=True
                                 )
                                 
+                                guide_schedule = gr.Textbox(
+                                    label="引导调度",
+                                    placeholder="可选，例如 'interval=0:0.6'、'every=2' 或 'scales=6,6,5,4'",
+                                    container=True
+                                )
+                                
                                 gr.Markdown("""
                                 **说明**: 时间偏移和引导比例参数使用上方基础参数区域的设置。
                                 如需覆盖，请使用命令行参数 `--sample_shift` 和 `--sample_guide_scale`。
@@ -775,7 +784,7 @@ def gradio_interface():
             fn=t2v_generation,
             inputs=[
                 txt2vid_prompt, resolution, sd_steps, guide_scale, shift_scale,
-                seed, n_prompt, offload_model_ui
+                seed, n_prompt, offload_model_ui, guide_schedule
             ],
             outputs=[result_gallery],
             show_progress="full"  # 显示完整的进度条
@@ -171,6 +171,10 @@ class VACEInference:
                         step=0.5,
                         value=5.0,
                         interactive=True)
+                    self.guide_schedule = gr.Textbox(
+                        label='guide_schedule',
+                        placeholder="e.g. 'interval=0:0.6' or 'every=2'",
+                        interactive=True)
                     self.infer_seed = gr.Slider(
                         minimum=-1, maximum=10000000, value=2025, label="Seed")
         #
@@ -211,8 +215,8 @@ class VACEInference:
     def generate(self, output_gallery, src_video, src_mask, src_ref_image_1,
                  src_ref_image_2, src_ref_image_3, prompt, negative_prompt,
                  shift_scale, sample_steps, context_scale, guide_scale,
-                 infer_seed, output_height, output_width, frame_rate,
-                 num_frames):
+                 guide_schedule, infer_seed, output_height, output_width,
+                 frame_rate, num_frames):
         output_height, output_width, frame_rate, num_frames = int(
             output_height), int(output_width), int(frame_rate), int(num_frames)
         src_ref_images = [
@@ -234,6 +238,7 @@ class VACEInference:
             shift=shift_scale,
             sampling_steps=sample_steps,
             guide_scale=guide_scale,
+            guide_schedule=guide_schedule,
             n_prompt=negative_prompt,
             seed=infer_seed,
             offload_model=True)
@@ -270,8 +275,8 @@ class VACEInference:
             self.src_ref_image_1, self.src_ref_image_2, self.src_ref_image_3,
             self.prompt, self.negative_prompt, self.shift_scale,
             self.sample_steps, self.context_scale, self.guide_scale,
-            self.infer_seed, self.output_height, self.output_width,
-            self.frame_rate, self.num_frames
+            self.guide_schedule, self.infer_seed, self.output_height,
+            self.output_width, self.frame_rate, self.num_frames
         ]
         self.gen_outputs = [self.output_gallery]
         self.generate_button.click(
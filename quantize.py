@@ -0,0 +1,225 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import argparse
+import glob
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import warnings
+
+warnings.filterwarnings('ignore')
+
+import torch
+import torch.cuda.amp as amp
+
+from wan.configs import SIZE_CONFIGS
+from wan.modules.model import WanModel
+from wan.modules.vace_model import VaceWanModel
+
+# files of the DiT in a checkpoint directory, all other files are copied as they are
+DIT_FILES = ('config.json', 'diffusion_pytorch_model*')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Convert the DiT of a Wan checkpoint directory to weight-only int8/int4 and compare it with the original."
+    )
+    parser.add_argument(
+        "--ckpt_dir",
+        type=str,
+        required=True,
+        help="The path to the original checkpoint directory.")
+    parser.add_argument(
+        "--out_dir",
+        type=str,
+        required=True,
+        help="The path to the quantized checkpoint directory. It can be passed as --ckpt_dir to generate.py."
+    )
+    parser.add_argument(
+        "--bits",
+        type=int,
+        default=8,
+        choices=[8, 4],
+        help="The weight bits, 8 for per-channel int8 and 4 for group-wise int4."
+    )
+    parser.add_argument(
+        "--group_size",
+        type=int,
+        default=128,
+        help="The number of input channels sharing a scale in int4 mode.")
+    parser.add_argument(
+        "--symlink",
+        action="store_true",
+        default=False,
+        help="Whether to symlink the T5, VAE and CLIP files of the original checkpoint instead of copying them."
+    )
+    parser.add_argument(
+        "--skip_conversion",
+        action="store_true",
+        default=False,
+        help="Whether to only compare an existing quantized checkpoint.")
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        default=False,
+        help="Whether to compare the outputs of the quantized and the original DiT on random inputs."
+    )
+    parser.add_argument(
+        "--compare_size",
+        type=str,
+        default="832*480",
+        choices=list(SIZE_CONFIGS.keys()),
+        help="The video size of the comparison inputs.")
+    parser.add_argument(
+        "--compare_frame_num",
+        type=int,
+        default=17,
+        help="The number of frames of the comparison inputs, 4n+1.")
+    parser.add_argument(
+        "--compare_steps",
+        type=int,
+        default=10,
+        help="The number of timesteps compared, evenly spaced over the schedule."
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="The device of the comparison.")
+    parser.add_argument(
+        "--seed", type=int, default=0, help="The seed of the comparison inputs.")
+    return parser.parse_args()
+
+
+def _init_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s: %(message)s",
+        handlers=[logging.StreamHandler(stream=sys.stdout)])
+
+
+def _model_class(ckpt_dir):
+    with open(os.path.join(ckpt_dir, 'config.json')) as f:
+        name = json.load(f).get('_class_name')
+    return VaceWanModel if name == 'VaceWanModel' else WanModel
+
+
+def convert(ckpt_dir, out_dir, bits=8, group_size=128, symlink=False):
+    r"""
+    Writes a copy of the checkpoint directory whose DiT weights are quantized, see
+    `WanModel.quantize`. The DiT config gets a `quantization` entry, so that
+    `WanModel.from_pretrained` loads the quantized weights directly.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    dit_files = set()
+    for pattern in DIT_FILES:
+        dit_files.update(glob.glob(os.path.join(ckpt_dir, pattern)))
+    for name in sorted(os.listdir(ckpt_dir)):
+        src, dst = os.path.join(ckpt_dir, name), os.path.join(out_dir, name)
+        if src in dit_files or os.path.exists(dst):
+            continue
+        logging.info(f"{'Linking' if symlink else 'Copying'} {name}")
+        if symlink:
+            os.symlink(os.path.abspath(src), dst)
+        elif os.path.isdir(src):
+            shutil.copytree(src, dst)
+        else:
+            shutil.copy2(src, dst)
+
+    model_cls = _model_class(ckpt_dir)
+    logging.info(f"Loading {model_cls.__name__} from {ckpt_dir}")
+    model = model_cls.from_pretrained(ckpt_dir)
+    model.eval().requires_grad_(False)
+    logging.info(f"Quantizing to int{bits}")
+    model.quantize(bits=bits, group_size=group_size)
+    model.save_pretrained(out_dir)
+    logging.info(f"Saved the quantized DiT to {out_dir}")
+
+
+@torch.no_grad()
+def dit_outputs(model, timesteps, size, frame_num, seed=0):
+    r"""
+    Runs the DiT on the same random inputs at every timestep and returns the outputs.
+    """
+    device = model.patch_embedding.weight.device
+    g = torch.Generator().manual_seed(seed)
+    w, h = size
+    shape = (model.out_dim, (frame_num - 1) // 4 + 1, h // 8, w // 8)
+    seq_len = math.ceil(shape[1] * shape[2] * shape[3] / 4)
+    x = [torch.randn(shape, generator=g).to(device)]
+    kwargs = dict(
+        context=[torch.randn(64, model.text_dim, generator=g).to(device)],
+        seq_len=seq_len)
+    if model.model_type in ('i2v', 'flf2v'):
+        kwargs['clip_fea'] = torch.randn(
+            1, 257 * (2 if model.model_type == 'flf2v' else 1), 1280,
+            generator=g).to(device)
+        kwargs['y'] = [
+            torch.randn(model.in_dim - shape[0], *shape[1:],
+                        generator=g).to(device)
+        ]
+    if model.model_type == 'vace':
+        kwargs['vace_context'] = [
+            torch.randn(model.vace_in_dim, *shape[1:], generator=g).to(device)
+        ]
+
+    outputs = []
+    with amp.autocast(dtype=torch.bfloat16):
+        for t in timesteps:
+            t = torch.tensor([t], device=device)
+            outputs.append(model(x, t=t, **kwargs)[0].float().cpu())
+    return outputs
+
+
+def compare(ckpt_dir,
+            out_dir,
+            size=(832, 480),
+            frame_num=17,
+            steps=10,
+            device='cuda',
+            seed=0):
+    r"""
+    Compares the DiT outputs of the quantized and the original checkpoint on the same random
+    inputs, and logs the relative L2 error and the cosine similarity of every timestep.
+
+    Returns:
+        List[Tuple[`float`, `float`, `float`]]:
+            (timestep, relative L2 error, cosine similarity) of every compared timestep
+    """
+    timesteps = torch.linspace(999, 1, steps).tolist()
+    outputs = []
+    for path in (ckpt_dir, out_dir):
+        model = _model_class(path).from_pretrained(path)
+        model.eval().requires_grad_(False).to(device)
+        logging.info(f"Running the DiT of {path}")
+        outputs.append(dit_outputs(model, timesteps, size, frame_num, seed))
+        del model
+        if device != 'cpu':
+            torch.cuda.empty_cache()
+
+    results = []
+    for t, ref, out in zip(timesteps, *outputs):
+        error = ((out - ref).norm() / ref.norm()).item()
+        cosine = torch.nn.functional.cosine_similarity(
+            out.flatten(), ref.flatten(), dim=0).item()
+        logging.info(f"t={t:7.2f}  relative L2 error {error:.4f}  "
+                     f"cosine similarity {cosine:.6f}")
+        results.append((t, error, cosine))
+    logging.info(
+        f"Mean relative L2 error {sum(u[1] for u in results) / steps:.4f}, "
+        f"mean cosine similarity {sum(u[2] for u in results) / steps:.6f}")
+    return results
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    _init_logging()
+    if not args.skip_conversion:
+        convert(args.ckpt_dir, args.out_dir, args.bits, args.group_size,
+                args.symlink)
+    if args.compare:
+        compare(args.ckpt_dir, args.out_dir, SIZE_CONFIGS[args.compare_size],
+                args.compare_frame_num, args.compare_steps, args.device,
+                args.seed)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the chunked, variable length, local and head-sparse attention against a dense
+reference, and the backend choice of variable length calls. Runs on CPU.
+"""
+
+import torch
+
+import wan.modules.attention as attention
+from wan.modules.attention import (
+    chunked_attention,
+    head_sparse_attention,
+    local_attention,
+    register_attention_backend,
+    varlen_attention,
+)
+from wan.modules.model import WanModel
+
+
+def _randn(*shape):
+    return torch.randn(*shape, generator=_randn.generator)
+
+
+_randn.generator = torch.Generator().manual_seed(0)
+
+
+def _reference(q, k, v, q_lens=None, k_lens=None, causal=False,
+               window_size=(-1, -1), mask=None):
+    # dense float64 attention with the masks of flash attention, the query rows aligned
+    # to the end of the keys, and mask [Lq, Lk] of the allowed keys on top. Queries
+    # without keys are zero
+    b, lq, nq, _ = q.shape
+    lk, nk = k.size(1), k.size(2)
+    k, v = (u.repeat_interleave(nq // nk, 2).double() for u in (k, v))
+    s = torch.einsum('blnc,bmnc->bnlm', q.double(), k) * q.size(-1)**-0.5
+    i = torch.arange(lq)[:, None]
+    j = torch.arange(lk)[None]
+    out = torch.zeros(b, lq, nq, v.size(-1), dtype=torch.float64)
+    for n in range(b):
+        q_len = lq if q_lens is None else int(q_lens[n])
+        k_len = lk if k_lens is None else int(k_lens[n])
+        pos = i + k_len - q_len
+        allowed = j < k_len
+        if causal:
+            allowed = allowed & (j <= pos)
+        if window_size[0] >= 0:
+            allowed = allowed & (j >= pos - window_size[0])
+        if window_size[1] >= 0:
+            allowed = allowed & (j <= pos + window_size[1])
+        if mask is not None:
+            allowed = allowed & mask
+        p = s[n].masked_fill(~allowed, float('-inf')).softmax(-1).nan_to_num()
+        out[n, :q_len] = torch.einsum('nlm,mnc->lnc', p, v[n])[:q_len]
+    return out.float()
+
+
+def test_chunked_attention():
+    q = _randn(2, 11, 4, 8)
+    k = _randn(2, 13, 2, 8)
+    v = _randn(2, 13, 2, 6)
+    q_lens = torch.tensor([11, 7])
+    k_lens = torch.tensor([13, 9])
+    for kwargs in (dict(), dict(q_lens=q_lens, k_lens=k_lens),
+                   dict(k_lens=k_lens, causal=True),
+                   dict(q_lens=q_lens, k_lens=k_lens, window_size=(3, 2))):
+        out = chunked_attention(q, k, v, q_chunk_size=3, k_chunk_size=5,
+                                **kwargs)
+        assert torch.allclose(out, _reference(q, k, v, **kwargs), atol=1e-5), \
+            kwargs
+
+
+def test_varlen_attention():
+    # packed samples against each sample on its own
+    q_lens, k_lens = [5, 9, 2], [7, 3, 6]
+    q = _randn(sum(q_lens), 4, 8)
+    k = _randn(sum(k_lens), 2, 8)
+    v = _randn(sum(k_lens), 2, 8)
+
+    def cumulative(lens):
+        return torch.tensor([0] + lens).cumsum(0).to(torch.int32)
+
+    out = varlen_attention(q, k, v, cumulative(q_lens), cumulative(k_lens),
+                           max(q_lens), max(k_lens), dtype=torch.float16)
+    for i, (qs, ks) in enumerate(
+            zip(cumulative(q_lens)[:-1].tolist(),
+                cumulative(k_lens)[:-1].tolist())):
+        u = _reference(q[None, qs:qs + q_lens[i]], k[None, ks:ks + k_lens[i]],
+                       v[None, ks:ks + k_lens[i]])[0]
+        assert torch.allclose(out[qs:qs + q_lens[i]], u, atol=1e-2)
+
+
+def test_varlen_attention_backend():
+    # variable length calls use registered backends, padded or on the packed tokens
+    q_lens, k_lens = [5, 9], [7, 3]
+    cu_seqlens_q = torch.tensor([0, 5, 14], dtype=torch.int32)
+    cu_seqlens_k = torch.tensor([0, 7, 10], dtype=torch.int32)
+    q = _randn(sum(q_lens), 4, 8)
+    k = _randn(sum(k_lens), 4, 8)
+    v = _randn(sum(k_lens), 4, 8)
+    expected = varlen_attention(q, k, v, cu_seqlens_q, cu_seqlens_k, 9, 7)
+    calls = []
+
+    def padded(q, k, v, q_lens, k_lens, **kwargs):
+        calls.append(('padded', tuple(q.shape), q_lens.tolist()))
+        return chunked_attention(q, k, v, q_lens, k_lens)
+
+    def packed(q, k, v, cu_seqlens_q, cu_seqlens_k, max_seqlen_q,
+               max_seqlen_k, **kwargs):
+        calls.append(('packed', tuple(q.shape), max_seqlen_q))
+        return expected
+
+    try:
+        register_attention_backend('padded', padded)
+        out = varlen_attention(q, k, v, cu_seqlens_q, cu_seqlens_k, 9, 7)
+        assert calls == [('padded', (2, 9, 4, 8), q_lens)]
+        assert torch.allclose(out, expected, atol=1e-2)
+        register_attention_backend('packed', padded, varlen=packed)
+        out = varlen_attention(q, k, v, cu_seqlens_q, cu_seqlens_k, 9, 7)
+        assert calls[1:] == [('packed', (14, 4, 8), 9)]
+    finally:
+        attention._BACKENDS.pop('padded')
+        attention._BACKENDS.pop('packed', None)
+
+
+def _grid(grid):
+    # [F * H * W, 3] (f, h, w) of the tokens of grid
+    return torch.stack(
+        torch.meshgrid(*[torch.arange(u) for u in grid], indexing='ij'),
+        -1).flatten(0, 2)
+
+
+def test_local_attention():
+    grid = (4, 6, 6)
+    seq_len = 4 * 6 * 6
+    q, k, v = (_randn(2, seq_len + 5, 2, 8) for _ in range(3))
+    out = local_attention(q, k, v, [grid] * 2, window=(4, 6, 6))
+    dense = _reference(q[:, :seq_len], k[:, :seq_len], v[:, :seq_len])
+    assert torch.allclose(out[:, :seq_len], dense, atol=1e-5)
+    assert not out[:, seq_len:].any()
+
+    # keys of the tiles around the query tile, shifted inwards at the borders
+    window, tile = (2, 4, 3), (1, 2, 1)
+    spans = (3, 3, 3)
+    pos = _grid(grid)
+    tiles = pos // torch.tensor(tile)
+    counts = torch.tensor(grid) // torch.tensor(tile)
+    starts = (tiles - torch.tensor(spans) // 2).clamp(
+        torch.zeros(3, dtype=torch.long), counts - torch.tensor(spans))
+    mask = ((tiles[None] >= starts[:, None]) &
+            (tiles[None] < starts[:, None] + torch.tensor(spans))).all(-1)
+    out = local_attention(q, k, v, [grid] * 2, window=window, tile=tile)
+    local = _reference(
+        q[:, :seq_len], k[:, :seq_len], v[:, :seq_len], mask=mask)
+    assert torch.allclose(out[:, :seq_len], local, atol=1e-5)
+
+
+def test_head_sparse_attention():
+    grids = [(2, 2, 3), (3, 2, 2)]
+    patterns = [('dense', 'spatial', 'temporal', 'spatial'),
+                ('temporal', 'temporal', 'dense', 'spatial')]
+    q, k, v = (_randn(2, 14, 4, 8) for _ in range(3))
+    out = head_sparse_attention(q, k, v, grids, patterns)
+    for i, (grid, pattern) in enumerate(zip(grids, patterns)):
+        pos = _grid(grid)
+        masks = dict(
+            dense=None,
+            spatial=pos[:, None, 0] == pos[None, :, 0],
+            temporal=(pos[:, None, 1:] == pos[None, :, 1:]).all(-1))
+        for n, name in enumerate(pattern):
+            u = _reference(
+                *(x[i:i + 1, :12, n:n + 1] for x in (q, k, v)),
+                mask=masks[name])
+            assert torch.allclose(out[i:i + 1, :12, n:n + 1], u, atol=1e-5)
+        assert not out[i, 12:].any()
+
+
+def test_varlen_args():
+    model = WanModel(
+        dim=64,
+        ffn_dim=128,
+        num_heads=4,
+        num_layers=1,
+        in_dim=16,
+        out_dim=16,
+        text_dim=32,
+        freq_dim=32)
+    args = model.varlen_args(
+        torch.tensor([6, 4]),
+        context_lens=torch.tensor([3, 5]),
+        num_tokens=12,
+        offset=4,
+        chunk_len=6)
+    # the padding after the samples is a sample of its own in the self-attention,
+    # and joins the last sample in the cross-attention
+    assert args['cu_seqlens'].tolist() == [0, 6, 10, 12]
+    assert args['max_seqlen'] == 6
+    assert args['cu_seqlens_q'].tolist() == [0, 2, 6]
+    assert args['max_seqlen_q'] == 4
+    assert args['cu_seqlens_k'].tolist() == [0, 3, 8]
+    assert args['max_seqlen_k'] == 5
+    assert all(args[u].dtype == torch.int32
+               for u in ('cu_seqlens', 'cu_seqlens_q', 'cu_seqlens_k'))
+
+
+if __name__ == "__main__":
+    test_chunked_attention()
+    test_varlen_attention()
+    test_varlen_attention_backend()
+    test_local_attention()
+    test_head_sparse_attention()
+    test_varlen_args()
+    print("test_attention: ok")
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks that `load_weights` loads .pth checkpoints (zip and legacy format) and their
+safetensors conversions into models built on the meta device. Runs on CPU.
+"""
+
+import os
+import tempfile
+
+import torch
+import torch.nn as nn
+
+from wan.modules.checkpoint import (
+    convert_checkpoint,
+    load_weights,
+    safetensors_path,
+)
+
+
+class Model(nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.embedding = nn.Embedding(10, 8)
+        self.proj = nn.Linear(8, 8)
+        self.norm = nn.LayerNorm(8)
+        self.register_buffer('freqs', torch.arange(4).float())
+
+
+def _state_dict():
+    torch.manual_seed(0)
+    state_dict = Model().state_dict()
+    # tensors sharing a storage, as in checkpoints of tied weights
+    state_dict['proj.weight'] = state_dict['embedding.weight'][:8]
+    return state_dict
+
+
+def _meta_model():
+    with torch.device('meta'):
+        return Model()
+
+
+def _check(model, state_dict, dtype=None):
+    loaded = model.state_dict()
+    assert loaded.keys() == state_dict.keys()
+    for key, t in state_dict.items():
+        assert loaded[key].device.type == 'cpu'
+        assert loaded[key].dtype == (dtype or t.dtype)
+        assert torch.equal(loaded[key], t.to(loaded[key].dtype)), key
+
+
+def test_load_pth():
+    state_dict = _state_dict()
+    with tempfile.TemporaryDirectory() as tmp:
+        for zip_format in (True, False):
+            path = os.path.join(tmp, f'model_{zip_format}.pth')
+            torch.save(
+                state_dict, path, _use_new_zipfile_serialization=zip_format)
+            _check(load_weights(_meta_model(), path), state_dict)
+            _check(
+                load_weights(_meta_model(), path, dtype=torch.bfloat16),
+                state_dict, torch.bfloat16)
+
+
+def test_convert_checkpoint():
+    state_dict = _state_dict()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'model.pth')
+        torch.save(state_dict, path)
+        converted = convert_checkpoint(path, torch.bfloat16)
+        assert converted == safetensors_path(path) and os.path.isfile(converted)
+        # the safetensors file is read instead of the .pth file, in the dtypes of the
+        # model unless given
+        os.remove(path)
+        converted = {k: v.bfloat16().float() for k, v in state_dict.items()}
+        _check(load_weights(_meta_model(), path), converted)
+        _check(
+            load_weights(_meta_model(), path, dtype=torch.bfloat16), converted,
+            torch.bfloat16)
+
+
+if __name__ == "__main__":
+    test_load_pth()
+    test_convert_checkpoint()
+    print("test_checkpoint: ok")
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks that the compiled DiT blocks are not recompiled for new prompt lengths after
+`WanModel.warmup`, that token merging does not break their graphs, and that they use
+the attention backends autotuned by the warmup. Runs on CPU.
+"""
+
+import copy
+
+import torch
+import torch._dynamo
+from torch._dynamo.utils import counters
+
+import wan.modules.attention as attention
+from wan.modules.attention import (
+    chunked_attention,
+    register_attention_backend,
+    set_attention_backend,
+)
+from wan.modules.model import WanModel
+
+SHAPE = (16, 3, 4, 6)
+SEQ_LEN = 18
+
+
+def _model():
+    torch.manual_seed(0)
+    model = WanModel(
+        dim=64,
+        ffn_dim=128,
+        num_heads=4,
+        num_layers=2,
+        in_dim=16,
+        out_dim=16,
+        text_dim=32,
+        freq_dim=32).eval().requires_grad_(False)
+    for p in model.parameters():
+        p.normal_(0, 0.05)
+    return model
+
+
+def _sample(model, context, timesteps):
+    x = [torch.randn(SHAPE, generator=torch.Generator().manual_seed(1))]
+    out = []
+    with torch.no_grad(), model.sampling_session(timesteps):
+        for step, t in enumerate(timesteps):
+            out.append(
+                model(
+                    x=x,
+                    t=t[None],
+                    context=[context],
+                    seq_len=SEQ_LEN,
+                    step=step)[0])
+    return out
+
+
+def test_no_recompile_across_prompt_lengths():
+    model = _model()
+    reference = copy.deepcopy(model)
+    assert model.varlen
+    torch._dynamo.reset()
+    counters.clear()
+    model.compile_blocks(backend='eager')
+    model.warmup([SHAPE])
+    graphs = counters['stats']['unique_graphs']
+
+    timesteps = torch.linspace(1000, 1, 2)
+    for text_len in (5, 9, 13, 27, 40):
+        context = torch.randn(text_len, 32)
+        out = _sample(model, context, timesteps)
+        assert counters['stats']['unique_graphs'] == graphs, \
+            f'recompiled for a prompt of {text_len} tokens'
+        for u, v in zip(out, _sample(reference, context, timesteps)):
+            assert torch.allclose(u, v, atol=1e-5)
+
+
+def test_token_merging_without_graph_breaks():
+    model = _model()
+    model.set_token_merging(ratio=0.5)
+    reference = copy.deepcopy(model)
+    torch._dynamo.reset()
+    counters.clear()
+    model.compile_blocks(backend='eager')
+
+    timesteps = torch.linspace(1000, 1, 2)
+    context = torch.randn(7, 32)
+    out = _sample(model, context, timesteps)
+    assert not counters['graph_break'], dict(counters['graph_break'])
+    for u, v in zip(out, _sample(reference, context, timesteps)):
+        assert torch.allclose(u, v, atol=1e-5)
+
+
+def _probe(q, k, v, q_lens, k_lens, dropout_p, softmax_scale, q_scale, causal,
+           window_size, deterministic, dtype):
+    # attention with an output telling it apart from the built-in backends
+    return chunked_attention(
+        q, k, v, q_lens, k_lens, softmax_scale, q_scale, causal,
+        window_size) * 0.5
+
+
+def test_compiled_blocks_use_autotuned_backends():
+    model = _model()
+    reference = copy.deepcopy(model)
+    register_attention_backend('probe', _probe, auto=False)
+    benchmark = attention._benchmark
+    benchmarked = []
+
+    def choose_probe(names, q, k, v, kwargs, repeats=3):
+        benchmarked.append(names)
+        return 'probe'
+
+    attention._benchmark = choose_probe
+    try:
+        set_attention_backend('auto', autotune=True)
+        torch._dynamo.reset()
+        counters.clear()
+        model.compile_blocks(backend='eager')
+        model.warmup([SHAPE])
+        assert benchmarked
+        num_benchmarks = len(benchmarked)
+        graphs = counters['stats']['unique_graphs']
+
+        timesteps = torch.linspace(1000, 1, 2)
+        contexts = [torch.randn(text_len, 32) for text_len in (5, 27, 40)]
+        outs = [_sample(model, u, timesteps) for u in contexts]
+        assert len(benchmarked) == num_benchmarks
+        assert counters['stats']['unique_graphs'] == graphs
+        assert not counters['graph_break']
+
+        # the outputs of the probe backend
+        set_attention_backend('probe')
+        for context, out in zip(contexts, outs):
+            for u, v in zip(out, _sample(reference, context, timesteps)):
+                assert torch.allclose(u, v, atol=1e-5)
+    finally:
+        attention._benchmark = benchmark
+        attention._BACKENDS.pop('probe')
+        set_attention_backend()
+
+
+if __name__ == "__main__":
+    test_no_recompile_across_prompt_lengths()
+    test_token_merging_without_graph_breaks()
+    test_compiled_blocks_use_autotuned_backends()
+    print("test_compile: ok")
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the guidance schedules and the batched classifier-free guidance forward against
+the per-branch forwards. Runs on CPU.
+"""
+
+import torch
+
+from wan.modules.model import WanModel
+from wan.utils.guidance import (
+    GuidanceSchedule,
+    merge_cfg_args,
+    parse_guidance_schedule,
+)
+
+SHAPE = (16, 3, 4, 6)
+SEQ_LEN = 18
+
+
+def _run(schedule, num_steps):
+    # steps evaluating the unconditional branch, and the guided predictions
+    cond = [torch.full((2,), 2. * step) for step in range(num_steps)]
+    uncond = [torch.full((2,), 1. * step) for step in range(num_steps)]
+    steps, out = [], []
+    for step in range(num_steps):
+        if schedule.needs_uncond(step):
+            steps.append(step)
+            out.append(schedule(step, cond[step], uncond[step]))
+        else:
+            out.append(schedule(step, cond[step]))
+    return steps, out
+
+
+def test_default_schedule_is_classifier_free_guidance():
+    steps, out = _run(GuidanceSchedule(5., 6), 6)
+    assert steps == list(range(6))
+    for step, u in enumerate(out):
+        assert torch.equal(u, torch.full((2,), step + 5. * step))
+
+
+def test_interval():
+    schedule = GuidanceSchedule(5., 10, interval=(0, 0.6))
+    assert [schedule.guided(u) for u in range(10)] == [True] * 6 + [False] * 4
+    steps, out = _run(schedule, 10)
+    assert steps == list(range(6))
+    # unguided steps are the conditional prediction
+    assert torch.equal(out[8], torch.full((2,), 16.))
+
+
+def test_period_counts_guided_steps():
+    schedule = GuidanceSchedule(
+        5., 10, every=2, scales=[5, 1, 5, 1, 5, 5, 1, 5, 5, 5])
+    steps, out = _run(schedule, 10)
+    assert steps == [0, 4, 7, 9]
+    # step 5 reuses the guidance direction cond - uncond of step 4
+    assert torch.equal(out[5], torch.full((2,), 10. + 4 * 4.))
+    assert torch.equal(out[1], torch.full((2,), 2.))
+
+
+def test_parse_guidance_schedule():
+    assert parse_guidance_schedule(None) == {}
+    assert parse_guidance_schedule('interval=0:0.6;every=2') == dict(
+        interval=(0, 0.6), every=2)
+    assert parse_guidance_schedule('scales=6,5') == dict(scales=[6., 5.])
+    for spec in ('interval=0', 'step=1'):
+        try:
+            parse_guidance_schedule(spec)
+        except ValueError:
+            continue
+        raise AssertionError(spec)
+
+
+def test_batched_cfg_matches_branches():
+    torch.manual_seed(0)
+    model = WanModel(
+        dim=64,
+        ffn_dim=128,
+        num_heads=4,
+        num_layers=2,
+        in_dim=16,
+        out_dim=16,
+        text_dim=32,
+        freq_dim=32).eval().requires_grad_(False)
+    for p in model.parameters():
+        p.normal_(0, 0.05)
+    x = [torch.randn(SHAPE)]
+    arg_c = dict(
+        context=[torch.randn(5, 32)], seq_len=SEQ_LEN, branch=['cond'])
+    arg_null = dict(
+        context=[torch.randn(9, 32)], seq_len=SEQ_LEN, branch=['uncond'])
+    arg_cfg = merge_cfg_args(arg_c, arg_null)
+    assert arg_cfg['branch'] == ['cond', 'uncond']
+
+    timesteps = torch.linspace(1000, 1, 2)
+    with torch.no_grad(), model.sampling_session(timesteps):
+        for step, t in enumerate(timesteps):
+            cond, uncond = model(x * 2, t=t[None].repeat(2), step=step,
+                                 **arg_cfg)
+            assert torch.allclose(
+                cond, model(x, t=t[None], step=step, **arg_c)[0], atol=1e-5)
+            assert torch.allclose(
+                uncond,
+                model(x, t=t[None], step=step, **arg_null)[0],
+                atol=1e-5)
+
+
+if __name__ == "__main__":
+    test_default_schedule_is_classifier_free_guidance()
+    test_interval()
+    test_period_counts_guided_steps()
+    test_parse_guidance_schedule()
+    test_batched_cfg_matches_branches()
+    print("test_guidance: ok")
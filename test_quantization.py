@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the int8/int4 weight quantization round trip, the quantized state dict and the
+fused quantized layers. Runs on CPU.
+"""
+
+import torch
+import torch.nn as nn
+
+from wan.modules.quantization import (
+    QuantLinear,
+    quantize_linears,
+    quantize_weight,
+)
+
+
+def _linear(in_features=64, out_features=24):
+    torch.manual_seed(0)
+    return nn.Linear(in_features, out_features).requires_grad_(False)
+
+
+def test_round_trip():
+    linear = _linear()
+    for bits, group_size in ((8, 128), (4, 16), (4, 64)):
+        layer = QuantLinear.from_linear(linear, bits, group_size)
+        assert layer.qweight.dtype == (torch.int8 if bits == 8 else torch.uint8)
+        w = layer.dequantize()
+        # every weight is within half a quantization step
+        step = layer.scale.repeat_interleave(layer.group_size, 1)
+        assert ((w - linear.weight).abs() <= step / 2 + 1e-6).all(), bits
+        # the quantized values round trip exactly
+        q, _ = quantize_weight(w, bits, group_size)
+        assert torch.equal(q, layer.qweight)
+        x = torch.randn(3, 64)
+        assert torch.allclose(
+            layer(x), nn.functional.linear(x, w, linear.bias), atol=1e-5)
+
+
+def test_state_dict():
+    model = nn.Sequential(_linear(), nn.GELU(), _linear(24, 8))
+    x = torch.randn(3, 64)
+    for bits in (8, 4):
+        quantized = nn.Sequential(_linear(), nn.GELU(), _linear(24, 8))
+        quantized.load_state_dict(model.state_dict())
+        quantize_linears(quantized, bits, group_size=8)
+        empty = nn.Sequential(_linear(), nn.GELU(), _linear(24, 8))
+        quantize_linears(empty, bits, group_size=8, convert=False)
+        empty.load_state_dict(quantized.state_dict())
+        assert torch.equal(empty(x), quantized(x))
+        assert torch.allclose(quantized(x), model(x), atol=0.1)
+
+
+def test_cat():
+    layers = [
+        QuantLinear.from_linear(_linear(64, u), 4, 16) for u in (8, 16, 8)
+    ]
+    fused = QuantLinear.cat(layers)
+    x = torch.randn(3, 64)
+    assert torch.equal(fused(x), torch.cat([u(x) for u in layers], -1))
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_state_dict()
+    test_cat()
+    print("test_quantization: ok")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the VAE causal cache, the tiled blending, the kept caches, the batching and the
+zero chunk reuse against the plain computations. Runs on CPU.
+"""
+
+import torch
+import torch.nn.functional as F
+
+from wan.modules.vae import CACHE_T, CausalCache, WanVAE_, tiled_apply
+
+SCALE = [0., 1.]
+
+
+def _vae():
+    torch.manual_seed(0)
+    return WanVAE_(dim=8, z_dim=4).eval().requires_grad_(False)
+
+
+def _video(t=1 + 4 * 4, size=16, batch=1):
+    return torch.randn(batch, 3, t, size, size)
+
+
+def test_causal_cache():
+    # the cache holds the last CACHE_T frames of everything written
+    cache = CausalCache(2)
+    history = torch.empty(1, 2, 0, 3)
+    assert cache.empty(0) and cache.read(0) is None
+    for t in (1, 4, 1, 2, 4, 1, 1):
+        x = torch.randn(1, 2, t, 3)
+        cache.write(0, x)
+        history = torch.cat([history, x], 2)
+        assert torch.equal(cache.read(0), history[:, :, -CACHE_T:])
+        assert torch.equal(cache.read(0, 1), history[:, :, -1:])
+    assert cache.empty(1)
+    cache.zero(1, x)
+    assert torch.equal(cache.read(1), torch.zeros(1, 2, CACHE_T, 3))
+    cache.reset()
+    assert cache.empty(0) and cache.empty(1)
+
+
+def test_tiled_apply():
+    # a function of each grid cell is reproduced exactly by the blended tiles
+    def fn(x):
+        y = F.avg_pool3d(x, (1, 8, 8))
+        return y.repeat_interleave(2, -2).repeat_interleave(2, -1) * 3 + 1
+
+    x = torch.randn(1, 3, 2, 8 * 11, 8 * 7)
+    for tile_size, overlap in (((4, 4), 1), ((5, 3), 2), ((11, 2), 1),
+                               ((32, 32), 8)):
+        out = tiled_apply(fn, x, tile_size, overlap, in_factor=8, out_factor=2)
+        assert torch.allclose(out, fn(x), atol=1e-6), tile_size
+
+
+def test_keep_cache():
+    model = _vae()
+    z = torch.randn(1, 4, 3, 2, 2)
+    expected = model.decode(z, SCALE)
+    model.keep_cache = True
+    for _ in range(2):
+        assert torch.equal(model.decode(z, SCALE), expected)
+    # the kept caches are reset for other resolutions
+    other = torch.randn(1, 4, 2, 3, 3)
+    expected_other = _vae().decode(other, SCALE)
+    assert torch.equal(model.decode(other, SCALE), expected_other)
+    assert torch.equal(model.decode(z, SCALE), expected)
+
+
+def test_batched_encode():
+    model = _vae()
+    x = _video(batch=2)
+    out = model.encode(x, SCALE)
+    for i in range(2):
+        assert torch.allclose(
+            out[i:i + 1], model.encode(x[i:i + 1], SCALE), atol=1e-5)
+
+
+def test_zero_tolerance():
+    model = _vae()
+    x = torch.zeros(1, 3, 1 + 4 * 12, 16, 16)
+    x[:, :, :1] = torch.randn(1, 3, 1, 16, 16)
+    expected = model.encode(x, SCALE)
+    out = model.encode(x, SCALE, zero_tolerance=1e-3)
+    assert (out - expected).abs().max() <= 1e-2 * expected.abs().max()
+    # frames after the zero run are encoded again
+    x[:, :, -4:] = torch.randn(1, 3, 4, 16, 16)
+    expected = model.encode(x, SCALE)
+    out = model.encode(x, SCALE, zero_tolerance=1e-3)
+    assert (out - expected).abs().max() <= 1e-2 * expected.abs().max()
+
+
+if __name__ == "__main__":
+    test_causal_cache()
+    test_tiled_apply()
+    test_keep_cache()
+    test_batched_encode()
+    test_zero_tolerance()
+    print("test_vae: ok")
@@ -12,6 +12,42 @@ wan_shared_cfg.text_len = 512
 
 # transformer
 wan_shared_cfg.param_dtype = torch.bfloat16
+# attend to the real prompt tokens only, False keeps the padded behaviour
+wan_shared_cfg.trim_text_context = True
+# pack the video tokens of the samples without padding (varlen attention) where possible
+wan_shared_cfg.varlen = True
+# pack the q/k/v (cross-attention k/v) projections into one GEMM at load time
+wan_shared_cfg.fuse_qkv = True
+# attention kernel, 'auto' or a name of `wan.modules.attention.attention_backends()`
+wan_shared_cfg.attention_backend = 'auto'
+# with 'auto', benchmark the kernels once per attention shape and keep the fastest
+wan_shared_cfg.attention_autotune = False
+# json file of the autotuned kernels, reused across runs
+wan_shared_cfg.attention_cache_file = None
+# 3D local self-attention, keyword arguments of `WanModel.set_local_attention`,
+# None keeps full attention
+wan_shared_cfg.local_attention = None
+# head-aware sparse self-attention, keyword arguments of
+# `WanModel.set_sparse_attention`, None keeps full attention
+wan_shared_cfg.sparse_attention = None
+# token merging in the blocks, keyword arguments of `WanModel.set_token_merging`,
+# None disables it
+wan_shared_cfg.token_merging = None
+# run the ffn of the blocks on chunks of this many tokens to cut the peak activation
+# memory, None runs the whole sequence at once
+wan_shared_cfg.ffn_chunk_size = None
+# stream the DiT, T5 and CLIP blocks from pinned host memory instead of moving the
+# whole models, keyword arguments of `BlockOffloader`, None disables it
+wan_shared_cfg.block_offload = None
+# encode/decode videos on overlapping spatial tiles, keyword arguments of
+# `WanVAE.set_tiling`, None disables it
+wan_shared_cfg.vae_tiling = None
+# keep the causal caches of the VAE across calls of the same resolution instead of
+# allocating them per call, at the cost of keeping them in GPU memory next to the DiT
+wan_shared_cfg.vae_keep_cache = False
+# relative tolerance of the latents reused for the all-zero frames of the I2V and FLF2V
+# conditions instead of encoding them, None to encode every frame
+wan_shared_cfg.vae_zero_tolerance = 1e-3
 
 # inference
 wan_shared_cfg.num_train_timesteps = 1000
@@ -1,78 +1,57 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import torch
-import torch.cuda.amp as amp
+import torch.distributed as dist
 from xfuser.core.distributed import (
+    get_ring_parallel_world_size,
     get_sequence_parallel_rank,
     get_sequence_parallel_world_size,
     get_sp_group,
 )
 from xfuser.core.long_ctx_attention import xFuserLongContextAttention
 
-from ..modules.model import sinusoidal_embedding_1d
+from ..modules.attention import varlen_attention
+from ..modules.model import rope_cos_sin, rope_rotate
 
 
-def pad_freqs(original_tensor, target_len):
-    seq_len, s1, s2 = original_tensor.shape
-    pad_size = target_len - seq_len
-    padding_tensor = torch.ones(
-        pad_size,
-        s1,
-        s2,
-        dtype=original_tensor.dtype,
-        device=original_tensor.device)
-    padded_tensor = torch.cat([original_tensor, padding_tensor], dim=0)
-    return padded_tensor
-
-
-@amp.autocast(enabled=False)
 def rope_apply(x, grid_sizes, freqs):
     """
     x:          [B, L, N, C].
     grid_sizes: [B, 3].
     freqs:      [M, C // 2].
     """
-    s, n, c = x.size(1), x.size(2), x.size(3) // 2
-    # split freqs
-    freqs = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
-
-    # loop over samples
-    output = []
-    for i, (f, h, w) in enumerate(grid_sizes.tolist()):
-        seq_len = f * h * w
-
-        # precompute multipliers
-        x_i = torch.view_as_complex(x[i, :s].to(torch.float64).reshape(
-            s, n, -1, 2))
-        freqs_i = torch.cat([
-            freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
-            freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
-            freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
-        ],
-                            dim=-1).reshape(seq_len, 1, -1)
-
-        # apply rotary embedding
-        sp_size = get_sequence_parallel_world_size()
-        sp_rank = get_sequence_parallel_rank()
-        freqs_i = pad_freqs(freqs_i, s * sp_size)
-        s_per_rank = s
-        freqs_i_rank = freqs_i[(sp_rank * s_per_rank):((sp_rank + 1) *
-                                                       s_per_rank), :, :]
-        x_i = torch.view_as_real(x_i * freqs_i_rank).flatten(2)
-        x_i = torch.cat([x_i, x[i, s:]])
+    s = x.size(1)
+    cos, sin = rope_cos_sin(
+        freqs, grid_sizes, s, offset=get_sequence_parallel_rank() * s)
+    return rope_rotate(x, cos, sin)
 
-        # append to collection
-        output.append(x_i)
-    return torch.stack(output).float()
+
+def all_to_all(x, scatter_dim, gather_dim):
+    """
+    Scatters x along scatter_dim to the sequence parallel ranks and gathers the received
+    chunks along gather_dim, e.g. sequence shards of all heads -> all tokens of a shard of
+    the heads.
+    """
+    world_size = get_sequence_parallel_world_size()
+    inputs = [u.contiguous() for u in x.chunk(world_size, dim=scatter_dim)]
+    outputs = [torch.empty_like(u) for u in inputs]
+    dist.all_to_all(outputs, inputs, group=get_sp_group().device_group)
+    return torch.cat(outputs, dim=gather_dim)
 
 
 def usp_dit_forward_vace(self, x, vace_context, seq_len, kwargs):
     # embeddings
     c = [self.vace_patch_embedding(u.unsqueeze(0)) for u in vace_context]
     c = [u.flatten(2).transpose(1, 2) for u in c]
-    c = torch.cat([
-        torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))], dim=1)
-        for u in c
-    ])
+    if kwargs['varlen'] is not None:
+        c = torch.cat(c, dim=1)
+        num_tokens = x.size(1) * get_sequence_parallel_world_size()
+        c = torch.cat(
+            [c, c.new_zeros(1, num_tokens - c.size(1), c.size(2))], dim=1)
+    else:
+        c = torch.cat([
+            torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
+                      dim=1) for u in c
+        ])
 
     # arguments
     new_kwargs = dict(x=x)
@@ -100,11 +79,15 @@ def usp_dit_forward(
     vace_context_scale=1.0,
     clip_fea=None,
     y=None,
+    branch=None,
+    step=None,
 ):
     """
     x:              A list of videos each with shape [C, T, H, W].
     t:              [B].
     context:        A list of text embeddings each with shape [L, C].
+    branch:         A list of guidance branch labels, one per video.
+    step:           Index of t in the timestep schedule of the sampling session.
     """
     if self.model_type == 'i2v':
         assert clip_fea is not None and y is not None
@@ -116,36 +99,31 @@ def usp_dit_forward(
     if self.model_type != 'vace' and y is not None:
         x = [torch.cat([u, v], dim=0) for u, v in zip(x, y)]
 
-    # embeddings
+    # time embeddings
+    e, e0, time_kwargs = self.embed_time(t, step)
+    # packed tokens are sharded over the Ulysses ranks only
+    varlen = self.use_varlen(
+        len(x), bool(time_kwargs)) and get_ring_parallel_world_size() == 1
+
+    # embeddings, packed and padded to a multiple of the sequence parallel size
+    # or padded to seq_len
     x = [self.patch_embedding(u.unsqueeze(0)) for u in x]
     grid_sizes = torch.stack(
         [torch.tensor(u.shape[2:], dtype=torch.long) for u in x])
     x = [u.flatten(2).transpose(1, 2) for u in x]
     seq_lens = torch.tensor([u.size(1) for u in x], dtype=torch.long)
     assert seq_lens.max() <= seq_len
-    x = torch.cat([
-        torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))], dim=1)
-        for u in x
-    ])
-
-    # time embeddings
-    with amp.autocast(dtype=torch.float32):
-        e = self.time_embedding(
-            sinusoidal_embedding_1d(self.freq_dim, t).float())
-        e0 = self.time_projection(e).unflatten(1, (6, self.dim))
-        assert e.dtype == torch.float32 and e0.dtype == torch.float32
-
-    # context
-    context_lens = None
-    context = self.text_embedding(
-        torch.stack([
-            torch.cat([u, u.new_zeros(self.text_len - u.size(0), u.size(1))])
-            for u in context
-        ]))
-
-    if self.model_type != 'vace' and clip_fea is not None:
-        context_clip = self.img_emb(clip_fea)  # bs x 257 x dim
-        context = torch.concat([context_clip, context], dim=1)
+    if varlen:
+        x = torch.cat(x, dim=1)
+        sp_size = get_sequence_parallel_world_size()
+        num_tokens = -(-x.size(1) // sp_size) * sp_size
+        x = torch.cat(
+            [x, x.new_zeros(1, num_tokens - x.size(1), x.size(2))], dim=1)
+    else:
+        x = torch.cat([
+            torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
+                      dim=1) for u in x
+        ])
 
     # arguments
     kwargs = dict(
@@ -153,29 +131,50 @@ def usp_dit_forward(
         seq_lens=seq_lens,
         grid_sizes=grid_sizes,
         freqs=self.freqs,
-        context=context,
-        context_lens=context_lens)
+        **time_kwargs,
+        **self.prepare_context(
+            context, clip_fea if self.model_type != 'vace' else None,
+            branch))
 
     # Context Parallel
     x = torch.chunk(
         x, get_sequence_parallel_world_size(),
         dim=1)[get_sequence_parallel_rank()]
-
-    if self.model_type == 'vace':
-        hints = self.forward_vace(x, vace_context, seq_len, kwargs)
-        kwargs['hints'] = hints
-        kwargs['context_scale'] = vace_context_scale
-
-    for block in self.blocks:
-        x = block(x, **kwargs)
+    offset = get_sequence_parallel_rank() * x.size(1)
+    kwargs['rope'] = rope_cos_sin(
+        self.freqs, grid_sizes, x.size(1), offset=offset, packed=varlen)
+    kwargs['varlen'] = self.varlen_args(
+        seq_lens,
+        kwargs['context_lens'],
+        num_tokens,
+        offset=offset,
+        chunk_len=x.size(1)) if varlen else None
+
+    cache = self.residual_cache(
+        x, e0, branch, step, all_reduce=get_sp_group().all_reduce)
+    if cache is not None and cache['skip']:
+        x = x + cache['residual']
+    else:
+        if self.model_type == 'vace':
+            hints = self.forward_vace(x, vace_context, seq_len, kwargs)
+            kwargs['hints'] = hints
+            kwargs['context_scale'] = vace_context_scale
+
+        x_in = x
+        for block in self.blocks:
+            x = block(x, **kwargs)
+        if cache is not None:
+            cache['residual'] = x - x_in
 
     # head
-    x = self.head(x, e)
+    x = self.head(x, e, **time_kwargs)
 
     # Context Parallel
     x = get_sp_group().all_gather(x, dim=1)
 
     # unpatchify
+    if varlen:
+        x = x[0, :int(seq_lens.sum())].split(seq_lens.tolist())
     x = self.unpatchify(x, grid_sizes)
     return [u.float() for u in x]
 
@@ -185,7 +184,12 @@ def usp_attn_forward(self,
                      seq_lens,
                      grid_sizes,
                      freqs,
-                     dtype=torch.bfloat16):
+                     dtype=torch.bfloat16,
+                     rope=None,
+                     local=None,
+                     sparse=None,
+                     varlen=None):
+    assert local is None, 'Local attention is not supported with sequence parallel.'
     b, s, n, d = *x.shape[:2], self.num_heads, self.head_dim
     half_dtypes = (torch.float16, torch.bfloat16)
 
@@ -194,31 +198,47 @@ def usp_attn_forward(self,
 
     # query, key, value function
     def qkv_fn(x):
-        q = self.norm_q(self.q(x)).view(b, s, n, d)
-        k = self.norm_k(self.k(x)).view(b, s, n, d)
-        v = self.v(x).view(b, s, n, d)
+        q, k, v = self.project('qkv', x)
+        q = self.norm_q(q).view(b, s, n, d)
+        k = self.norm_k(k).view(b, s, n, d)
+        v = v.view(b, s, n, d)
         return q, k, v
 
     q, k, v = qkv_fn(x)
-    q = rope_apply(q, grid_sizes, freqs)
-    k = rope_apply(k, grid_sizes, freqs)
-
-    # TODO: We should use unpaded q,k,v for attention.
-    # k_lens = seq_lens // get_sequence_parallel_world_size()
-    # if k_lens is not None:
-    #     q = torch.cat([u[:l] for u, l in zip(q, k_lens)]).unsqueeze(0)
-    #     k = torch.cat([u[:l] for u, l in zip(k, k_lens)]).unsqueeze(0)
-    #     v = torch.cat([u[:l] for u, l in zip(v, k_lens)]).unsqueeze(0)
-
-    x = xFuserLongContextAttention()(
-        None,
-        query=half(q),
-        key=half(k),
-        value=half(v),
-        window_size=self.window_size)
-
-    # TODO: padding after attention.
-    # x = torch.cat([x, x.new_zeros(b, s - x.size(1), n, d)], dim=1)
+    if rope is None:
+        q = rope_apply(q, grid_sizes, freqs)
+        k = rope_apply(k, grid_sizes, freqs)
+    else:
+        q = rope_rotate(q, *rope)
+        k = rope_rotate(k, *rope)
+
+    if varlen is not None:
+        # Ulysses all-to-all, every rank attends over all packed tokens with its
+        # shard of the heads
+        q, k, v = [all_to_all(half(u), 2, 1) for u in (q, k, v)]
+        x = varlen_attention(
+            q[0],
+            k[0],
+            v[0],
+            cu_seqlens_q=varlen['cu_seqlens'],
+            cu_seqlens_k=varlen['cu_seqlens'],
+            max_seqlen_q=varlen['max_seqlen'],
+            max_seqlen_k=varlen['max_seqlen'],
+            window_size=self.window_size).unsqueeze(0)
+        x = all_to_all(x, 1, 2)
+    elif sparse is not None:
+        # Ulysses all-to-all, every rank attends over all tokens with its shard of
+        # the heads, whose patterns it profiles itself
+        q, k, v = [all_to_all(half(u), 2, 1) for u in (q, k, v)]
+        x = self.sparse_attention(q, k, v, seq_lens, *sparse)
+        x = all_to_all(x, 1, 2)
+    else:
+        x = xFuserLongContextAttention()(
+            None,
+            query=half(q),
+            key=half(k),
+            value=half(v),
+            window_size=self.window_size)
 
     # output
     x = x.flatten(2)
@@ -17,8 +17,10 @@ import torchvision.transforms.functional as TF
 from tqdm import tqdm
 
 from .distributed.fsdp import shard_model
+from .modules.attention import set_attention_backend
 from .modules.clip import CLIPModel
 from .modules.model import WanModel
+from .modules.offload import encoder_offload, offload_blocks
 from .modules.t5 import T5EncoderModel
 from .modules.vae import WanVAE
 from .utils.fm_solvers import (
@@ -27,6 +29,11 @@ from .utils.fm_solvers import (
     retrieve_timesteps,
 )
 from .utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .utils.guidance import (
+    GuidanceSchedule,
+    merge_cfg_args,
+    parse_guidance_schedule,
+)
 
 
 class WanFLF2V:
@@ -42,6 +49,8 @@ class WanFLF2V:
         use_usp=False,
         t5_cpu=False,
         init_on_cpu=True,
+        compile=False,
+        compile_cache_dir=None,
     ):
         r"""
         Initializes the image-to-video generation model components.
@@ -65,12 +74,17 @@ class WanFLF2V:
                 Whether to place T5 model on CPU. Only works without t5_fsdp.
             init_on_cpu (`bool`, *optional*, defaults to True):
                 Enable initializing Transformer Model on CPU. Only works without FSDP or USP.
+            compile (`bool`, *optional*, defaults to False):
+                Compile the DiT blocks with `torch.compile`. Use `warmup` to build the graphs ahead of time.
+            compile_cache_dir (`str`, *optional*, defaults to None):
+                Directory of the persistent compile cache, reused across restarts.
         """
         self.device = torch.device(f"cuda:{device_id}")
         self.config = config
         self.rank = rank
         self.use_usp = use_usp
         self.t5_cpu = t5_cpu
+        self.block_offload = config.block_offload is not None
 
         self.num_train_timesteps = config.num_train_timesteps
         self.param_dtype = config.param_dtype
@@ -84,12 +98,21 @@ class WanFLF2V:
             tokenizer_path=os.path.join(checkpoint_dir, config.t5_tokenizer),
             shard_fn=shard_fn if t5_fsdp else None,
         )
+        if self.block_offload and not t5_cpu:
+            offload_blocks(
+                self.text_encoder.model,
+                self.text_encoder.model.blocks,
+                self.device,
+                **encoder_offload(config.block_offload))
 
         self.vae_stride = config.vae_stride
         self.patch_size = config.patch_size
         self.vae = WanVAE(
             vae_pth=os.path.join(checkpoint_dir, config.vae_checkpoint),
             device=self.device)
+        if config.vae_tiling:
+            self.vae.set_tiling(**config.vae_tiling)
+        self.vae.model.keep_cache = config.vae_keep_cache
 
         self.clip = CLIPModel(
             dtype=config.clip_dtype,
@@ -97,10 +120,36 @@ class WanFLF2V:
             checkpoint_path=os.path.join(checkpoint_dir,
                                          config.clip_checkpoint),
             tokenizer_path=os.path.join(checkpoint_dir, config.clip_tokenizer))
+        if self.block_offload:
+            # only the visual transformer is used, its last block is never run
+            # and stays in host memory rather than being prefetched
+            self.clip.model.cpu()
+            offload_blocks(
+                self.clip.model.visual,
+                self.clip.model.visual.transformer[:-1],
+                self.device,
+                unused=self.clip.model.visual.transformer[-1:],
+                **encoder_offload(config.block_offload))
 
         logging.info(f"Creating WanModel from {checkpoint_dir}")
-        self.model = WanModel.from_pretrained(checkpoint_dir)
+        self.model = WanModel.load_pretrained(checkpoint_dir)
         self.model.eval().requires_grad_(False)
+        self.model.trim_text_context = config.trim_text_context
+        self.model.varlen = config.varlen
+        if config.fuse_qkv:
+            self.model.fuse_qkv_projections()
+        set_attention_backend(
+            config.attention_backend,
+            autotune=config.attention_autotune,
+            cache_file=config.attention_cache_file)
+        if config.local_attention:
+            self.model.set_local_attention(**config.local_attention)
+        if config.sparse_attention:
+            self.model.set_sparse_attention(**config.sparse_attention)
+        if config.token_merging:
+            self.model.set_token_merging(**config.token_merging)
+        if config.ffn_chunk_size:
+            self.model.set_chunked_ffn(config.ffn_chunk_size)
 
         if t5_fsdp or dit_fsdp or use_usp:
             init_on_cpu = False
@@ -124,12 +173,45 @@ class WanFLF2V:
             dist.barrier()
         if dit_fsdp:
             self.model = shard_fn(self.model)
+        elif self.block_offload:
+            offload_blocks(self.model, self.model.blocks, self.device,
+                           **config.block_offload)
         else:
             if not init_on_cpu:
                 self.model.to(self.device)
 
+        if compile:
+            self.model.compile_blocks(cache_dir=compile_cache_dir)
+
         self.sample_neg_prompt = config.sample_neg_prompt
 
+    def warmup(self, sizes, frame_num=81, batched_cfg=False):
+        r"""
+        Runs dummy DiT steps for the given output sizes, so that the graphs of the compiled
+        blocks are built and the attention backends are autotuned ahead of the first
+        request, see `WanModel.warmup`.
+
+        Args:
+            sizes (List[tuple[`int`]]):
+                Video resolutions (width,height) to warm up, e.g. all `SUPPORTED_SIZES` of the task.
+                Each is used as the `max_area` of an input image of the same aspect ratio
+            frame_num (`int`, *optional*, defaults to 81):
+                How many frames the warmed up videos have
+            batched_cfg (`bool`, *optional*, defaults to False):
+                Also warm up the batched classifier-free guidance forwards
+        """
+        shapes = [(16, (frame_num - 1) // self.vae_stride[0] + 1,
+                   h // self.vae_stride[1] // self.patch_size[1] *
+                   self.patch_size[1], w // self.vae_stride[2] //
+                   self.patch_size[2] * self.patch_size[2]) for w, h in sizes]
+        if not self.block_offload:
+            self.model.to(self.device)
+        with amp.autocast(dtype=self.param_dtype):
+            self.model.warmup(
+                shapes,
+                sp_size=self.sp_size,
+                batch_sizes=(1, 2) if batched_cfg else (1,))
+
     def generate(self,
                  input_prompt,
                  first_frame,
@@ -142,7 +224,11 @@ class WanFLF2V:
                  guide_scale=5.5,
                  n_prompt="",
                  seed=-1,
-                 offload_model=True):
+                 offload_model=True,
+                 batched_cfg=False,
+                 cache_threshold=0.,
+                 guide_schedule=None,
+                 video_writer=None):
         r"""
         Generates video frames from input first-last frame and text prompt using diffusion process.
 
@@ -174,6 +260,21 @@ class WanFLF2V:
                 Random seed for noise generation. If -1, use random seed
             offload_model (`bool`, *optional*, defaults to True):
                 If True, offloads models to CPU during generation to save VRAM
+            batched_cfg (`bool`, *optional*, defaults to False):
+                If True, evaluates the conditional and unconditional branches in a single batch-2
+                forward per step. Faster, but doubles the activation memory of the DiT
+            cache_threshold (`float`, *optional*, defaults to 0.0):
+                Residual cache threshold. If positive, the DiT skips the block stack on steps
+                whose input changed little since the last computed step and reuses its residual.
+                Larger values skip more steps, 0 disables skipping
+            guide_schedule (`str`, *optional*, defaults to None):
+                Guidance schedule, e.g. 'interval=0:0.6' (guide the first 60% of the steps only),
+                'every=2' (evaluate the unconditional branch on every 2nd step and reuse its
+                guidance direction in between) or 'scales=6,6,5,4' (per-step guidance scales).
+                Options are separated by ';'. Unguided steps only run the conditional branch
+            video_writer (`VideoWriter`, *optional*, defaults to None):
+                If given, the frames are streamed to `video_writer.write` chunk by chunk as the
+                VAE decodes them (see `WanVAE.decode_stream`) and None is returned
 
         Returns:
             torch.Tensor:
@@ -242,10 +343,11 @@ class WanFLF2V:
 
         # preprocess
         if not self.t5_cpu:
-            self.text_encoder.model.to(self.device)
+            if not self.block_offload:
+                self.text_encoder.model.to(self.device)
             context = self.text_encoder([input_prompt], self.device)
             context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
+            if offload_model and not self.block_offload:
                 self.text_encoder.model.cpu()
         else:
             context = self.text_encoder([input_prompt], torch.device('cpu'))
@@ -253,10 +355,11 @@ class WanFLF2V:
             context = [t.to(self.device) for t in context]
             context_null = [t.to(self.device) for t in context_null]
 
-        self.clip.model.to(self.device)
+        if not self.block_offload:
+            self.clip.model.to(self.device)
         clip_context = self.clip.visual(
             [first_frame[:, None, :, :], last_frame[:, None, :, :]])
-        if offload_model:
+        if offload_model and not self.block_offload:
             self.clip.model.cpu()
 
         y = self.vae.encode([
@@ -272,7 +375,8 @@ class WanFLF2V:
                     mode='bicubic').transpose(0, 1),
             ],
                          dim=1).to(self.device)
-        ])[0]
+        ],
+                           zero_tolerance=self.config.vae_zero_tolerance)[0]
         y = torch.concat([msk, y])
 
         @contextmanager
@@ -313,6 +417,7 @@ class WanFLF2V:
                 'clip_fea': clip_context,
                 'seq_len': max_seq_len,
                 'y': [y],
+                'branch': ['cond'],
             }
 
             arg_null = {
@@ -320,51 +425,87 @@ class WanFLF2V:
                 'clip_fea': clip_context,
                 'seq_len': max_seq_len,
                 'y': [y],
+                'branch': ['uncond'],
             }
 
+            if batched_cfg:
+                arg_cfg = merge_cfg_args(arg_c, arg_null)
+
             if offload_model:
                 torch.cuda.empty_cache()
 
-            self.model.to(self.device)
-            for _, t in enumerate(tqdm(timesteps)):
-                latent_model_input = [latent.to(self.device)]
-                timestep = [t]
-
-                timestep = torch.stack(timestep).to(self.device)
-
-                noise_pred_cond = self.model(
-                    latent_model_input, t=timestep, **arg_c)[0].to(
-                        torch.device('cpu') if offload_model else self.device)
-                if offload_model:
-                    torch.cuda.empty_cache()
-                noise_pred_uncond = self.model(
-                    latent_model_input, t=timestep, **arg_null)[0].to(
+            if not self.block_offload:
+                self.model.to(self.device)
+            guidance = GuidanceSchedule(
+                guide_scale, len(timesteps),
+                **parse_guidance_schedule(guide_schedule))
+            with self.model.sampling_session(
+                    timesteps, cache_threshold=cache_threshold):
+                for step, t in enumerate(tqdm(timesteps)):
+                    latent_model_input = [latent.to(self.device)]
+                    timestep = [t]
+
+                    timestep = torch.stack(timestep).to(self.device)
+
+                    if batched_cfg and guidance.needs_uncond(step):
+                        noise_pred_cond, noise_pred_uncond = [
+                            u.to(
+                                torch.device('cpu')
+                                if offload_model else self.device)
+                            for u in self.model(
+                                latent_model_input * 2,
+                                t=timestep.repeat(2),
+                                step=step,
+                                **arg_cfg)
+                        ]
+                        if offload_model:
+                            torch.cuda.empty_cache()
+                    else:
+                        noise_pred_cond = self.model(
+                            latent_model_input, t=timestep, step=step,
+                            **arg_c)[0].to(
+                                torch.device('cpu')
+                                if offload_model else self.device)
+                        if offload_model:
+                            torch.cuda.empty_cache()
+                        noise_pred_uncond = None
+                        if guidance.needs_uncond(step):
+                            noise_pred_uncond = self.model(
+                                latent_model_input, t=timestep, step=step,
+                                **arg_null)[0].to(
+                                    torch.device('cpu')
+                                    if offload_model else self.device)
+                            if offload_model:
+                                torch.cuda.empty_cache()
+                    noise_pred = guidance(step, noise_pred_cond,
+                                          noise_pred_uncond)
+
+                    latent = latent.to(
                         torch.device('cpu') if offload_model else self.device)
-                if offload_model:
-                    torch.cuda.empty_cache()
-                noise_pred = noise_pred_uncond + guide_scale * (
-                    noise_pred_cond - noise_pred_uncond)
-
-                latent = latent.to(
-                    torch.device('cpu') if offload_model else self.device)
 
-                temp_x0 = sample_scheduler.step(
-                    noise_pred.unsqueeze(0),
-                    t,
-                    latent.unsqueeze(0),
-                    return_dict=False,
-                    generator=seed_g)[0]
-                latent = temp_x0.squeeze(0)
+                    temp_x0 = sample_scheduler.step(
+                        noise_pred.unsqueeze(0),
+                        t,
+                        latent.unsqueeze(0),
+                        return_dict=False,
+                        generator=seed_g)[0]
+                    latent = temp_x0.squeeze(0)
 
-                x0 = [latent.to(self.device)]
-                del latent_model_input, timestep
+                    x0 = [latent.to(self.device)]
+                    del latent_model_input, timestep
 
             if offload_model:
-                self.model.cpu()
+                if not self.block_offload:
+                    self.model.cpu()
                 torch.cuda.empty_cache()
 
             if self.rank == 0:
-                videos = self.vae.decode(x0)
+                if video_writer is None:
+                    videos = self.vae.decode(x0)
+                else:
+                    for chunk in self.vae.decode_stream(x0[0]):
+                        video_writer.write(chunk)
+                    videos = [None]
 
         del noise, latent
         del sample_scheduler
@@ -1,4 +1,8 @@
-from .attention import flash_attention
+from .attention import (
+    flash_attention,
+    register_attention_backend,
+    set_attention_backend,
+)
 from .model import WanModel
 from .t5 import T5Decoder, T5Encoder, T5EncoderModel, T5Model
 from .tokenizers import HuggingfaceTokenizer
@@ -15,4 +19,6 @@ __all__ = [
     'T5EncoderModel',
     'HuggingfaceTokenizer',
     'flash_attention',
+    'register_attention_backend',
+    'set_attention_backend',
 ]
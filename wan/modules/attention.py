@@ -1,5 +1,15 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import json
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import partial
+
 import torch
+from torch.nn.attention import SDPBackend, sdpa_kernel
 
 try:
     import flash_attn_interface
@@ -17,7 +27,16 @@ import warnings
 
 __all__ = [
     'flash_attention',
+    'varlen_attention',
+    'chunked_attention',
+    'local_attention',
+    'head_sparse_attention',
+    'head_pattern_errors',
     'attention',
+    'register_attention_backend',
+    'attention_backends',
+    'attention_autotuning',
+    'set_attention_backend',
 ]
 
 
@@ -48,10 +67,29 @@ def flash_attention(
     window_size:    (left right). If not (-1, -1), apply sliding window local attention.
     deterministic:  bool. If True, slightly slower and uses more memory.
     dtype:          torch.dtype. Apply when dtype of q/k/v is not float16/bfloat16.
+    version:        int. Prefer flash attention 2 or 3 if it can handle the call.
+
+    The kernel is chosen by the attention backend policy, see `set_attention_backend`.
     """
+    assert dtype in (torch.float16, torch.bfloat16)
+    kwargs = dict(
+        q_lens=q_lens,
+        k_lens=k_lens,
+        dropout_p=dropout_p,
+        softmax_scale=softmax_scale,
+        q_scale=q_scale,
+        causal=causal,
+        window_size=tuple(window_size),
+        deterministic=deterministic,
+        dtype=dtype)
+    name = _select_backend(q, k, v, kwargs, version)
+    return _BACKENDS[name]['fn'](q, k, v, **kwargs)
+
+
+def _flash_attention(q, k, v, q_lens, k_lens, dropout_p, softmax_scale,
+                     q_scale, causal, window_size, deterministic, dtype,
+                     version):
     half_dtypes = (torch.float16, torch.bfloat16)
-    assert dtype in half_dtypes
-    assert q.device.type == 'cuda' and q.size(-1) <= 256
 
     # params
     b, lq, lk, out_dtype = q.size(0), q.size(1), k.size(1), q.dtype
@@ -85,49 +123,760 @@ def flash_attention(
     if q_scale is not None:
         q = q * q_scale
 
-    if version is not None and version == 3 and not FLASH_ATTN_3_AVAILABLE:
-        warnings.warn(
-            'Flash attention 3 is not available, use flash attention 2 instead.'
-        )
-
     # apply attention
-    if (version is None or version == 3) and FLASH_ATTN_3_AVAILABLE:
+    x = _flash_varlen(
+        q,
+        k,
+        v,
+        cu_seqlens_q=torch.cat([q_lens.new_zeros([1]), q_lens]).cumsum(
+            0, dtype=torch.int32).to(q.device, non_blocking=True),
+        cu_seqlens_k=torch.cat([k_lens.new_zeros([1]), k_lens]).cumsum(
+            0, dtype=torch.int32).to(q.device, non_blocking=True),
+        max_seqlen_q=lq,
+        max_seqlen_k=lk,
+        dropout_p=dropout_p,
+        softmax_scale=softmax_scale,
+        causal=causal,
+        window_size=window_size,
+        deterministic=deterministic,
+        version=version).unflatten(0, (b, lq))
+
+    # output
+    return x.type(out_dtype)
+
+
+def _flash_varlen(q, k, v, cu_seqlens_q, cu_seqlens_k, max_seqlen_q,
+                  max_seqlen_k, dropout_p, softmax_scale, causal, window_size,
+                  deterministic, version):
+    if version == 3:
         # Note: dropout_p, window_size are not supported in FA3 now.
-        x = flash_attn_interface.flash_attn_varlen_func(
+        return flash_attn_interface.flash_attn_varlen_func(
             q=q,
             k=k,
             v=v,
-            cu_seqlens_q=torch.cat([q_lens.new_zeros([1]), q_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
-            cu_seqlens_k=torch.cat([k_lens.new_zeros([1]), k_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
+            cu_seqlens_q=cu_seqlens_q,
+            cu_seqlens_k=cu_seqlens_k,
             seqused_q=None,
             seqused_k=None,
-            max_seqlen_q=lq,
-            max_seqlen_k=lk,
+            max_seqlen_q=max_seqlen_q,
+            max_seqlen_k=max_seqlen_k,
             softmax_scale=softmax_scale,
             causal=causal,
-            deterministic=deterministic)[0].unflatten(0, (b, lq))
-    else:
-        assert FLASH_ATTN_2_AVAILABLE
-        x = flash_attn.flash_attn_varlen_func(
-            q=q,
-            k=k,
-            v=v,
-            cu_seqlens_q=torch.cat([q_lens.new_zeros([1]), q_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
-            cu_seqlens_k=torch.cat([k_lens.new_zeros([1]), k_lens]).cumsum(
-                0, dtype=torch.int32).to(q.device, non_blocking=True),
-            max_seqlen_q=lq,
-            max_seqlen_k=lk,
-            dropout_p=dropout_p,
+            deterministic=deterministic)[0]
+    return flash_attn.flash_attn_varlen_func(
+        q=q,
+        k=k,
+        v=v,
+        cu_seqlens_q=cu_seqlens_q,
+        cu_seqlens_k=cu_seqlens_k,
+        max_seqlen_q=max_seqlen_q,
+        max_seqlen_k=max_seqlen_k,
+        dropout_p=dropout_p,
+        softmax_scale=softmax_scale,
+        causal=causal,
+        window_size=window_size,
+        deterministic=deterministic)
+
+
+def _flash_varlen_attention(q, k, v, cu_seqlens_q, cu_seqlens_k,
+                            max_seqlen_q, max_seqlen_k, softmax_scale, causal,
+                            window_size, deterministic, dtype, version):
+    half_dtypes = (torch.float16, torch.bfloat16)
+
+    def half(x):
+        return x if x.dtype in half_dtypes else x.to(dtype)
+
+    x = _flash_varlen(
+        half(q).to(half(v).dtype),
+        half(k).to(half(v).dtype),
+        half(v),
+        cu_seqlens_q,
+        cu_seqlens_k,
+        max_seqlen_q,
+        max_seqlen_k,
+        dropout_p=0.,
+        softmax_scale=softmax_scale,
+        causal=causal,
+        window_size=window_size,
+        deterministic=deterministic,
+        version=version)
+    return x.type(q.dtype)
+
+
+def varlen_attention(
+    q,
+    k,
+    v,
+    cu_seqlens_q,
+    cu_seqlens_k,
+    max_seqlen_q,
+    max_seqlen_k,
+    softmax_scale=None,
+    causal=False,
+    window_size=(-1, -1),
+    deterministic=False,
+    dtype=torch.bfloat16,
+):
+    """
+    Attention of packed variable length samples, sample i of q being the tokens
+    [cu_seqlens_q[i], cu_seqlens_q[i + 1]) and attending to the tokens
+    [cu_seqlens_k[i], cu_seqlens_k[i + 1]) of k and v.
+
+    q:              [Nq, Hq, C1].
+    k:              [Nk, Hk, C1].
+    v:              [Nk, Hk, C2]. Hq must be divisible by Hk.
+    cu_seqlens_q:   [B + 1]. int32 cumulative query lengths, on the device of q.
+    cu_seqlens_k:   [B + 1]. int32 cumulative key lengths, on the device of k.
+    max_seqlen_q:   int. Length of the longest query sample.
+    max_seqlen_k:   int. Length of the longest key sample.
+
+    The samples must cover all tokens, i.e. cu_seqlens_q[-1] == Nq and
+    cu_seqlens_k[-1] == Nk. The kernel is chosen by the attention backend policy
+    for the samples padded to the longest one, see `set_attention_backend`.
+    Backends with a varlen entry point (flash attention) run on the packed tokens
+    directly, the others get the padded samples, see `flash_attention`.
+    """
+    assert dtype in (torch.float16, torch.bfloat16)
+    b = cu_seqlens_q.numel() - 1
+    kwargs = dict(
+        q_lens=cu_seqlens_q.diff(),
+        k_lens=cu_seqlens_k.diff(),
+        dropout_p=0.,
+        softmax_scale=softmax_scale,
+        q_scale=None,
+        causal=causal,
+        window_size=tuple(window_size),
+        deterministic=deterministic,
+        dtype=dtype)
+
+    # the backend is chosen on views of the padded shapes, [N, H, C] -> [B, L, H, C]
+    name = _select_backend(
+        *[
+            u[:1, None].expand(b, max_seqlen, -1, -1)
+            for u, max_seqlen in ((q, max_seqlen_q), (k, max_seqlen_k),
+                                  (v, max_seqlen_k))
+        ], kwargs)
+    if _BACKENDS[name]['varlen'] is not None:
+        return _BACKENDS[name]['varlen'](
+            q,
+            k,
+            v,
+            cu_seqlens_q=cu_seqlens_q,
+            cu_seqlens_k=cu_seqlens_k,
+            max_seqlen_q=max_seqlen_q,
+            max_seqlen_k=max_seqlen_k,
             softmax_scale=softmax_scale,
             causal=causal,
-            window_size=window_size,
-            deterministic=deterministic).unflatten(0, (b, lq))
+            window_size=tuple(window_size),
+            deterministic=deterministic,
+            dtype=dtype)
+
+    # pad the samples, [N, H, C] -> [B, L, H, C]
+    def pad(x, cu_seqlens, max_seqlen):
+        index = cu_seqlens[:-1].view(-1, 1) + torch.arange(
+            max_seqlen, device=x.device)
+        return x[index.clamp(max=x.size(0) - 1)]
+
+    x = _BACKENDS[name]['fn'](
+        pad(q, cu_seqlens_q, max_seqlen_q), pad(k, cu_seqlens_k, max_seqlen_k),
+        pad(v, cu_seqlens_k, max_seqlen_k), **kwargs)
+
+    # unpad
+    token = torch.arange(q.size(0), device=q.device)
+    sample = torch.searchsorted(cu_seqlens_q[1:], token, right=True)
+    return x[sample, token - cu_seqlens_q[sample]]
+
+
+def chunked_attention(
+    q,
+    k,
+    v,
+    q_lens=None,
+    k_lens=None,
+    softmax_scale=None,
+    q_scale=None,
+    causal=False,
+    window_size=(-1, -1),
+    q_chunk_size=1024,
+    k_chunk_size=4096,
+):
+    """
+    Attention computed block by block with an online softmax, so that at most a
+    [B, Nq, q_chunk_size, k_chunk_size] score matrix is alive at any time. Works on
+    any device, accumulates in float32 and honours the same padding, causal and
+    window masks as `flash_attention`. Dropout is not supported.
+
+    q:              [B, Lq, Nq, C1].
+    k:              [B, Lk, Nk, C1].
+    v:              [B, Lk, Nk, C2]. Nq must be divisible by Nk.
+    q_lens:         [B]. Outputs of the padded query positions are zero.
+    k_lens:         [B].
+    softmax_scale:  float. The scaling of QK^T before applying softmax.
+    q_scale:        float. Extra scaling of q.
+    causal:         bool. Whether to apply causal attention mask.
+    window_size:    (left right). If not (-1, -1), apply sliding window local attention.
+    q_chunk_size:   int. Number of queries per block.
+    k_chunk_size:   int. Number of keys per block.
+    """
+    b, lq, nq, c1 = q.shape
+    lk, nk, out_dtype = k.size(1), k.size(2), q.dtype
+    assert nq % nk == 0
+    scale = (softmax_scale or c1**-0.5) * (q_scale or 1.0)
+    q_pos = torch.arange(lq, device=q.device)
+    k_pos = torch.arange(lk, device=q.device)
+
+    # the query rows of sample i are aligned to the end of its keys, as in flash
+    # attention: query j sees key j + k_lens[i] - q_lens[i] in the causal case
+    masked = k_lens is not None or causal or tuple(window_size) != (-1, -1)
+    pad_q = q_lens is not None
+    q_lens = torch.full((b,), lq, device=q.device) if q_lens is None else \
+        q_lens.to(q.device)
+    k_lens = torch.full((b,), lk, device=q.device) if k_lens is None else \
+        k_lens.to(q.device)
+    offset = (k_lens - q_lens).view(b, 1, 1, 1)
+    # skip the keys padded in all samples, unless tracing where it is a host sync
+    k_end = lk if torch.compiler.is_compiling() else int(k_lens.max())
+
+    def heads(x, start, end):
+        x = x[:, start:end].transpose(1, 2).float()
+        return x.repeat_interleave(nq // x.size(1), dim=1)
+
+    # a single block if the keys fit, so that tracing only guards on lk <=
+    # k_chunk_size instead of specializing on lk, e.g. the prompt length
+    k_chunks = [(0, k_end)] if k_end <= k_chunk_size else [
+        (u, min(u + k_chunk_size, k_end)) for u in range(0, k_end, k_chunk_size)
+    ]
+
+    out = q.new_zeros(b, lq, nq, v.size(-1))
+    for q_start in range(0, lq, q_chunk_size):
+        q_end = min(q_start + q_chunk_size, lq)
+        q_chunk = heads(q, q_start, q_end) * scale
+        q_idx = q_pos[q_start:q_end].view(1, 1, -1, 1) + offset
+
+        m = q_chunk.new_full((b, nq, q_end - q_start, 1), float('-inf'))
+        l = q_chunk.new_zeros((b, nq, q_end - q_start, 1))
+        acc = q_chunk.new_zeros((b, nq, q_end - q_start, v.size(-1)))
+        for k_start, k_chunk_end in k_chunks:
+            scores = q_chunk @ heads(k, k_start, k_chunk_end).transpose(-1, -2)
+            if masked:
+                k_idx = k_pos[k_start:k_chunk_end].view(1, 1, 1, -1)
+                mask = k_idx >= k_lens.view(b, 1, 1, 1)
+                if causal:
+                    mask = mask | (k_idx > q_idx)
+                if window_size[0] >= 0:
+                    mask = mask | (k_idx < q_idx - window_size[0])
+                if window_size[1] >= 0:
+                    mask = mask | (k_idx > q_idx + window_size[1])
+                scores = scores.masked_fill(mask, float('-inf'))
+
+            # online softmax, rows without any visible key so far stay zero
+            m_new = torch.maximum(m, scores.amax(-1, keepdim=True))
+            m_safe = m_new.masked_fill(m_new == float('-inf'), 0.)
+            p = torch.exp(scores - m_safe)
+            alpha = torch.exp(m - m_safe)
+            l = l * alpha + p.sum(-1, keepdim=True)
+            acc = acc * alpha + p @ heads(v, k_start, k_chunk_end)
+            m = m_new
+        out[:, q_start:q_end] = (acc / l.clamp(min=1e-20)).transpose(
+            1, 2).to(out_dtype)
+
+    # zero the padded queries
+    if pad_q:
+        out = out.masked_fill(
+            q_pos.view(1, -1, 1, 1) >= q_lens.view(b, 1, 1, 1), 0.)
+    return out
+
+
+def _tile_size(n, size):
+    # largest divisor of n not above size
+    return max(u for u in range(1, min(n, max(size, 1)) + 1) if n % u == 0)
+
+
+def local_attention(q, k, v, grid_sizes, window, tile=None):
+    """
+    3D neighbourhood attention on the (F, H, W) token grid. The grid is split into
+    tiles, and every query tile attends to the block of tiles covering `window` tokens
+    around it, shifted inwards at the grid borders. Each tile therefore sees the same
+    number of keys and is computed densely by `flash_attention`.
+
+    q:              [B, L, N, C1]. The first F * H * W tokens of each sample are its grid
+                    in (F, H, W) order, the rest is padding.
+    k:              [B, L, N, C1].
+    v:              [B, L, N, C2].
+    grid_sizes:     List[Tuple[int]]. (F, H, W) of each sample.
+    window:         (t h w). Extent of the key neighbourhood in tokens, at least one tile.
+    tile:           (t h w). Query tile size, rounded down to divisors of the grid. Defaults
+                    to a third of the window.
+    """
+    b, n = q.size(0), q.size(2)
+    out = torch.zeros_like(q[..., :v.size(-1)])
+    if tile is None:
+        tile = [u // 3 for u in window]
+
+    # samples of the same grid are processed together
+    for grid in dict.fromkeys(grid_sizes):
+        idx = [i for i, u in enumerate(grid_sizes) if u == grid]
+        batch = len(idx)
+        tiles = [_tile_size(u, t) for u, t in zip(grid, tile)]
+        counts = [u // t for u, t in zip(grid, tiles)]
+        # odd number of neighbour tiles per axis, so that the window is centered
+        spans = [
+            min(c, -(-w // t) | 1) for c, w, t in zip(counts, window, tiles)
+        ]
+        starts = [
+            torch.arange(c).sub(s // 2).clamp(0, c - s).tolist()
+            for c, s in zip(counts, spans)
+        ]
+        seq_len, tile_len = math.prod(grid), math.prod(tiles)
+
+        def to_tiles(x):
+            # [B, F * H * W, N, C] -> [B, nF, nH, nW, tile_len, N, C]
+            x = x[idx, :seq_len].view(batch, counts[0], tiles[0], counts[1],
+                                      tiles[1], counts[2], tiles[2], n, -1)
+            return x.permute(0, 1, 3, 5, 2, 4, 6, 7, 8).flatten(4, 6)
+
+        qt, kt, vt = to_tiles(q), to_tiles(k), to_tiles(v)
+        w_index = torch.tensor(
+            [[u + i for i in range(spans[2])] for u in starts[2]],
+            device=q.device)
+        ot = torch.empty_like(qt[..., :v.size(-1)])
+        for f in range(counts[0]):
+            for h in range(counts[1]):
+                f0, h0 = starts[0][f], starts[1][h]
+
+                def neighbours(x):
+                    # [B, nW, span_f * span_h * span_w * tile_len, N, C]
+                    x = x[:, f0:f0 + spans[0], h0:h0 + spans[1]][:, :, :,
+                                                                 w_index]
+                    return x.permute(0, 3, 1, 2, 4, 5, 6, 7).flatten(2, 5)
+
+                ot[:, f, h] = flash_attention(
+                    q=qt[:, f, h].flatten(0, 1),
+                    k=neighbours(kt).flatten(0, 1),
+                    v=neighbours(vt).flatten(0, 1)).unflatten(
+                        0, (batch, counts[2]))
+
+        # back to the (F, H, W) order
+        ot = ot.unflatten(4, tiles).permute(0, 1, 4, 2, 5, 3, 6, 7, 8)
+        out[idx, :seq_len] = ot.reshape(batch, seq_len, n, -1)
+    return out
+
+
+# block-sparse patterns of `head_sparse_attention`, the keys a query attends to are
+# all tokens (dense), the tokens of its frame (spatial) or the tokens at its (h, w)
+# location in all frames (temporal)
+HEAD_PATTERNS = ('dense', 'spatial', 'temporal')
+
+
+def head_sparse_attention(q, k, v, grid_sizes, patterns):
+    """
+    Self-attention over the (F, H, W) token grid where every head only computes its
+    block-sparse pattern, see `HEAD_PATTERNS`.
+
+    q:              [B, L, N, C1]. The first F * H * W tokens of each sample are its grid
+                    in (F, H, W) order, the rest is padding.
+    k:              [B, L, N, C1].
+    v:              [B, L, N, C2].
+    grid_sizes:     List[Tuple[int]]. (F, H, W) of each sample.
+    patterns:       List[Tuple[str]]. Pattern of every head of each sample.
+    """
+    out = torch.zeros_like(q[..., :v.size(-1)])
+    groups = list(zip(grid_sizes, patterns))
+    for grid, pattern in dict.fromkeys(groups):
+        idx = [i for i, u in enumerate(groups) if u == (grid, pattern)]
+        f, h, w = grid
+        seq_len = f * h * w
+        y = q.new_empty(len(idx), seq_len, q.size(2), v.size(-1))
+        for name in HEAD_PATTERNS:
+            heads = [i for i, u in enumerate(pattern) if u == name]
+            if not heads:
+                continue
+            x = [u[idx, :seq_len][:, :, heads] for u in (q, k, v)]
+            if name == 'spatial':
+                # [B * F, H * W, N, C]
+                x = [u.unflatten(1, (f, h * w)).flatten(0, 1) for u in x]
+            elif name == 'temporal':
+                # [B * H * W, F, N, C]
+                x = [
+                    u.unflatten(1, (f, h * w)).transpose(1, 2).flatten(0, 1)
+                    for u in x
+                ]
+            x = flash_attention(*x)
+            if name == 'spatial':
+                x = x.unflatten(0, (len(idx), f)).flatten(1, 2)
+            elif name == 'temporal':
+                x = x.unflatten(0, (len(idx), h * w)).transpose(1, 2).flatten(
+                    1, 2)
+            y[:, :, heads] = x
+        out[idx, :seq_len] = y
+    return out
+
+
+def head_pattern_errors(q, k, v, grid, num_samples=64, softmax_scale=None):
+    """
+    Profiles how well the sparse patterns of `head_sparse_attention` approximate full
+    attention, on evenly spaced sample queries.
+
+    q:              [B, L, N, C1]. Tokens of the (F, H, W) grid, without padding.
+    k:              [B, L, N, C1].
+    v:              [B, L, N, C2].
+    grid:           (F, H, W).
+    num_samples:    int. Number of sample queries.
+    softmax_scale:  float. The scaling of QK^T before applying softmax.
+
+    Returns a [len(HEAD_PATTERNS), N] tensor with the relative L2 error of the sample
+    outputs of every pattern and head, averaged over the batch.
+    """
+    f, h, w = grid
+    seq_len = q.size(1)
+    scale = softmax_scale or q.size(-1)**-0.5
+    pos = torch.linspace(0, seq_len - 1, min(num_samples, seq_len),
+                         device=q.device).round().long()
+    token = torch.arange(seq_len, device=q.device)
+    masks = [
+        None,
+        token.div(h * w, rounding_mode='floor') == pos.div(
+            h * w, rounding_mode='floor').unsqueeze(1),
+        token.remainder(h * w) == pos.remainder(h * w).unsqueeze(1)
+    ]
+
+    # one head at a time keeps the [B, S, L] scores small
+    errors = torch.zeros(len(HEAD_PATTERNS), q.size(2), device=q.device)
+    for i in range(q.size(2)):
+        scores = q[:, pos, i].float() @ k[:, :, i].float().transpose(1, 2)
+        scores = scores * scale
+        outputs = [
+            torch.softmax(
+                scores if mask is None else scores.masked_fill(
+                    ~mask, float('-inf')), -1) @ v[:, :, i].float()
+            for mask in masks
+        ]
+        errors[:, i] = torch.stack([
+            ((u - outputs[0]).norm(dim=(1, 2)) /
+             outputs[0].norm(dim=(1, 2)).clamp(min=1e-6)).mean()
+            for u in outputs
+        ])
+    return errors
+
+
+def _sdpa_attention(q, k, v, q_lens, k_lens, dropout_p, softmax_scale,
+                    q_scale, causal, window_size, deterministic, dtype,
+                    kernel):
+    half_dtypes = (torch.float16, torch.bfloat16)
+    b, lq, lk, out_dtype = q.size(0), q.size(1), k.size(1), q.dtype
+    groups = q.size(2) // k.size(2)
+
+    def half(x):
+        return x if x.dtype in half_dtypes else x.to(dtype)
+
+    # [B, L, N, C] -> [B, N, L, C]
+    q = half(q).transpose(1, 2)
+    k = half(k).transpose(1, 2).repeat_interleave(groups, 1)
+    v = half(v).transpose(1, 2).repeat_interleave(groups, 1)
+    if q_scale is not None:
+        q = q * q_scale
+
+    attn_mask = None
+    if k_lens is not None:
+        attn_mask = torch.arange(lk, device=k.device).view(
+            1, 1, 1, -1) < k_lens.to(k.device).view(b, 1, 1, 1)
+
+    with sdpa_kernel(kernel) if kernel is not None else nullcontext():
+        x = torch.nn.functional.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=attn_mask,
+            dropout_p=dropout_p,
+            is_causal=causal,
+            scale=softmax_scale).transpose(1, 2)
+
+    # zero the padded queries
+    if q_lens is not None:
+        x = x.masked_fill(
+            torch.arange(lq, device=x.device).view(1, -1, 1, 1) >=
+            q_lens.to(x.device).view(b, 1, 1, 1), 0.)
 
     # output
-    return x.type(out_dtype)
+    return x.type(out_dtype).contiguous()
+
+
+def _chunked_attention(q, k, v, q_lens, k_lens, dropout_p, softmax_scale,
+                       q_scale, causal, window_size, deterministic, dtype):
+    return chunked_attention(
+        q=q,
+        k=k,
+        v=v,
+        q_lens=q_lens,
+        k_lens=k_lens,
+        softmax_scale=softmax_scale,
+        q_scale=q_scale,
+        causal=causal,
+        window_size=window_size)
+
+
+def _flash_supported(q, k, v, dropout_p, window_size, version, **kwargs):
+    if version == 3 and (dropout_p > 0 or window_size != (-1, -1)):
+        return False
+    return q.device.type == 'cuda' and q.size(-1) <= 256
+
+
+def _sdpa_supported(q, k, v, q_lens, k_lens, causal, window_size, cuda_only,
+                    **kwargs):
+    # the causal mask of sdpa is aligned to the first key, flash attention
+    # aligns it to the last key
+    causal_ok = not causal or (q.size(1) == k.size(1) and q_lens is None and
+                               k_lens is None)
+    return window_size == (-1, -1) and causal_ok and (
+        not cuda_only or q.device.type == 'cuda')
+
+
+# name -> dict(fn, supports, auto, varlen), the default policy picks the first backend
+# with `auto` that supports the call
+_BACKENDS = OrderedDict()
+
+# `choices` maps the shape keys to the autotuned backends, `traced` the shape keys
+# without the key length to those used by compiled graphs, see `_traced_choices`
+_POLICY = dict(
+    backend='auto', autotune=False, cache_file=None, choices={}, traced={})
+
+# device names of the shape keys, filled eagerly so that tracing needs no CUDA call
+_DEVICE_NAMES = {}
+
+
+def _register(name, fn, supports=None, auto=True, varlen=None):
+    _BACKENDS[name] = dict(
+        fn=fn,
+        supports=supports or (lambda q, k, v, **kwargs: True),
+        auto=auto,
+        varlen=varlen)
+
+
+def register_attention_backend(name, fn, supports=None, auto=True, varlen=None):
+    r"""
+    Registers an attention kernel, which can then be selected by name or by autotuning.
+
+    Args:
+        name (`str`):
+            Name of the backend
+        fn (`callable`):
+            Called as `fn(q, k, v, q_lens=, k_lens=, dropout_p=, softmax_scale=, q_scale=,
+            causal=, window_size=, deterministic=, dtype=)` with the arguments of
+            `flash_attention`, returns a [B, Lq, Nq, C2] tensor of the dtype of q
+        supports (`callable`, *optional*):
+            Called with the same arguments, returns whether `fn` can handle the call.
+            By default all calls are supported
+        auto (`bool`, *optional*, defaults to True):
+            Whether the default policy prefers this backend over the built-in ones
+            when it supports the call. Otherwise it is only chosen by name or by
+            autotuning
+        varlen (`callable`, *optional*):
+            Called as `fn(q, k, v, cu_seqlens_q=, cu_seqlens_k=, max_seqlen_q=,
+            max_seqlen_k=, softmax_scale=, causal=, window_size=, deterministic=, dtype=)`
+            with the packed tokens of `varlen_attention`, returns a [Nq, Hq, C2] tensor of
+            the dtype of q. If None, `fn` gets the samples padded to the longest one
+    """
+    _register(name, fn, supports, auto, varlen)
+    if auto:
+        _BACKENDS.move_to_end(name, last=False)
+
+
+def attention_backends():
+    r"""
+    Returns the names of the registered attention backends.
+    """
+    return list(_BACKENDS)
+
+
+def attention_autotuning():
+    r"""
+    Returns whether the attention backend policy autotunes, see `set_attention_backend`.
+    """
+    return _POLICY['backend'] == 'auto' and _POLICY['autotune']
+
+
+def set_attention_backend(backend='auto', autotune=False, cache_file=None):
+    r"""
+    Sets the attention backend policy of the process.
+
+    Args:
+        backend (`str`, *optional*, defaults to 'auto'):
+            Name of a registered backend, or 'auto' to choose per call. Calls the
+            backend does not support use the default choice with a warning
+        autotune (`bool`, *optional*, defaults to False):
+            With 'auto', benchmark all backends supporting a call once per device,
+            dtype, sequence lengths (other key lengths than the query length rounded
+            up to a power of two), heads and head dim, and use the fastest one for
+            all later calls of that shape. Otherwise the first supporting backend of
+            the registered backends with `auto`, then flash3, flash2, sdpa_efficient
+            and chunked is used. The benchmarks run eagerly, at the first call of a
+            shape, so `WanModel.warmup` runs them at startup for the supported sizes.
+            Compiled graphs never benchmark: they use the choice of their shape tuned
+            before tracing, for the longest key length of other key lengths than the
+            query length, else the default one
+        cache_file (`str`, *optional*):
+            JSON file of the autotuned choices. Loaded here and updated after each
+            benchmark, so that later runs on the same host skip the benchmarks
+    """
+    if backend != 'auto' and backend not in _BACKENDS:
+        raise ValueError(f'Attention backend {backend} is not available, '
+                         f'choose from {["auto"] + attention_backends()}.')
+    choices = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            choices = json.load(f)
+    _POLICY.update(
+        backend=backend,
+        autotune=autotune,
+        cache_file=cache_file,
+        choices=choices,
+        traced=_traced_choices(choices))
+
+
+def _device_name(device):
+    if device not in _DEVICE_NAMES:
+        _DEVICE_NAMES[device] = torch.cuda.get_device_name(
+            device) if device.type == 'cuda' else device.type
+    return _DEVICE_NAMES[device]
+
+
+def _shape_key(q, k, kwargs, traced=False):
+    masks = [
+        kwargs['q_lens'] is not None, kwargs['k_lens'] is not None,
+        kwargs['causal'], kwargs['window_size']
+    ]
+    # other key lengths (e.g. the prompt length of cross-attention) are rounded up to a
+    # power of two, so that a new prompt does not trigger a new benchmark. Traced keys
+    # leave them out, as compiled graphs are shared by all prompt lengths
+    if k.size(1) == q.size(1):
+        lk = k.size(1)
+    else:
+        lk = '*' if traced else 2**math.ceil(math.log2(max(k.size(1), 1)))
+    return '|'.join(
+        map(str, [
+            _device_name(q.device), q.dtype, f'{q.size(1)}x{lk}',
+            f'{q.size(2)}/{k.size(2)}',
+            q.size(3), *masks
+        ]))
+
+
+def _traced_choices(choices):
+    # choices by traced shape key, that of the longest key length for other key
+    # lengths than the query length
+    traced, longest = {}, {}
+    for key, choice in choices.items():
+        parts = key.split('|')
+        lq, lk = parts[2].split('x')
+        if lk != lq:
+            parts[2] = f'{lq}x*'
+        traced_key = '|'.join(parts)
+        if int(lk) >= longest.get(traced_key, -1):
+            traced[traced_key], longest[traced_key] = choice, int(lk)
+    return traced
+
+
+def _benchmark(names, q, k, v, kwargs, repeats=3):
+    timings = {}
+    for name in names:
+        try:
+            for i in range(repeats + 1):
+                # the first call is a warmup
+                if i == 1:
+                    if q.device.type == 'cuda':
+                        torch.cuda.synchronize(q.device)
+                    start = time.perf_counter()
+                _BACKENDS[name]['fn'](q, k, v, **kwargs)
+            if q.device.type == 'cuda':
+                torch.cuda.synchronize(q.device)
+            timings[name] = (time.perf_counter() - start) / repeats
+        except Exception as e:
+            logging.warning(f'Attention backend {name} failed: {e}')
+    return min(timings, key=timings.get) if timings else None
+
+
+def _select_backend(q, k, v, kwargs, version=None):
+    names = [
+        name for name, u in _BACKENDS.items()
+        if u['supports'](q, k, v, **kwargs)
+    ]
+    if not names:
+        raise ValueError(
+            f'No attention backend supports the call ({q.device.type}, '
+            f'{q.dtype}, dropout {kwargs["dropout_p"]}).')
+    # the first supporting backend with `auto`
+    default = next((name for name in names if _BACKENDS[name]['auto']),
+                   names[0])
+    if _POLICY['backend'] != 'auto':
+        if _POLICY['backend'] in names:
+            return _POLICY['backend']
+        warnings.warn(
+            f'Attention backend {_POLICY["backend"]} does not support the call '
+            f'({q.device.type}, {q.dtype}, head dim {q.size(-1)}), using {default} '
+            f'instead.')
+        return default
+    if version is not None and f'flash{version}' in names:
+        return f'flash{version}'
+    if version == 3 and not FLASH_ATTN_3_AVAILABLE:
+        warnings.warn(
+            'Flash attention 3 is not available, use flash attention 2 instead.'
+        )
+    if not _POLICY['autotune']:
+        return default
+    if torch.compiler.is_compiling():
+        # tracing never benchmarks, it uses the choices tuned eagerly before, see
+        # `WanModel.warmup`
+        choice = None
+        if q.device in _DEVICE_NAMES:
+            choice = _POLICY['traced'].get(_shape_key(q, k, kwargs, traced=True))
+        return choice if choice in names else default
+
+    # autotune
+    key = _shape_key(q, k, kwargs)
+    choices = _POLICY['choices']
+    if choices.get(key) not in names:
+        choice = _benchmark(names, q, k, v, kwargs)
+        if choice is None:
+            # every backend failed, so does the call with the default backend
+            return default
+        choices[key] = choice
+        _POLICY['traced'] = _traced_choices(choices)
+        logging.info(f'Attention backend of {key}: {choices[key]}')
+        if _POLICY['cache_file'] is not None:
+            tmp = f'{_POLICY["cache_file"]}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(choices, f, indent=2)
+            os.replace(tmp, _POLICY['cache_file'])
+    return choices[key]
+
+
+if FLASH_ATTN_3_AVAILABLE:
+    _register(
+        'flash3',
+        partial(_flash_attention, version=3),
+        supports=partial(_flash_supported, version=3),
+        varlen=partial(_flash_varlen_attention, version=3))
+if FLASH_ATTN_2_AVAILABLE:
+    _register(
+        'flash2',
+        partial(_flash_attention, version=2),
+        supports=partial(_flash_supported, version=2),
+        varlen=partial(_flash_varlen_attention, version=2))
+_register(
+    'sdpa_efficient',
+    partial(_sdpa_attention, kernel=SDPBackend.EFFICIENT_ATTENTION),
+    supports=partial(_sdpa_supported, cuda_only=True))
+_register('chunked', _chunked_attention,
+          lambda q, k, v, dropout_p, **kwargs: dropout_p == 0)
+_register(
+    'sdpa',
+    partial(_sdpa_attention, kernel=None),
+    supports=partial(_sdpa_supported, cuda_only=False),
+    auto=False)
+_register(
+    'sdpa_math',
+    partial(_sdpa_attention, kernel=SDPBackend.MATH),
+    supports=partial(_sdpa_supported, cuda_only=False),
+    auto=False)
 
 
 def attention(
@@ -145,35 +894,18 @@ def attention(
     dtype=torch.bfloat16,
     fa_version=None,
 ):
-    if FLASH_ATTN_2_AVAILABLE or FLASH_ATTN_3_AVAILABLE:
-        return flash_attention(
-            q=q,
-            k=k,
-            v=v,
-            q_lens=q_lens,
-            k_lens=k_lens,
-            dropout_p=dropout_p,
-            softmax_scale=softmax_scale,
-            q_scale=q_scale,
-            causal=causal,
-            window_size=window_size,
-            deterministic=deterministic,
-            dtype=dtype,
-            version=fa_version,
-        )
-    else:
-        if q_lens is not None or k_lens is not None:
-            warnings.warn(
-                'Padding mask is disabled when using scaled_dot_product_attention. It can have a significant impact on performance.'
-            )
-        attn_mask = None
-
-        q = q.transpose(1, 2).to(dtype)
-        k = k.transpose(1, 2).to(dtype)
-        v = v.transpose(1, 2).to(dtype)
-
-        out = torch.nn.functional.scaled_dot_product_attention(
-            q, k, v, attn_mask=attn_mask, is_causal=causal, dropout_p=dropout_p)
-
-        out = out.transpose(1, 2).contiguous()
-        return out
+    return flash_attention(
+        q=q,
+        k=k,
+        v=v,
+        q_lens=q_lens,
+        k_lens=k_lens,
+        dropout_p=dropout_p,
+        softmax_scale=softmax_scale,
+        q_scale=q_scale,
+        causal=causal,
+        window_size=window_size,
+        deterministic=deterministic,
+        dtype=dtype,
+        version=fa_version,
+    )
@@ -0,0 +1,97 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import logging
+import os
+import zipfile
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+__all__ = ['safetensors_path', 'load_weights', 'convert_checkpoint']
+
+
+def safetensors_path(checkpoint_path):
+    r"""
+    Path of the safetensors conversion of a .pth checkpoint, see `convert_checkpoint`.
+    """
+    return os.path.splitext(checkpoint_path)[0] + '.safetensors'
+
+
+def _load_pth(checkpoint_path):
+    # files of the legacy (non-zip) serialization format can not be memory-mapped
+    return torch.load(
+        checkpoint_path,
+        map_location='cpu',
+        mmap=zipfile.is_zipfile(checkpoint_path))
+
+
+def load_weights(model, checkpoint_path, device='cpu', dtype=None):
+    r"""
+    Loads a checkpoint into a model built on the meta device. The tensors are memory-mapped
+    (from the safetensors conversion of the checkpoint if it exists, else from the .pth
+    file unless it uses the legacy serialization format) and assigned in their final dtype
+    and device, so neither a random initialization nor a full host copy of the checkpoint
+    is made.
+
+    Args:
+        model (`nn.Module`):
+            Model built on the meta device
+        checkpoint_path (`str`):
+            Path of the .pth checkpoint
+        device (`torch.device`, *optional*, defaults to 'cpu'):
+            Device of the loaded tensors
+        dtype (`torch.dtype`, *optional*):
+            Dtype of the floating point tensors. If None, the dtypes of the model
+
+    Returns:
+        `nn.Module`:
+            The model
+    """
+    path = safetensors_path(checkpoint_path)
+    if os.path.isfile(path):
+        logging.info(f'loading {path}')
+        with safe_open(
+                path, framework='pt', device=str(torch.device(device))) as f:
+            state_dict = {key: f.get_tensor(key) for key in f.keys()}
+    else:
+        logging.info(f'loading {checkpoint_path}')
+        state_dict = _load_pth(checkpoint_path)
+
+    targets = dict(model.named_parameters())
+    targets.update(model.named_buffers())
+    for key, t in state_dict.items():
+        target = dtype if dtype is not None and t.is_floating_point() else (
+            targets[key].dtype if key in targets else t.dtype)
+        state_dict[key] = t.to(device=device, dtype=target)
+    model.load_state_dict(state_dict, assign=True)
+    return model
+
+
+def convert_checkpoint(checkpoint_path, dtype=None):
+    r"""
+    Writes the tensors of a .pth checkpoint to a safetensors file next to it, see
+    `safetensors_path`, which `load_weights` then reads instead.
+
+    Args:
+        checkpoint_path (`str`):
+            Path of the .pth checkpoint
+        dtype (`torch.dtype`, *optional*):
+            Dtype of the floating point tensors. If None, the dtypes of the checkpoint
+
+    Returns:
+        `str`:
+            Path of the safetensors file
+    """
+    state_dict = _load_pth(checkpoint_path)
+    tensors, storages = {}, set()
+    for key, t in state_dict.items():
+        if dtype is not None and t.is_floating_point():
+            t = t.to(dtype)
+        # safetensors stores every tensor in its own storage
+        if t.untyped_storage().data_ptr() in storages:
+            t = t.clone()
+        storages.add(t.untyped_storage().data_ptr())
+        tensors[key] = t.contiguous()
+    path = safetensors_path(checkpoint_path)
+    save_file(tensors, path)
+    return path
@@ -1,6 +1,5 @@
 # Modified from ``https://github.com/openai/CLIP'' and ``https://github.com/mlfoundations/open_clip''
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
-import logging
 import math
 
 import torch
@@ -9,6 +8,7 @@ import torch.nn.functional as F
 import torchvision.transforms as T
 
 from .attention import flash_attention
+from .checkpoint import load_weights
 from .tokenizers import HuggingfaceTokenizer
 from .xlm_roberta import XLMRoberta
 
@@ -82,7 +82,7 @@ class SelfAttention(nn.Module):
 
         # compute attention
         p = self.attn_dropout if self.training else 0.0
-        x = flash_attention(q, k, v, dropout_p=p, causal=self.causal, version=2)
+        x = flash_attention(q, k, v, dropout_p=p, causal=self.causal)
         x = x.reshape(b, s, c)
 
         # output
@@ -194,7 +194,7 @@ class AttentionPool(nn.Module):
         k, v = self.to_kv(x).view(b, s, 2, n, d).unbind(2)
 
         # compute attention
-        x = flash_attention(q, k, v, version=2)
+        x = flash_attention(q, k, v)
         x = x.reshape(b, 1, c)
 
         # output
@@ -506,17 +506,15 @@ class CLIPModel:
         self.checkpoint_path = checkpoint_path
         self.tokenizer_path = tokenizer_path
 
-        # init model
+        # init model on the meta device, the weights are loaded memory-mapped
         self.model, self.transforms = clip_xlm_roberta_vit_h_14(
             pretrained=False,
             return_transforms=True,
             return_tokenizer=False,
             dtype=dtype,
-            device=device)
+            device='meta')
         self.model = self.model.eval().requires_grad_(False)
-        logging.info(f'loading {checkpoint_path}')
-        self.model.load_state_dict(
-            torch.load(checkpoint_path, map_location='cpu'))
+        load_weights(self.model, checkpoint_path, device, dtype)
 
         # init tokenizer
         self.tokenizer = HuggingfaceTokenizer(
@@ -1,19 +1,40 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import json
+import logging
 import math
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import torch
 import torch.cuda.amp as amp
 import torch.nn as nn
 from diffusers.configuration_utils import ConfigMixin, register_to_config
 from diffusers.models.modeling_utils import ModelMixin
-
-from .attention import flash_attention
+from diffusers.utils import SAFE_WEIGHTS_INDEX_NAME, SAFETENSORS_WEIGHTS_NAME
+from safetensors import safe_open
+
+from .attention import (
+    HEAD_PATTERNS,
+    attention_autotuning,
+    flash_attention,
+    head_pattern_errors,
+    head_sparse_attention,
+    local_attention,
+    varlen_attention,
+)
+from .quantization import QuantLinear, quantize_linears
+from .token_merging import LocalTokenMerging, merge_candidates
 
 __all__ = ['WanModel']
 
 T5_CONTEXT_TOKEN_NUMBER = 512
 FIRST_LAST_FRAME_CONTEXT_TOKEN_NUMBER = 257 * 2
 
+# maximum number of grid layouts whose rope tables are kept
+ROPE_CACHE_SIZE = 16
+_ROPE_CACHE = OrderedDict()
+
 
 def sinusoidal_embedding_1d(dim, position):
     # preprocess
@@ -40,34 +61,90 @@ def rope_params(max_seq_len, dim, theta=10000):
 
 
 @amp.autocast(enabled=False)
-def rope_apply(x, grid_sizes, freqs):
-    n, c = x.size(2), x.size(3) // 2
+def rope_cos_sin(freqs, grid_sizes, seq_len, offset=0, packed=False):
+    r"""
+    Returns the rotation tables of tokens [offset, offset + seq_len) of each sample.
+
+    The tables only depend on the grid sizes, so they are built once and kept in a bounded
+    LRU cache. Positions past the end of a sample's grid get the identity rotation.
+
+    Args:
+        freqs(Tensor): Rope freqs, shape [1024, C / num_heads / 2]
+        grid_sizes(Tensor): Shape [B, 3], the second dimension contains (F, H, W)
+        seq_len(`int`): Number of tokens covered by the tables
+        offset(`int`, *optional*, defaults to 0): Index of the first covered token
+        packed(`bool`, *optional*, defaults to False): Whether the samples are packed into a
+            single sequence, see `WanModel.varlen`
+
+    Returns:
+        Tuple[Tensor, Tensor]:
+            float32 cos and sin tables, each with shape [B, seq_len, 1, C / num_heads / 2],
+            or [1, seq_len, 1, C / num_heads / 2] if packed
+    """
+    grids = tuple(tuple(u) for u in grid_sizes.tolist())
+    key = (grids, seq_len, offset, packed, tuple(freqs.shape), freqs.device)
+    if key in _ROPE_CACHE:
+        _ROPE_CACHE.move_to_end(key)
+        return _ROPE_CACHE[key]
 
     # split freqs
+    c = freqs.size(1)
     freqs = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
 
-    # loop over samples
-    output = []
-    for i, (f, h, w) in enumerate(grid_sizes.tolist()):
-        seq_len = f * h * w
+    cos = torch.ones(
+        1 if packed else len(grids),
+        seq_len,
+        1,
+        c,
+        dtype=torch.float32,
+        device=key[-1])
+    sin = torch.zeros_like(cos)
+    begin = 0
+    for i, (f, h, w) in enumerate(grids):
+        # covered tokens [start, end) of the sample, which begins at token `begin`
+        row = 0 if packed else i
+        start = max(offset - begin, 0)
+        end = min(f * h * w, offset + seq_len - begin)
+        if end > start:
+            freqs_i = torch.cat([
+                freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
+                freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
+                freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
+            ],
+                                dim=-1).reshape(f * h * w, 1,
+                                                -1)[start:end]
+            cos[row, begin + start - offset:begin + end - offset] = \
+                freqs_i.real
+            sin[row, begin + start - offset:begin + end - offset] = \
+                freqs_i.imag
+        if packed:
+            begin += f * h * w
+
+    _ROPE_CACHE[key] = (cos, sin)
+    if len(_ROPE_CACHE) > ROPE_CACHE_SIZE:
+        _ROPE_CACHE.popitem(last=False)
+    return cos, sin
 
-        # precompute multipliers
-        x_i = torch.view_as_complex(x[i, :seq_len].to(torch.float64).reshape(
-            seq_len, n, -1, 2))
-        freqs_i = torch.cat([
-            freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
-            freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
-            freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
-        ],
-                            dim=-1).reshape(seq_len, 1, -1)
 
-        # apply rotary embedding
-        x_i = torch.view_as_real(x_i * freqs_i).flatten(2)
-        x_i = torch.cat([x_i, x[i, seq_len:]])
+@amp.autocast(enabled=False)
+def rope_rotate(x, cos, sin):
+    r"""
+    Rotates consecutive channel pairs of x in float32 real arithmetic.
+
+    Args:
+        x(Tensor): Shape [B, L, N, C]
+        cos(Tensor): Shape [B, L, 1, C / 2]
+        sin(Tensor): Shape [B, L, 1, C / 2]
+    """
+    x_real, x_imag = x.float().unflatten(3, (-1, 2)).unbind(-1)
+    return torch.stack(
+        [x_real * cos - x_imag * sin, x_real * sin + x_imag * cos],
+        dim=-1).flatten(3)
 
-        # append to collection
-        output.append(x_i)
-    return torch.stack(output).float()
+
+def rope_apply(x, grid_sizes, freqs):
+    cos, sin = rope_cos_sin(freqs, grid_sizes, x.size(1))
+    return rope_rotate(x, cos, sin)
 
 
 class WanRMSNorm(nn.Module):
@@ -102,8 +179,43 @@ class WanLayerNorm(nn.LayerNorm):
         return super().forward(x.float()).type_as(x)
 
 
+# tensors of `nn.Linear` and `QuantLinear` projections, all split by output channel
+_PROJECTION_TENSORS = ('weight', 'bias', 'qweight', 'scale')
+
+
+def _split_projections(module, state_dict, prefix, local_metadata):
+    # save fused projections in the unfused layout of the released checkpoints
+    for name, parts in module._fusable_projections.items():
+        for suffix in _PROJECTION_TENSORS:
+            if f'{prefix}{name}.{suffix}' not in state_dict:
+                continue
+            fused = state_dict.pop(f'{prefix}{name}.{suffix}')
+            for part, u in zip(parts, fused.chunk(len(parts))):
+                state_dict[f'{prefix}{part}.{suffix}'] = u.clone()
+
+
+def _pack_projections(module, state_dict, prefix, *args):
+    # load the unfused layout of the released checkpoints into fused projections
+    for name, parts in module._fusable_projections.items():
+        for suffix in _PROJECTION_TENSORS:
+            keys = [f'{prefix}{part}.{suffix}' for part in parts]
+            if all(key in state_dict for key in keys):
+                state_dict[f'{prefix}{name}.{suffix}'] = torch.cat(
+                    [state_dict.pop(key) for key in keys])
+
+
+def _pack_tokens(x, lens):
+    # [B, L, ...] -> [sum(lens), ...], all L tokens of each sample if lens is None
+    if lens is None:
+        return x.flatten(0, 1)
+    return torch.cat([u[:l] for u, l in zip(x, lens.tolist())])
+
+
 class WanSelfAttention(nn.Module):
 
+    # fused projection -> the projections of the same input packed into it
+    _fusable_projections = {'qkv': ('q', 'k', 'v')}
+
     def __init__(self,
                  dim,
                  num_heads,
@@ -126,32 +238,168 @@ class WanSelfAttention(nn.Module):
         self.o = nn.Linear(dim, dim)
         self.norm_q = WanRMSNorm(dim, eps=eps) if qk_norm else nn.Identity()
         self.norm_k = WanRMSNorm(dim, eps=eps) if qk_norm else nn.Identity()
+        self.fused = False
+        # 3D local attention of the self-attentions, see `WanModel.set_local_attention`
+        self.local_window = None
+        self.local_tile = None
+        self.global_steps = None
+        # head-aware sparse attention, see `WanModel.set_sparse_attention`
+        self.sparse = None
+        self.sparse_patterns = {}
+
+    def fuse_projections(self):
+        r"""
+        Packs the projections that read the same input into a single linear layer each, e.g.
+        q/k/v into `qkv`, so that one GEMM replaces several. The norms are still applied per
+        projection. State dicts keep the unfused layout of the released checkpoints, both when
+        saving and when loading.
+        """
+        if self.fused:
+            return
+        for name, parts in self._fusable_projections.items():
+            layers = [getattr(self, part) for part in parts]
+            if isinstance(layers[0], QuantLinear):
+                fused = QuantLinear.cat(layers)
+            else:
+                fused = nn.Linear(
+                    self.dim,
+                    self.dim * len(parts),
+                    device=torch.device('meta'))
+                fused.weight = nn.Parameter(
+                    torch.cat([u.weight for u in layers]),
+                    requires_grad=layers[0].weight.requires_grad)
+                fused.bias = nn.Parameter(
+                    torch.cat([u.bias for u in layers]),
+                    requires_grad=layers[0].bias.requires_grad)
+            for part in parts:
+                delattr(self, part)
+            setattr(self, name, fused)
+        self._register_state_dict_hook(_split_projections)
+        self._register_load_state_dict_pre_hook(
+            _pack_projections, with_module=True)
+        self.fused = True
+
+    def project(self, name, x):
+        r"""
+        Applies the projections packed into the fused projection `name` (e.g. 'qkv') to x.
 
-    def forward(self, x, seq_lens, grid_sizes, freqs):
+        Returns:
+            List[Tensor]:
+                One output per packed projection, before the norms
+        """
+        if self.fused:
+            return getattr(self, name)(x).chunk(
+                len(self._fusable_projections[name]), dim=-1)
+        return [getattr(self, part)(x) for part in self._fusable_projections[name]]
+
+    def head_patterns(self, grid_sizes):
+        r"""
+        Returns the sparse attention pattern of every head for each grid in grid_sizes, or
+        None for the grids whose heads are still being profiled.
+        """
+        patterns = [self.sparse_patterns.get(u) for u in grid_sizes]
+        return [u if isinstance(u, tuple) else None for u in patterns]
+
+    @torch.compiler.disable
+    def profile_heads(self, q, k, v, grid_sizes):
+        r"""
+        Accumulates the errors of the sparse patterns of every head on the grids that are
+        not classified yet. After `profile_passes` forwards, each head gets the pattern with
+        the smallest error, or 'dense' if that error exceeds the threshold.
+        """
+        for grid in dict.fromkeys(grid_sizes):
+            state = self.sparse_patterns.setdefault(
+                grid, dict(errors=0., passes=0))
+            if isinstance(state, tuple):
+                continue
+            idx = [i for i, u in enumerate(grid_sizes) if u == grid]
+            seq_len = math.prod(grid)
+            state['errors'] = state['errors'] + head_pattern_errors(
+                q[idx, :seq_len],
+                k[idx, :seq_len],
+                v[idx, :seq_len],
+                grid,
+                num_samples=self.sparse['num_samples'])
+            state['passes'] += 1
+            if state['passes'] >= self.sparse['profile_passes']:
+                errors, best = state['errors'][1:].min(0)
+                errors = (errors / state['passes']).tolist()
+                self.sparse_patterns[grid] = tuple(
+                    HEAD_PATTERNS[i + 1] if e < self.sparse['threshold'] else
+                    'dense' for e, i in zip(errors, best.tolist()))
+
+    def sparse_attention(self, q, k, v, seq_lens, grid_sizes, patterns):
+        r"""
+        Head-aware sparse self-attention of rope-rotated q, k and v, see
+        `WanModel.set_sparse_attention`. Profiling forwards compute full attention.
+        """
+        if any(u is None for u in patterns):
+            self.profile_heads(q, k, v, grid_sizes)
+            return flash_attention(
+                q=q, k=k, v=v, k_lens=seq_lens, window_size=self.window_size)
+        return head_sparse_attention(q, k, v, grid_sizes, patterns)
+
+    def forward(self,
+                x,
+                seq_lens,
+                grid_sizes,
+                freqs,
+                rope=None,
+                local=None,
+                sparse=None,
+                varlen=None):
         r"""
         Args:
             x(Tensor): Shape [B, L, num_heads, C / num_heads]
             seq_lens(Tensor): Shape [B]
             grid_sizes(Tensor): Shape [B, 3], the second dimension contains (F, H, W)
             freqs(Tensor): Rope freqs, shape [1024, C / num_heads / 2]
+            rope(Tuple[Tensor], *optional*): Precomputed rope tables of x, see `rope_cos_sin`
+            local(Tuple, *optional*): (grid sizes, window, tile) of 3D local attention, see
+                `local_attention`. If None, every token attends to the whole sequence
+            sparse(Tuple, *optional*): (grid sizes, head patterns) of head-aware sparse
+                attention, see `sparse_attention`. Ignored if local is given
+            varlen(dict, *optional*): Sample boundaries of packed tokens, see
+                `WanModel.varlen_args`. If given, x has shape [1, sum(seq_lens), C]
         """
         b, s, n, d = *x.shape[:2], self.num_heads, self.head_dim
 
         # query, key, value function
         def qkv_fn(x):
-            q = self.norm_q(self.q(x)).view(b, s, n, d)
-            k = self.norm_k(self.k(x)).view(b, s, n, d)
-            v = self.v(x).view(b, s, n, d)
+            q, k, v = self.project('qkv', x)
+            q = self.norm_q(q).view(b, s, n, d)
+            k = self.norm_k(k).view(b, s, n, d)
+            v = v.view(b, s, n, d)
             return q, k, v
 
         q, k, v = qkv_fn(x)
-
-        x = flash_attention(
-            q=rope_apply(q, grid_sizes, freqs),
-            k=rope_apply(k, grid_sizes, freqs),
-            v=v,
-            k_lens=seq_lens,
-            window_size=self.window_size)
+        if rope is None:
+            rope = rope_cos_sin(freqs, grid_sizes, s)
+
+        if local is not None:
+            x = local_attention(
+                rope_rotate(q, *rope), rope_rotate(k, *rope), v, *local)
+        elif sparse is not None:
+            x = self.sparse_attention(
+                rope_rotate(q, *rope), rope_rotate(k, *rope), v, seq_lens,
+                *sparse)
+        elif varlen is not None:
+            x = varlen_attention(
+                rope_rotate(q, *rope)[0],
+                rope_rotate(k, *rope)[0],
+                v[0],
+                cu_seqlens_q=varlen['cu_seqlens'],
+                cu_seqlens_k=varlen['cu_seqlens'],
+                max_seqlen_q=varlen['max_seqlen'],
+                max_seqlen_k=varlen['max_seqlen'],
+                window_size=self.window_size).unsqueeze(0)
+        else:
+            x = flash_attention(
+                q=rope_rotate(q, *rope),
+                k=rope_rotate(k, *rope),
+                v=v,
+                k_lens=seq_lens,
+                window_size=self.window_size)
 
         # output
         x = x.flatten(2)
@@ -161,22 +409,57 @@ class WanSelfAttention(nn.Module):
 
 class WanT2VCrossAttention(WanSelfAttention):
 
-    def forward(self, x, context, context_lens):
+    _fusable_projections = {'kv': ('k', 'v')}
+
+    def project_context(self, context, context_lens):
         r"""
         Args:
-            x(Tensor): Shape [B, L1, C]
             context(Tensor): Shape [B, L2, C]
             context_lens(Tensor): Shape [B]
+
+        Returns:
+            Tuple[Tensor]:
+                The keys and values of the context, each with shape [B, L2, num_heads, C / num_heads]
+        """
+        b, n, d = context.size(0), self.num_heads, self.head_dim
+        k, v = self.project('kv', context)
+        return self.norm_k(k).view(b, -1, n, d), v.view(b, -1, n, d)
+
+    def pack_context(self, context_kv, context_lens):
+        r"""
+        Packs the real tokens of the keys and values of `project_context` for varlen
+        attention, each into shape [sum(context_lens), num_heads, C / num_heads].
+        """
+        return tuple(_pack_tokens(u, context_lens) for u in context_kv)
+
+    def forward(self, x, context_kv, context_lens, varlen=None):
+        r"""
+        Args:
+            x(Tensor): Shape [B, L1, C]
+            context_kv(Tuple[Tensor]): Keys and values of the context, see `project_context`,
+                packed by `pack_context` if varlen is given
+            context_lens(Tensor): Shape [B]
+            varlen(dict, *optional*): Sample boundaries of packed tokens, see
+                `WanModel.varlen_args`. If given, x has shape [1, sum(L1), C]
         """
         b, n, d = x.size(0), self.num_heads, self.head_dim
 
         # compute query, key, value
         q = self.norm_q(self.q(x)).view(b, -1, n, d)
-        k = self.norm_k(self.k(context)).view(b, -1, n, d)
-        v = self.v(context).view(b, -1, n, d)
+        k, v = context_kv
 
         # compute attention
-        x = flash_attention(q, k, v, k_lens=context_lens)
+        if varlen is not None:
+            x = varlen_attention(
+                q[0],
+                k,
+                v,
+                cu_seqlens_q=varlen['cu_seqlens_q'],
+                cu_seqlens_k=varlen['cu_seqlens_k'],
+                max_seqlen_q=varlen['max_seqlen_q'],
+                max_seqlen_k=varlen['max_seqlen_k']).unsqueeze(0)
+        else:
+            x = flash_attention(q, k, v, k_lens=context_lens)
 
         # output
         x = x.flatten(2)
@@ -186,6 +469,8 @@ class WanT2VCrossAttention(WanSelfAttention):
 
 class WanI2VCrossAttention(WanSelfAttention):
 
+    _fusable_projections = {'kv': ('k', 'v'), 'kv_img': ('k_img', 'v_img')}
+
     def __init__(self,
                  dim,
                  num_heads,
@@ -199,27 +484,79 @@ class WanI2VCrossAttention(WanSelfAttention):
         # self.alpha = nn.Parameter(torch.zeros((1, )))
         self.norm_k_img = WanRMSNorm(dim, eps=eps) if qk_norm else nn.Identity()
 
-    def forward(self, x, context, context_lens):
+    def project_context(self, context, context_lens):
         r"""
         Args:
-            x(Tensor): Shape [B, L1, C]
-            context(Tensor): Shape [B, L2, C]
+            context(Tensor): Shape [B, L2, C], the CLIP image context followed by the text context
             context_lens(Tensor): Shape [B]
+
+        Returns:
+            Tuple[Tensor]:
+                The keys and values of the text and the image context, each with shape
+                [B, L, num_heads, C / num_heads]
         """
-        image_context_length = context.shape[1] - T5_CONTEXT_TOKEN_NUMBER
+        b, n, d = context.size(0), self.num_heads, self.head_dim
+        image_context_length = context.shape[1] - (
+            T5_CONTEXT_TOKEN_NUMBER
+            if context_lens is None else int(context_lens.max()))
         context_img = context[:, :image_context_length]
         context = context[:, image_context_length:]
+        k, v = self.project('kv', context)
+        k_img, v_img = self.project('kv_img', context_img)
+        return (self.norm_k(k).view(b, -1, n, d), v.view(b, -1, n, d),
+                self.norm_k_img(k_img).view(b, -1, n, d),
+                v_img.view(b, -1, n, d))
+
+    def pack_context(self, context_kv, context_lens):
+        r"""
+        Packs the real tokens of the keys and values of `project_context` for varlen
+        attention, each into shape [sum(L), num_heads, C / num_heads].
+        """
+        k, v, k_img, v_img = context_kv
+        return (_pack_tokens(k, context_lens), _pack_tokens(v, context_lens),
+                k_img.flatten(0, 1), v_img.flatten(0, 1))
+
+    def forward(self, x, context_kv, context_lens, varlen=None):
+        r"""
+        Args:
+            x(Tensor): Shape [B, L1, C]
+            context_kv(Tuple[Tensor]): Keys and values of the context, see `project_context`,
+                packed by `pack_context` if varlen is given
+            context_lens(Tensor): Shape [B]
+            varlen(dict, *optional*): Sample boundaries of packed tokens, see
+                `WanModel.varlen_args`. If given, x has shape [1, sum(L1), C]
+        """
         b, n, d = x.size(0), self.num_heads, self.head_dim
 
         # compute query, key, value
         q = self.norm_q(self.q(x)).view(b, -1, n, d)
-        k = self.norm_k(self.k(context)).view(b, -1, n, d)
-        v = self.v(context).view(b, -1, n, d)
-        k_img = self.norm_k_img(self.k_img(context_img)).view(b, -1, n, d)
-        v_img = self.v_img(context_img).view(b, -1, n, d)
-        img_x = flash_attention(q, k_img, v_img, k_lens=None)
-        # compute attention
-        x = flash_attention(q, k, v, k_lens=context_lens)
+        k, v, k_img, v_img = context_kv
+        if varlen is not None:
+            # every sample attends to its own image tokens
+            num_samples = varlen['cu_seqlens_q'].numel() - 1
+            img_len = k_img.size(0) // num_samples
+            img_x = varlen_attention(
+                q[0],
+                k_img,
+                v_img,
+                cu_seqlens_q=varlen['cu_seqlens_q'],
+                cu_seqlens_k=torch.arange(
+                    0, k_img.size(0) + 1, img_len,
+                    dtype=torch.int32, device=q.device),
+                max_seqlen_q=varlen['max_seqlen_q'],
+                max_seqlen_k=img_len).unsqueeze(0)
+            x = varlen_attention(
+                q[0],
+                k,
+                v,
+                cu_seqlens_q=varlen['cu_seqlens_q'],
+                cu_seqlens_k=varlen['cu_seqlens_k'],
+                max_seqlen_q=varlen['max_seqlen_q'],
+                max_seqlen_k=varlen['max_seqlen_k']).unsqueeze(0)
+        else:
+            img_x = flash_attention(q, k_img, v_img, k_lens=None)
+            # compute attention
+            x = flash_attention(q, k, v, k_lens=context_lens)
 
         # output
         x = x.flatten(2)
@@ -275,6 +612,11 @@ class WanAttentionBlock(nn.Module):
         # modulation
         self.modulation = nn.Parameter(torch.randn(1, 6, dim) / dim**0.5)
 
+        # see `WanModel.set_token_merging`
+        self.token_merging = None
+        # see `WanModel.set_chunked_ffn`
+        self.ffn_chunk_size = None
+
     def forward(
         self,
         x,
@@ -284,36 +626,140 @@ class WanAttentionBlock(nn.Module):
         freqs,
         context,
         context_lens,
+        cross_attn_cache=None,
+        step=None,
+        modulation_cache=None,
+        rope=None,
+        varlen=None,
     ):
         r"""
         Args:
-            x(Tensor): Shape [B, L, C]
-            e(Tensor): Shape [B, 6, C]
+            x(Tensor): Shape [B, L, C], or [1, sum(seq_lens), C] if varlen is given
+            e(Tensor): Shape [B, 6, C], or [S, 6, C] for the whole schedule if step is given
             seq_lens(Tensor): Shape [B], length of each sequence in batch
             grid_sizes(Tensor): Shape [B, 3], the second dimension contains (F, H, W)
             freqs(Tensor): Rope freqs, shape [1024, C / num_heads / 2]
+            cross_attn_cache(dict, *optional*): Per-run cross-attention key/value cache
+            step(`int`, *optional*): Index of the sampling step in the schedule
+            modulation_cache(dict, *optional*): Per-run modulation tables of the schedule
+            rope(Tuple[Tensor], *optional*): Precomputed rope tables of x, see `rope_cos_sin`
+            varlen(dict, *optional*): Sample boundaries of packed tokens, see
+                `WanModel.varlen_args`
         """
         assert e.dtype == torch.float32
         with amp.autocast(dtype=torch.float32):
-            e = (self.modulation + e).chunk(6, dim=1)
+            if step is None:
+                e = self.modulation + e
+            else:
+                if self not in modulation_cache:
+                    modulation_cache[self] = self.modulation + e
+                e = modulation_cache[self][step:step + 1]
+        if rope is None:
+            rope = rope_cos_sin(
+                freqs, grid_sizes, x.size(1), packed=varlen is not None)
+
+        # 3D local self-attention, unless this step is a global one
+        local = None
+        if self.self_attn.local_window is not None and (
+                step is None or self.self_attn.global_steps is None or
+                not self.self_attn.global_steps[0] <= step <
+                self.self_attn.global_steps[1]):
+            local = (list(map(tuple, grid_sizes.tolist())),
+                     self.self_attn.local_window, self.self_attn.local_tile)
+
+        # head-aware sparse self-attention
+        sparse = None
+        if local is None and self.self_attn.sparse is not None:
+            grids = list(map(tuple, grid_sizes.tolist()))
+            sparse = (grids, self.self_attn.head_patterns(grids))
+
+        # token merging, if all samples share the grid. The candidate merges are built
+        # here, the compiled `_forward` would break its graph on their mask selection
+        merge = None
+        merging = self.token_merging
+        if merging is not None and local is None and sparse is None and (
+                step is None or merging['steps'] is None or
+                merging['steps'][0] <= step < merging['steps'][1]):
+            grids = set(map(tuple, grid_sizes.tolist()))
+            if len(grids) == 1:
+                merge = (merging['ratio'],
+                         merge_candidates(grids.pop(), merging['stride'],
+                                          x.device), merging['whole_block'])
+
+        # cross-attention keys/values, packed for varlen attention
+        key = self.cross_attn if varlen is None else (self.cross_attn, 'varlen')
+        if cross_attn_cache is not None and key in cross_attn_cache:
+            context_kv = cross_attn_cache[key]
+        else:
+            context_kv = self.cross_attn.project_context(context, context_lens)
+            if varlen is not None:
+                context_kv = self.cross_attn.pack_context(
+                    context_kv, context_lens)
+            if cross_attn_cache is not None:
+                cross_attn_cache[key] = context_kv
+
+        return self._forward(x, e, seq_lens, grid_sizes, freqs, rope,
+                             context_kv, context_lens, local, sparse, merge,
+                             varlen)
+
+    def _forward(self, x, e, seq_lens, grid_sizes, freqs, rope, context_kv,
+                 context_lens, local, sparse, merge, varlen):
+        # tensor computation of the block, free of host syncs and cache lookups
+        # so that it can be compiled, see `WanModel.compile_blocks`
+        e = e.chunk(6, dim=1)
         assert e[0].dtype == torch.float32
 
+        # token merging, of the self-attention input or of the whole block
+        merging = None
+        if merge is not None:
+            ratio, candidates, whole_block = merge
+            merging = LocalTokenMerging(x, ratio, candidates)
+            seq_lens = seq_lens - merging.num_merged
+            rope = [merging.gather(u) for u in rope]
+            if whole_block:
+                x_full = x
+                x = x_merged = merging.merge(x)
+
         # self-attention
+        y = self.norm1(x).float() * (1 + e[1]) + e[0]
+        if merging is not None and not whole_block:
+            y = merging.merge(y)
         y = self.self_attn(
-            self.norm1(x).float() * (1 + e[1]) + e[0], seq_lens, grid_sizes,
-            freqs)
+            y,
+            seq_lens,
+            grid_sizes,
+            freqs,
+            rope=rope,
+            local=local,
+            sparse=sparse,
+            varlen=varlen)
+        if merging is not None and not whole_block:
+            y = merging.unmerge(y)
         with amp.autocast(dtype=torch.float32):
             x = x + y * e[2]
 
-        # cross-attention & ffn function
-        def cross_attn_ffn(x, context, context_lens, e):
-            x = x + self.cross_attn(self.norm3(x), context, context_lens)
+        # gated ffn residual
+        def ffn(x, e):
             y = self.ffn(self.norm2(x).float() * (1 + e[4]) + e[3])
             with amp.autocast(dtype=torch.float32):
-                x = x + y * e[5]
+                return y * e[5]
+
+        # cross-attention & ffn function
+        def cross_attn_ffn(x, context_kv, context_lens, e):
+            x = x + self.cross_attn(
+                self.norm3(x), context_kv, context_lens, varlen=varlen)
+            if self.ffn_chunk_size is None:
+                x = x + ffn(x, e)
+            else:
+                # in place, chunk by chunk of the sequence, so that the fp32 copies and
+                # the [B, L, ffn_dim] intermediate only exist for one chunk at a time
+                for u in x.split(self.ffn_chunk_size, dim=1):
+                    u += ffn(u, e)
             return x
 
-        x = cross_attn_ffn(x, context, context_lens, e)
+        x = cross_attn_ffn(x, context_kv, context_lens, e)
+        if merging is not None and whole_block:
+            return x_full + merging.unmerge(x - x_merged)
         return x
 
 
@@ -334,15 +780,28 @@ class Head(nn.Module):
         # modulation
         self.modulation = nn.Parameter(torch.randn(1, 2, dim) / dim**0.5)
 
-    def forward(self, x, e):
+    def forward(self, x, e, step=None, modulation_cache=None):
         r"""
         Args:
             x(Tensor): Shape [B, L1, C]
-            e(Tensor): Shape [B, C]
+            e(Tensor): Shape [B, C], or [S, C] for the whole schedule if step is given
+            step(`int`, *optional*): Index of the sampling step in the schedule
+            modulation_cache(dict, *optional*): Per-run modulation tables of the schedule
         """
         assert e.dtype == torch.float32
         with amp.autocast(dtype=torch.float32):
-            e = (self.modulation + e.unsqueeze(1)).chunk(2, dim=1)
+            if step is None:
+                e = self.modulation + e.unsqueeze(1)
+            else:
+                if self not in modulation_cache:
+                    modulation_cache[self] = self.modulation + e.unsqueeze(1)
+                e = modulation_cache[self][step:step + 1]
+        return self._forward(x, e)
+
+    def _forward(self, x, e):
+        # compiled by `WanModel.compile_blocks`
+        with amp.autocast(dtype=torch.float32):
+            e = e.chunk(2, dim=1)
             x = (self.head(self.norm(x) * (1 + e[1]) + e[0]))
         return x
 
@@ -395,7 +854,8 @@ class WanModel(ModelMixin, ConfigMixin):
                  window_size=(-1, -1),
                  qk_norm=True,
                  cross_attn_norm=True,
-                 eps=1e-6):
+                 eps=1e-6,
+                 quantization=None):
         r"""
         Initialize the diffusion model backbone.
 
@@ -430,6 +890,9 @@ class WanModel(ModelMixin, ConfigMixin):
                 Enable cross-attention normalization
             eps (`float`, *optional*, defaults to 1e-6):
                 Epsilon value for normalization layers
+            quantization (`dict`, *optional*):
+                Weight-only quantization of the blocks, `bits` and `group_size` of
+                `quantize`. Set in the config of checkpoints written after `quantize`
         """
 
         super().__init__()
@@ -475,20 +938,673 @@ class WanModel(ModelMixin, ConfigMixin):
         self.head = Head(dim, out_dim, patch_size, eps)
 
         # buffers (don't use register_buffer otherwise dtype will be changed in to())
+        # built on the host even if the model is built on the meta device, see
+        # `load_pretrained`
         assert (dim % num_heads) == 0 and (dim // num_heads) % 2 == 0
         d = dim // num_heads
-        self.freqs = torch.cat([
-            rope_params(1024, d - 4 * (d // 6)),
-            rope_params(1024, 2 * (d // 6)),
-            rope_params(1024, 2 * (d // 6))
-        ],
-                               dim=1)
+        with torch.device('cpu'):
+            self.freqs = torch.cat([
+                rope_params(1024, d - 4 * (d // 6)),
+                rope_params(1024, 2 * (d // 6)),
+                rope_params(1024, 2 * (d // 6))
+            ],
+                                   dim=1)
 
         if model_type == 'i2v' or model_type == 'flf2v':
             self.img_emb = MLPProj(1280, dim, flf_pos_emb=model_type == 'flf2v')
 
+        # attend to the real text tokens only, set to False for the
+        # (bit-compatible) behaviour of attending to all `text_len` tokens
+        self.trim_text_context = True
+
+        # pack the samples into one sequence without padding where possible, see
+        # `varlen_args`, set to False to always pad them to `seq_len`
+        self.varlen = True
+        # whether the blocks are compiled, see `compile_blocks`
+        self.compiled = False
+
+        # per-run state, see `sampling_session`
+        self._session = None
+
         # initialize weights
         self.init_weights()
+        if quantization is not None:
+            self._quantize_blocks(convert=False, **quantization)
+
+    @classmethod
+    def load_pretrained(cls,
+                        checkpoint_dir,
+                        device='cpu',
+                        torch_dtype=None,
+                        blocks=None):
+        r"""
+        Fast alternative to `from_pretrained` for local safetensors checkpoints. The model
+        is built on the meta device, skipping the random initialization, and the tensors of
+        the memory-mapped shards are assigned directly in the target dtype and device,
+        without intermediate copies. Other checkpoints fall back to `from_pretrained`.
+
+        Args:
+            checkpoint_dir (`str`):
+                Directory of the config and the (sharded) safetensors weights
+            device (`torch.device`, *optional*, defaults to 'cpu'):
+                Device of the loaded tensors
+            torch_dtype (`torch.dtype`, *optional*):
+                Dtype of the floating point tensors. If None, the dtypes of the model
+                definition as with `from_pretrained`
+            blocks (List[`int`], *optional*):
+                Indices of the entries of `self.blocks` to load, e.g. for pipeline parallel
+                stages. The other blocks are left on the meta device. If None, all blocks
+
+        Returns:
+            The model in eval mode
+        """
+        index_file = os.path.join(checkpoint_dir, SAFE_WEIGHTS_INDEX_NAME)
+        if os.path.isfile(index_file):
+            with open(index_file) as f:
+                shards = sorted(set(json.load(f)['weight_map'].values()))
+        elif os.path.isfile(
+                os.path.join(checkpoint_dir, SAFETENSORS_WEIGHTS_NAME)):
+            shards = [SAFETENSORS_WEIGHTS_NAME]
+        else:
+            model = cls.from_pretrained(checkpoint_dir, torch_dtype=torch_dtype)
+            return model.to(device)
+
+        with torch.device('meta'):
+            model = cls.from_config(cls.load_config(checkpoint_dir))
+        skipped = () if blocks is None else tuple(
+            f'blocks.{i}.'
+            for i in range(len(model.blocks))
+            if i not in set(blocks))
+        targets = dict(model.named_parameters())
+        targets.update(model.named_buffers())
+
+        state_dict = {}
+        for shard in shards:
+            with safe_open(
+                    os.path.join(checkpoint_dir, shard),
+                    framework='pt',
+                    device=str(torch.device(device))) as f:
+                for key in f.keys():
+                    if key.startswith(skipped):
+                        continue
+                    t = f.get_tensor(key)
+                    dtype = targets[key].dtype if key in targets else t.dtype
+                    if torch_dtype is not None and t.is_floating_point():
+                        dtype = torch_dtype
+                    state_dict[key] = t.to(dtype)
+
+        missing, unexpected = model.load_state_dict(
+            state_dict, strict=False, assign=True)
+        missing = [u for u in missing if not u.startswith(skipped)]
+        if missing or unexpected:
+            raise RuntimeError(
+                f'Error loading {checkpoint_dir}: missing keys {missing}, '
+                f'unexpected keys {unexpected}.')
+        return model.eval()
+
+    @contextmanager
+    def sampling_session(self, timesteps=None, cache_threshold=0.):
+        r"""
+        Scopes the per-run caches of one sampling run (e.g. one `generate` call).
+
+        Inside the session, the projected cross-attention keys/values of every block are
+        computed on the first forward of each guidance branch and reused by later steps,
+        since the text and CLIP image context do not change across sampling steps. Forwards
+        must pass `branch` to use the cache.
+
+        If the timestep schedule is given, the time embeddings and the modulation vectors
+        of every block and the head are computed once for the whole schedule, and forwards
+        passing `step` look them up by step index.
+
+        With a positive `cache_threshold`, the block stack is skipped on steps whose
+        timestep-modulated input changed by less than the threshold (accumulated relative
+        L1 distance) since the last computed step of the same branch, and the residual of
+        that step is reused instead (TeaCache). The number of skipped steps of each branch
+        is logged on exit. All cached state is dropped on exit.
+
+        Args:
+            timesteps (Tensor, *optional*):
+                Timesteps of the sampling schedule, shape [S]
+            cache_threshold (`float`, *optional*, defaults to 0.0):
+                Residual cache threshold, 0 disables step skipping
+        """
+        self._session = dict(
+            cross_attn={},
+            timesteps=timesteps,
+            time_embedding=None,
+            modulation={},
+            cache_threshold=cache_threshold,
+            residual={})
+        try:
+            yield
+        finally:
+            for branch, state in self._session['residual'].items():
+                logging.info(
+                    f'Residual cache of branch {"/".join(branch)} skipped '
+                    f'{state["skipped"]} of {state["steps"]} steps.')
+            for grid, sparsity in self.sparse_attention_report().items():
+                logging.info(f'Sparse attention skipped {sparsity:.1%} of the '
+                             f'attention scores at grid size {grid}.')
+            self._session = None
+
+    def fuse_qkv_projections(self):
+        r"""
+        Fuses the projections of the same input in every attention layer, i.e. q/k/v of the
+        self-attentions and k/v (and k_img/v_img) of the cross-attentions. Must be called
+        before sharding the model. The state dict layout is unchanged.
+        """
+        for module in self.modules():
+            if isinstance(module, WanSelfAttention):
+                module.fuse_projections()
+
+    def quantize(self, bits=8, group_size=128):
+        r"""
+        Quantizes the weights of the self-attention, cross-attention and ffn projections of
+        every block (including VACE blocks) to per-channel int8 or group-wise int4, see
+        `QuantLinear`. The quantization is recorded in the config, so a checkpoint written
+        by `save_pretrained` is loaded quantized by `from_pretrained`.
+
+        Args:
+            bits (`int`, *optional*, defaults to 8):
+                Weight bits, 8 or 4
+            group_size (`int`, *optional*, defaults to 128):
+                Number of input channels sharing a scale in int4 mode
+        """
+        self._quantize_blocks(bits, group_size, convert=True)
+        self.register_to_config(
+            quantization=dict(bits=bits, group_size=group_size))
+
+    def _quantize_blocks(self, bits=8, group_size=128, convert=True):
+        for module in self.modules():
+            if isinstance(module, WanAttentionBlock):
+                for layer in (module.self_attn, module.cross_attn,
+                              module.ffn):
+                    quantize_linears(layer, bits, group_size, convert)
+
+    def set_local_attention(self,
+                            window=None,
+                            tile=None,
+                            global_layers=(),
+                            global_steps=None):
+        r"""
+        Restricts the self-attention of every block (including VACE blocks) to a 3D
+        neighbourhood of each token on the (F, H, W) latent grid, see `local_attention`.
+
+        Args:
+            window (Tuple[`int`], *optional*):
+                (t, h, w) extent of the neighbourhood in tokens. If None, full attention is
+                restored
+            tile (Tuple[`int`], *optional*):
+                (t, h, w) size of the query tiles, rounded down to divisors of the grid.
+                Defaults to a third of the window
+            global_layers (List[`int`], *optional*):
+                Indices of the blocks that keep full attention
+            global_steps (Tuple[`int`, `int`], *optional*):
+                Sampling steps [start, end) on which all blocks use full attention
+        """
+        global_blocks = [self.blocks[i] for i in global_layers]
+        for module in self.modules():
+            if isinstance(module, WanAttentionBlock):
+                module.self_attn.local_window = None if window is None or any(
+                    module is u for u in global_blocks) else tuple(window)
+                module.self_attn.local_tile = tile and tuple(tile)
+                module.self_attn.global_steps = global_steps and tuple(
+                    global_steps)
+
+    def set_sparse_attention(self,
+                             threshold=0.,
+                             profile_passes=4,
+                             num_samples=64):
+        r"""
+        Enables head-aware sparse self-attention in every block (including VACE blocks).
+        The first forwards at a new latent grid size compute full attention and profile
+        every head on a few sample queries. Afterwards each head only computes the
+        block-sparse pattern that approximated it best: its own frame (spatial heads), its
+        own (h, w) location across frames (temporal heads) or everything (dense heads).
+        The head patterns are kept per grid size, so later runs at the same resolution skip
+        the profiling. Local attention takes precedence if both are enabled.
+
+        Args:
+            threshold (`float`, *optional*, defaults to 0.0):
+                Largest relative error of a sparse pattern on the sample queries for a head
+                to use it, 0 disables sparse attention
+            profile_passes (`int`, *optional*, defaults to 4):
+                Number of forwards profiled per grid size. A sampling step with classifier
+                free guidance makes two unless they are batched
+            num_samples (`int`, *optional*, defaults to 64):
+                Number of sample queries per head and forward
+        """
+        sparse = dict(
+            threshold=threshold,
+            profile_passes=profile_passes,
+            num_samples=num_samples) if threshold > 0 else None
+        for module in self.modules():
+            if isinstance(module, WanAttentionBlock):
+                module.self_attn.sparse = sparse
+                module.self_attn.sparse_patterns = {}
+
+    def sparse_attention_report(self):
+        r"""
+        Returns the fraction of the attention scores skipped by sparse attention for every
+        profiled grid size, averaged over all heads of all blocks.
+        """
+        density = {}
+        for module in self.modules():
+            for grid, patterns in getattr(module, 'sparse_patterns',
+                                          {}).items():
+                if isinstance(patterns, tuple):
+                    f, h, w = grid
+                    density.setdefault(grid, []).extend(
+                        dict(dense=1., spatial=1. / f,
+                             temporal=1. / (h * w))[u] for u in patterns)
+        return {k: 1. - sum(v) / len(v) for k, v in density.items()}
+
+    def set_token_merging(self,
+                          ratio=0.,
+                          stride=(1, 2, 2),
+                          layers=None,
+                          steps=None,
+                          whole_block=False):
+        r"""
+        Enables ToMe-style token merging in the blocks: redundant tokens are merged into a
+        similar token of their local (t, h, w) cell before the self-attention and unmerged
+        after it, see `LocalTokenMerging`. The model output keeps all tokens. Blocks using
+        local or sparse attention, and batches of different grid sizes, are not merged.
+
+        Args:
+            ratio (`float`, *optional*, defaults to 0.0):
+                Fraction of the tokens to merge, 0 disables token merging
+            stride (Tuple[`int`], *optional*, defaults to (1, 2, 2)):
+                (t, h, w) size of the cells, a token can only merge within its cell
+            layers (Tuple[`int`, `int`], *optional*):
+                Blocks [start, end) that merge tokens. If None, all blocks
+            steps (Tuple[`int`, `int`], *optional*):
+                Sampling steps [start, end) that merge tokens. If None, all steps
+            whole_block (`bool`, *optional*, defaults to False):
+                Whether to also run the cross-attention and the ffn on the merged tokens,
+                unmerging at the block output
+        """
+        start, end = layers or (0, len(self.blocks))
+        for i, block in enumerate(self.blocks):
+            block.token_merging = dict(
+                ratio=ratio,
+                stride=tuple(stride),
+                steps=steps and tuple(steps),
+                whole_block=whole_block) if ratio > 0 and start <= i < end else None
+
+    def set_chunked_ffn(self, chunk_size=None):
+        r"""
+        Runs the norm, modulation, ffn and gated residual of every block (including VACE
+        blocks) on chunks of the sequence, adding the results to the block activations in
+        place. This cuts the peak activation memory of the ffn by about L / chunk_size.
+
+        Args:
+            chunk_size (`int`, *optional*):
+                Number of tokens per chunk. If None, the whole sequence at once
+        """
+        for block in self.modules():
+            if isinstance(block, WanAttentionBlock):
+                block.ffn_chunk_size = chunk_size
+
+    def compile_blocks(self, cache_dir=None, **kwargs):
+        r"""
+        Compiles the tensor computation of every block (including VACE blocks) and of the
+        head with `torch.compile`. The rope tables, the cache lookups and the host syncs stay
+        outside of the compiled functions, so all blocks share the same graphs.
+
+        Args:
+            cache_dir (`str`, *optional*):
+                Directory of the persistent inductor cache, so that restarts reuse the
+                compiled kernels. If None, the default inductor cache is used
+            kwargs:
+                Arguments of `torch.compile`, e.g. `mode` or `backend`
+        """
+        import torch._dynamo.config
+        import torch._inductor.config
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+            torch._inductor.config.fx_graph_cache = True
+        # the blocks share the graphs of one function, one per input layout
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, 64)
+        for module in self.modules():
+            if isinstance(module, (WanAttentionBlock, Head)):
+                # kept for the eager steps of `warmup`
+                module._eager_forward = module._forward
+                module._forward = torch.compile(module._forward, **kwargs)
+        self.compiled = True
+
+    @contextmanager
+    def _eager_blocks(self):
+        # runs the blocks compiled by `compile_blocks` eagerly
+        modules = [
+            u for u in self.modules() if hasattr(u, '_eager_forward')
+        ]
+        compiled = [u._forward for u in modules]
+        for u in modules:
+            u._forward = u._eager_forward
+        try:
+            yield
+        finally:
+            for u, fn in zip(modules, compiled):
+                u._forward = fn
+
+    @torch.no_grad()
+    def warmup(self, shapes, sp_size=1, batch_sizes=(1,), num_steps=2):
+        r"""
+        Runs dummy sampling steps for every latent shape, so that the graphs of compiled
+        blocks (see `compile_blocks`) are built ahead of the first request. The steps use
+        prompts of different lengths, so that the graphs generalize to any prompt length.
+        With attention autotuning (see `set_attention_backend`), eager steps with prompts
+        of every power of two length up to `text_len` first benchmark the attention
+        backends of all shapes, so that neither the requests nor the compiled graphs wait
+        for a benchmark, and the graphs are traced with the tuned backends.
+
+        Args:
+            shapes (List[Tuple[`int`]]):
+                Latent shapes [C, F, H, W] to warm up
+            sp_size (`int`, *optional*, defaults to 1):
+                Sequence parallel size, the sequence length is padded to a multiple of it
+            batch_sizes (Tuple[`int`], *optional*, defaults to (1,)):
+                Batch sizes to warm up, e.g. (1, 2) for batched classifier-free guidance
+            num_steps (`int`, *optional*, defaults to 2):
+                Number of sampling steps per shape and batch size
+        """
+        device = self.patch_embedding.weight.device
+        timesteps = torch.linspace(1000, 1, num_steps, device=device)
+        seq_lens = [
+            math.ceil(
+                math.prod(shape[1:]) / math.prod(self.patch_size) / sp_size) *
+            sp_size for shape in shapes
+        ]
+        if attention_autotuning():
+            text_lens = [
+                2**i for i in range(int(math.log2(self.text_len)) + 1)
+            ] if self.trim_text_context else [self.text_len]
+            with self._eager_blocks():
+                for shape, seq_len in zip(shapes, seq_lens):
+                    for batch_size in batch_sizes:
+                        for text_len in text_lens:
+                            with self.sampling_session(timesteps[:1]):
+                                self(
+                                    t=timesteps[:1].repeat(batch_size),
+                                    seq_len=seq_len,
+                                    step=0,
+                                    **self._warmup_inputs(
+                                        shape, batch_size, text_len, device))
+        if not self.compiled:
+            return
+        for shape, seq_len in zip(shapes, seq_lens):
+            for batch_size in batch_sizes:
+                with self.sampling_session(timesteps):
+                    for step, t in enumerate(timesteps):
+                        self(
+                            t=t.repeat(batch_size),
+                            seq_len=seq_len,
+                            step=step,
+                            **self._warmup_inputs(shape, batch_size,
+                                                  16 * (step + 1), device))
+
+    def _warmup_inputs(self, shape, batch_size, text_len, device):
+        x = torch.zeros(shape, device=device)
+        kwargs = dict(
+            x=[x] * batch_size,
+            context=[
+                torch.zeros(
+                    text_len, self.text_embedding[0].in_features, device=device)
+            ] * batch_size)
+        if self.model_type == 'i2v' or self.model_type == 'flf2v':
+            kwargs['clip_fea'] = torch.zeros(
+                batch_size * (2 if self.model_type == 'flf2v' else 1),
+                257,
+                1280,
+                device=device)
+            kwargs['y'] = [
+                torch.zeros(
+                    self.in_dim - shape[0], *shape[1:], device=device)
+            ] * batch_size
+        return kwargs
+
+    def embed_time(self, t, step=None):
+        r"""
+        Computes the time embeddings of the head (`e`) and the blocks (`e0`).
+
+        Args:
+            t (Tensor):
+                Diffusion timesteps tensor of shape [B]
+            step (`int`, *optional*):
+                Index of t in the timestep schedule of the current sampling session
+
+        Returns:
+            Tuple[Tensor, Tensor, dict]:
+                `e` with shape [B, C], `e0` with shape [B, 6, C] and the extra arguments of
+                the blocks and head. If the step is looked up in the session schedule, `e`
+                and `e0` cover the whole schedule, i.e. have shape [S, C] and [S, 6, C].
+        """
+        session = self._session
+        if step is None or session is None or session['timesteps'] is None:
+            return (*self._embed_time(t), {})
+
+        if session['time_embedding'] is None:
+            session['time_embedding'] = self._embed_time(session['timesteps'])
+        return (*session['time_embedding'],
+                dict(step=step, modulation_cache=session['modulation']))
+
+    def _embed_time(self, t):
+        with amp.autocast(dtype=torch.float32):
+            e = self.time_embedding(
+                sinusoidal_embedding_1d(self.freq_dim, t).float())
+            e0 = self.time_projection(e).unflatten(1, (6, self.dim))
+            assert e.dtype == torch.float32 and e0.dtype == torch.float32
+        return e, e0
+
+    def residual_cache(self, x, e0, branch, step=None, all_reduce=None):
+        r"""
+        Decides whether the block stack can be skipped in the current forward of a branch.
+
+        Args:
+            x (Tensor):
+                Input of the first block, shape [B, L, C]
+            e0 (Tensor):
+                Block time embeddings as returned by `embed_time`
+            branch (List[`str`]):
+                Per-sample guidance branch labels keying the cache
+            step (`int`, *optional*):
+                Index of the step in the timestep schedule of the current sampling session
+            all_reduce (`callable`, *optional*):
+                Sums a tensor over the ranks holding the other parts of the sequence
+
+        Returns:
+            `dict` or None:
+                The cache state of the branch, None if step skipping is disabled. If `skip`
+                is set, the blocks must be replaced by adding `residual` to x, otherwise
+                `residual` must be updated with the output of the blocks minus x.
+        """
+        session = self._session
+        if session is None or not session['cache_threshold'] or branch is None:
+            return None
+        state = session['residual'].setdefault(
+            tuple(branch),
+            dict(
+                previous=None,
+                accumulated=0.,
+                residual=None,
+                skip=False,
+                steps=0,
+                skipped=0))
+
+        # block input modulated like in the first block, without the block parameters
+        if step is not None and session['time_embedding'] is not None:
+            e0 = e0[step:step + 1]
+        with amp.autocast(dtype=torch.float32):
+            modulated = nn.functional.layer_norm(
+                x.float(), (self.dim,),
+                eps=self.eps) * (1 + e0[:, 1:2]) + e0[:, 0:1]
+
+        # always compute the first and the last step
+        last = step is not None and session['timesteps'] is not None and \
+            step == len(session['timesteps']) - 1
+        previous, state['previous'] = state['previous'], modulated
+        state['steps'] += 1
+        if previous is None or last:
+            state['skip'] = False
+        else:
+            distance = torch.stack([(modulated - previous).abs().sum(),
+                                    previous.abs().sum()])
+            if all_reduce is not None:
+                distance = all_reduce(distance)
+            state['accumulated'] += (distance[0] / distance[1]).item()
+            state['skip'] = state['accumulated'] < session['cache_threshold']
+
+        if state['skip']:
+            state['skipped'] += 1
+        else:
+            state['accumulated'] = 0.
+        return state
+
+    def use_varlen(self, batch_size, step_indexed=False):
+        r"""
+        Whether a forward runs on packed tokens. 3D local attention, sparse attention and
+        token merging work on the padded token grid, and a batch of several samples can only
+        be packed if the samples share the modulation, i.e. on steps looked up in the
+        schedule of the sampling session. Compiled blocks use the padded tokens too: the
+        maximum sample lengths of varlen attention are host integers, on which the graphs
+        would be specialized for every prompt length.
+
+        Args:
+            batch_size (`int`):
+                Number of samples
+            step_indexed (`bool`, *optional*, defaults to False):
+                Whether the time embeddings are looked up by step, see `embed_time`
+        """
+        return self.varlen and not self.compiled and (
+            batch_size == 1 or step_indexed) and not any(
+            block.self_attn.local_window is not None or
+            block.self_attn.sparse is not None or
+            block.token_merging is not None
+            for block in self.modules()
+            if isinstance(block, WanAttentionBlock))
+
+    def varlen_args(self,
+                    seq_lens,
+                    context_lens=None,
+                    num_tokens=None,
+                    offset=0,
+                    chunk_len=None):
+        r"""
+        Sample boundaries of tokens packed into one sequence, the `varlen` block argument.
+
+        Args:
+            seq_lens (Tensor):
+                Number of tokens of each sample, shape [B]
+            context_lens (Tensor, *optional*):
+                Number of text context tokens of each sample, shape [B]. If None, each
+                sample has `text_len` tokens
+            num_tokens (`int`, *optional*):
+                Length of the packed sequence. The tokens after the samples (e.g. padding to
+                a multiple of the sequence parallel size) attend to each other only.
+                Defaults to sum(seq_lens)
+            offset (`int`, *optional*, defaults to 0):
+                Index of the first token held by this rank in sequence parallel runs
+            chunk_len (`int`, *optional*):
+                Number of tokens held by this rank. Defaults to num_tokens
+
+        Returns:
+            `dict`:
+                int32 cumulative lengths on the model device and maximum lengths of the
+                self-attention samples (`cu_seqlens`, `max_seqlen`), of the samples of the
+                local queries of the cross-attention (`cu_seqlens_q`, `max_seqlen_q`, the
+                padding joins the last sample) and of the text context (`cu_seqlens_k`,
+                `max_seqlen_k`)
+        """
+        device = self.patch_embedding.weight.device
+
+        def cumulative(lens):
+            cu = [0]
+            for u in lens:
+                cu.append(cu[-1] + u)
+            return cu
+
+        lens = seq_lens.tolist()
+        bounds = cumulative(lens)
+        num_tokens = num_tokens or bounds[-1]
+        chunk_len = chunk_len or num_tokens
+        if num_tokens > bounds[-1]:
+            lens = lens + [num_tokens - bounds[-1]]
+        local = [min(max(u - offset, 0), chunk_len) for u in bounds[:-1]]
+        local.append(chunk_len)
+        context_lens = [self.text_len] * len(seq_lens) \
+            if context_lens is None else context_lens.tolist()
+
+        def to_device(cu):
+            return torch.tensor(
+                cu, dtype=torch.int32).to(
+                    device, non_blocking=True)
+
+        return dict(
+            cu_seqlens=to_device(cumulative(lens)),
+            max_seqlen=max(lens),
+            cu_seqlens_q=to_device(local),
+            max_seqlen_q=max(v - u for u, v in zip(local, local[1:])),
+            cu_seqlens_k=to_device(cumulative(context_lens)),
+            max_seqlen_k=max(context_lens))
+
+    def prepare_context(self, context, clip_fea=None, branch=None):
+        r"""
+        Embeds the text (and CLIP image) context, or looks up the cached cross-attention
+        keys/values of the current sampling session.
+
+        Args:
+            context (List[Tensor]):
+                List of text embeddings each with shape [L, C]
+            clip_fea (Tensor, *optional*):
+                CLIP image features for image-to-video mode or first-last-frame-to-video mode
+            branch (List[`str`], *optional*):
+                Per-sample guidance branch labels (e.g. 'cond', 'uncond') keying the cache
+
+        Returns:
+            `dict`:
+                The `context`, `context_lens` and `cross_attn_cache` block arguments
+        """
+        cache = None
+        if self._session is not None and branch is not None:
+            cache = self._session['cross_attn'].setdefault(tuple(branch), {})
+            if cache:
+                return dict(
+                    context=None,
+                    context_lens=cache['context_lens'],
+                    cross_attn_cache=cache)
+
+        # context
+        if self.trim_text_context:
+            # embed the real tokens only, pad to the longest prompt in batch
+            context_lens = torch.tensor([u.size(0) for u in context],
+                                        dtype=torch.long)
+            context = self.text_embedding(torch.cat(context)).split(
+                context_lens.tolist())
+            max_len = int(context_lens.max())
+            context = torch.stack([
+                torch.cat([u, u.new_zeros(max_len - u.size(0), u.size(1))])
+                for u in context
+            ])
+        else:
+            context_lens = None
+            context = self.text_embedding(
+                torch.stack([
+                    torch.cat(
+                        [u, u.new_zeros(self.text_len - u.size(0), u.size(1))])
+                    for u in context
+                ]))
+
+        if clip_fea is not None:
+            context_clip = self.img_emb(clip_fea)  # bs x 257 (x2) x dim
+            context = torch.concat([context_clip, context], dim=1)
+        if cache is not None:
+            cache['context_lens'] = context_lens
+        return dict(
+            context=context, context_lens=context_lens, cross_attn_cache=cache)
 
     def forward(
         self,
@@ -498,6 +1614,8 @@ class WanModel(ModelMixin, ConfigMixin):
         seq_len,
         clip_fea=None,
         y=None,
+        branch=None,
+        step=None,
     ):
         r"""
         Forward pass through the diffusion model
@@ -515,6 +1633,10 @@ class WanModel(ModelMixin, ConfigMixin):
                 CLIP image features for image-to-video mode or first-last-frame-to-video mode
             y (List[Tensor], *optional*):
                 Conditional video inputs for image-to-video mode, same shape as x
+            branch (List[`str`], *optional*):
+                Per-sample guidance branch labels, used to key the caches of `sampling_session`
+            step (`int`, *optional*):
+                Index of t in the timestep schedule of the current `sampling_session`
 
         Returns:
             List[Tensor]:
@@ -530,37 +1652,24 @@ class WanModel(ModelMixin, ConfigMixin):
         if y is not None:
             x = [torch.cat([u, v], dim=0) for u, v in zip(x, y)]
 
-        # embeddings
+        # time embeddings
+        e, e0, time_kwargs = self.embed_time(t, step)
+        varlen = self.use_varlen(len(x), bool(time_kwargs))
+
+        # embeddings, packed or padded to seq_len
         x = [self.patch_embedding(u.unsqueeze(0)) for u in x]
         grid_sizes = torch.stack(
             [torch.tensor(u.shape[2:], dtype=torch.long) for u in x])
         x = [u.flatten(2).transpose(1, 2) for u in x]
         seq_lens = torch.tensor([u.size(1) for u in x], dtype=torch.long)
         assert seq_lens.max() <= seq_len
-        x = torch.cat([
-            torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
-                      dim=1) for u in x
-        ])
-
-        # time embeddings
-        with amp.autocast(dtype=torch.float32):
-            e = self.time_embedding(
-                sinusoidal_embedding_1d(self.freq_dim, t).float())
-            e0 = self.time_projection(e).unflatten(1, (6, self.dim))
-            assert e.dtype == torch.float32 and e0.dtype == torch.float32
-
-        # context
-        context_lens = None
-        context = self.text_embedding(
-            torch.stack([
-                torch.cat(
-                    [u, u.new_zeros(self.text_len - u.size(0), u.size(1))])
-                for u in context
-            ]))
-
-        if clip_fea is not None:
-            context_clip = self.img_emb(clip_fea)  # bs x 257 (x2) x dim
-            context = torch.concat([context_clip, context], dim=1)
+        if varlen:
+            x = torch.cat(x, dim=1)
+        else:
+            x = torch.cat([
+                torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
+                          dim=1) for u in x
+            ])
 
         # arguments
         kwargs = dict(
@@ -568,16 +1677,29 @@ class WanModel(ModelMixin, ConfigMixin):
             seq_lens=seq_lens,
             grid_sizes=grid_sizes,
             freqs=self.freqs,
-            context=context,
-            context_lens=context_lens)
-
-        for block in self.blocks:
-            x = block(x, **kwargs)
+            rope=rope_cos_sin(
+                self.freqs, grid_sizes, x.size(1), packed=varlen),
+            **time_kwargs,
+            **self.prepare_context(context, clip_fea, branch))
+        kwargs['varlen'] = self.varlen_args(
+            seq_lens, kwargs['context_lens']) if varlen else None
+
+        cache = self.residual_cache(x, e0, branch, step)
+        if cache is not None and cache['skip']:
+            x = x + cache['residual']
+        else:
+            x_in = x
+            for block in self.blocks:
+                x = block(x, **kwargs)
+            if cache is not None:
+                cache['residual'] = x - x_in
 
         # head
-        x = self.head(x, e)
+        x = self.head(x, e, **time_kwargs)
 
         # unpatchify
+        if varlen:
+            x = x[0].split(seq_lens.tolist())
         x = self.unpatchify(x, grid_sizes)
         return [u.float() for u in x]
 
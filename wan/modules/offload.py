@@ -0,0 +1,208 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+from functools import partial
+
+import torch
+
+__all__ = ['BlockOffloader', 'offload_blocks', 'encoder_offload']
+
+
+def _tensors(module):
+    # (store, name) of every parameter and buffer of module and its submodules
+    for m in module.modules():
+        for store in (m._parameters, m._buffers):
+            for name, t in store.items():
+                if t is not None:
+                    yield store, name
+
+
+def _assign(store, name, tensor):
+    if isinstance(store[name], torch.nn.Parameter):
+        store[name].data = tensor
+    else:
+        store[name] = tensor
+
+
+def _nbytes(module):
+    return sum(store[name].numel() * store[name].element_size()
+               for store, name in _tensors(module))
+
+
+class BlockOffloader:
+    r"""
+    Streams the weights of a sequence of blocks from host memory to the device, one block at
+    a time. The weights of the offloaded blocks live in pinned host memory. When a block starts,
+    the next `prefetch` offloaded blocks are copied on a side stream, so the copies overlap
+    with the computation. When it ends, its device copy is dropped. The first `num_resident`
+    blocks stay on the device.
+
+    Blocks are expected to run in the given order, repeatedly (e.g. once per sampling step).
+    Blocks running out of order are still correct, they are just loaded without overlap.
+
+    Args:
+        blocks (List[`nn.Module`]):
+            Blocks in execution order
+        device (`torch.device`):
+            Device the blocks run on
+        num_resident (`int`, *optional*, defaults to 0):
+            Number of blocks kept on the device
+        memory_budget (`float`, *optional*):
+            Device memory in GiB for the block weights, including the prefetched ones.
+            Overrides `num_resident` with as many resident blocks as fit
+        prefetch (`int`, *optional*, defaults to 1):
+            Number of blocks copied ahead of the running one
+        pin_memory (`bool`, *optional*, defaults to True):
+            Pin the host copies, required for asynchronous copies. Only used on cuda devices
+    """
+
+    def __init__(self,
+                 blocks,
+                 device,
+                 num_resident=0,
+                 memory_budget=None,
+                 prefetch=1,
+                 pin_memory=True):
+        self.blocks = list(blocks)
+        self.device = torch.device(device)
+        self.prefetch = prefetch
+        self.stream = torch.cuda.Stream(
+            self.device) if self.device.type == 'cuda' else None
+        if memory_budget is not None:
+            size = max(_nbytes(block) for block in self.blocks)
+            num_resident = int(memory_budget * 2**30 // size) - 1 - prefetch
+        self.num_resident = min(max(num_resident, 0), len(self.blocks))
+
+        self.host = []
+        self.events = {}
+        self.hooks = []
+        for i, block in enumerate(self.blocks):
+            if i < self.num_resident:
+                block.to(self.device)
+                self.host.append(None)
+                continue
+            host = []
+            for store, name in _tensors(block):
+                t = store[name].detach().cpu()
+                if pin_memory and self.stream is not None:
+                    t = t.pin_memory()
+                _assign(store, name, t)
+                host.append((store, name, t))
+            self.host.append(host)
+            self.hooks += [
+                block.register_forward_pre_hook(partial(self._pre_hook, i)),
+                block.register_forward_hook(partial(self._post_hook, i))
+            ]
+
+    def _next(self, i):
+        # the offloaded blocks following block i, cyclically
+        n = len(self.blocks) - self.num_resident
+        return [
+            self.num_resident + (i - self.num_resident + k) % n
+            for k in range(1, min(self.prefetch, n - 1) + 1)
+        ]
+
+    def load(self, i):
+        r"""
+        Starts copying the weights of block i to the device, unless they are already there.
+        """
+        if self.host[i] is None or i in self.events:
+            return
+        if self.stream is None:
+            for store, name, t in self.host[i]:
+                _assign(store, name, t.to(self.device))
+            self.events[i] = None
+            return
+        compute_stream = torch.cuda.current_stream(self.device)
+        with torch.cuda.stream(self.stream):
+            for store, name, t in self.host[i]:
+                u = t.to(self.device, non_blocking=True)
+                # the memory is only reused once the computation on it is done
+                u.record_stream(compute_stream)
+                _assign(store, name, u)
+            self.events[i] = torch.cuda.Event()
+            self.events[i].record(self.stream)
+
+    def release(self, i):
+        r"""
+        Drops the device copy of the weights of block i.
+        """
+        if self.host[i] is None or i not in self.events:
+            return
+        for store, name, t in self.host[i]:
+            _assign(store, name, t)
+        del self.events[i]
+
+    def _pre_hook(self, i, module, args):
+        self.load(i)
+        if self.events[i] is not None:
+            torch.cuda.current_stream(self.device).wait_event(self.events[i])
+        for j in self._next(i):
+            self.load(j)
+
+    def _post_hook(self, i, module, args, output):
+        self.release(i)
+
+    def remove(self):
+        r"""
+        Removes the hooks, the offloaded blocks are left in host memory.
+        """
+        for hook in self.hooks:
+            hook.remove()
+        for i in list(self.events):
+            self.release(i)
+        self.hooks = []
+
+
+def offload_blocks(module, blocks, device, unused=(), **kwargs):
+    r"""
+    Moves module to the device except for the given blocks, whose weights are streamed by a
+    `BlockOffloader`.
+
+    Args:
+        module (`nn.Module`):
+            Model containing the blocks
+        blocks (List[`nn.Module`]):
+            Blocks of module in execution order
+        device (`torch.device`):
+            Device the model runs on
+        unused (List[`nn.Module`], *optional*):
+            Blocks of module that are never run, left in host memory
+        kwargs:
+            Arguments of `BlockOffloader`
+
+    Returns:
+        `BlockOffloader`:
+            The offloader of the blocks
+    """
+    offloader = BlockOffloader(blocks, device, **kwargs)
+    streamed = {
+        id(m) for block in list(blocks) + list(unused) for m in block.modules()
+    }
+    for m in module.modules():
+        if id(m) in streamed:
+            continue
+        for store in (m._parameters, m._buffers):
+            for name, t in store.items():
+                if t is not None:
+                    _assign(store, name, t.to(device))
+    return offloader
+
+
+def encoder_offload(block_offload):
+    r"""
+    Arguments of the `BlockOffloader` of a text or image encoder. The number of resident blocks
+    and the memory budget of the block offload options size the DiT, which runs at every
+    sampling step, so the encoders, run once per prompt, stream all their blocks.
+
+    Args:
+        block_offload (`dict`):
+            Arguments of the `BlockOffloader` of the DiT
+
+    Returns:
+        `dict`:
+            Arguments of `BlockOffloader`
+    """
+    return {
+        k: v
+        for k, v in block_offload.items()
+        if k not in ('num_resident', 'memory_budget')
+    }
@@ -0,0 +1,192 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+__all__ = ['QuantLinear', 'quantize_linears']
+
+
+def quantize_weight(weight, bits=8, group_size=128):
+    r"""
+    Symmetric weight-only quantization of a [out, in] weight.
+
+    Args:
+        weight (Tensor):
+            Weight of a linear layer
+        bits (`int`, *optional*, defaults to 8):
+            8 for per output channel int8, 4 for group-wise int4
+        group_size (`int`, *optional*, defaults to 128):
+            Number of input channels sharing an int4 scale
+
+    Returns:
+        Tuple[Tensor, Tensor]:
+            The int8 weight (int4 values are offset by 8 and packed in pairs into uint8) and
+            the scales of shape [out, in / group_size], in the dtype of the weight
+    """
+    out_features, in_features = weight.shape
+    group_size = in_features if bits == 8 else group_size
+    qmax = 2**(bits - 1) - 1
+    w = weight.float().view(out_features, in_features // group_size,
+                            group_size)
+    scale = w.abs().amax(-1).clamp(min=1e-8) / qmax
+    q = (w / scale.unsqueeze(-1)).round().clamp(-qmax - 1, qmax)
+    q = q.view(out_features, in_features)
+    if bits == 8:
+        q = q.to(torch.int8)
+    else:
+        q = (q + 8).to(torch.uint8)
+        q = q[:, 0::2] | (q[:, 1::2] << 4)
+    return q, scale.to(weight.dtype)
+
+
+class QuantLinear(nn.Module):
+    r"""
+    Linear layer with an int8 (per output channel) or int4 (group-wise) weight, dequantized
+    on the fly in plain torch, so it runs on any device.
+
+    Args:
+        in_features (`int`):
+            Input channels
+        out_features (`int`):
+            Output channels
+        bias (`bool`, *optional*, defaults to True):
+            Whether the layer has a bias
+        bits (`int`, *optional*, defaults to 8):
+            Weight bits, 8 or 4
+        group_size (`int`, *optional*, defaults to 128):
+            Number of input channels sharing a scale in int4 mode
+        dtype (`torch.dtype`, *optional*, defaults to torch.bfloat16):
+            Dtype of the scales and the bias
+    """
+
+    def __init__(self,
+                 in_features,
+                 out_features,
+                 bias=True,
+                 bits=8,
+                 group_size=128,
+                 dtype=torch.bfloat16,
+                 device=None):
+        assert bits in (4, 8), f'Unsupported weight bits {bits}.'
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = in_features if bits == 8 else group_size
+        assert in_features % self.group_size == 0 and self.group_size % 2 == 0
+
+        self.register_buffer(
+            'qweight',
+            torch.zeros(
+                out_features,
+                in_features if bits == 8 else in_features // 2,
+                dtype=torch.int8 if bits == 8 else torch.uint8,
+                device=device))
+        self.register_buffer(
+            'scale',
+            torch.ones(
+                out_features,
+                in_features // self.group_size,
+                dtype=dtype,
+                device=device))
+        if bias:
+            self.bias = nn.Parameter(
+                torch.zeros(out_features, dtype=dtype, device=device))
+        else:
+            self.register_parameter('bias', None)
+
+    @classmethod
+    def from_linear(cls, linear, bits=8, group_size=128):
+        r"""
+        Quantizes the weight of an `nn.Linear`.
+        """
+        layer = cls(
+            linear.in_features,
+            linear.out_features,
+            bias=linear.bias is not None,
+            bits=bits,
+            group_size=group_size,
+            dtype=linear.weight.dtype,
+            device=linear.weight.device)
+        layer.qweight, layer.scale = quantize_weight(linear.weight.data, bits,
+                                                     group_size)
+        if linear.bias is not None:
+            layer.bias.data.copy_(linear.bias.data)
+        layer.requires_grad_(linear.weight.requires_grad)
+        return layer
+
+    @classmethod
+    def cat(cls, layers):
+        r"""
+        Stacks layers reading the same input along the output channels, e.g. to fuse q/k/v.
+        """
+        u = layers[0]
+        layer = cls(
+            u.in_features,
+            sum(v.out_features for v in layers),
+            bias=u.bias is not None,
+            bits=u.bits,
+            group_size=u.group_size,
+            dtype=u.scale.dtype,
+            device=torch.device('meta'))
+        layer.qweight = torch.cat([v.qweight for v in layers])
+        layer.scale = torch.cat([v.scale for v in layers])
+        if u.bias is not None:
+            layer.bias = nn.Parameter(
+                torch.cat([v.bias for v in layers]),
+                requires_grad=u.bias.requires_grad)
+        return layer
+
+    def dequantize(self, dtype=None):
+        r"""
+        Returns the [out, in] weight in the given dtype (the dtype of the scales by default).
+        """
+        dtype = dtype or self.scale.dtype
+        q = self.qweight
+        if self.bits == 4:
+            q = torch.stack([q & 15, q >> 4], dim=-1).flatten(1).to(dtype) - 8
+        w = q.to(dtype).view(self.out_features, -1, self.group_size)
+        return (w * self.scale.to(dtype).unsqueeze(-1)).flatten(1)
+
+    def forward(self, x):
+        bias = None if self.bias is None else self.bias.to(x.dtype)
+        return F.linear(x, self.dequantize(x.dtype), bias)
+
+    def extra_repr(self):
+        return (f'in_features={self.in_features}, '
+                f'out_features={self.out_features}, '
+                f'bias={self.bias is not None}, bits={self.bits}, '
+                f'group_size={self.group_size}')
+
+
+def quantize_linears(module, bits=8, group_size=128, convert=True):
+    r"""
+    Replaces every `nn.Linear` in module by a `QuantLinear`.
+
+    Args:
+        module (`nn.Module`):
+            Module whose linear layers are replaced, in place
+        bits (`int`, *optional*, defaults to 8):
+            Weight bits, 8 or 4
+        group_size (`int`, *optional*, defaults to 128):
+            Number of input channels sharing a scale in int4 mode
+        convert (`bool`, *optional*, defaults to True):
+            Whether to quantize the current weights. Otherwise the layers are left empty,
+            e.g. to load a quantized state dict
+    """
+    for name, child in list(module.named_modules()):
+        for child_name, layer in list(child.named_children()):
+            if not isinstance(layer, nn.Linear):
+                continue
+            if convert:
+                layer = QuantLinear.from_linear(layer, bits, group_size)
+            else:
+                layer = QuantLinear(
+                    layer.in_features,
+                    layer.out_features,
+                    bias=layer.bias is not None,
+                    bits=bits,
+                    group_size=group_size,
+                    dtype=layer.weight.dtype,
+                    device=layer.weight.device)
+            setattr(child, child_name, layer)
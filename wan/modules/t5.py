@@ -1,12 +1,12 @@
 # Modified from transformers.models.t5.modeling_t5
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
-import logging
 import math
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .checkpoint import load_weights
 from .tokenizers import HuggingfaceTokenizer
 
 __all__ = [
@@ -475,26 +475,27 @@ class T5EncoderModel:
         self,
         text_len,
         dtype=torch.bfloat16,
-        device=torch.cuda.current_device(),
+        device=None,
         checkpoint_path=None,
         tokenizer_path=None,
         shard_fn=None,
     ):
+        # resolved here rather than at import, so the package imports without CUDA
+        if device is None:
+            device = torch.cuda.current_device()
         self.text_len = text_len
         self.dtype = dtype
         self.device = device
         self.checkpoint_path = checkpoint_path
         self.tokenizer_path = tokenizer_path
 
-        # init model
+        # init model on the meta device, the weights are loaded memory-mapped
         model = umt5_xxl(
             encoder_only=True,
             return_tokenizer=False,
             dtype=dtype,
-            device=device).eval().requires_grad_(False)
-        logging.info(f'loading {checkpoint_path}')
-        model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
-        self.model = model
+            device='meta').eval().requires_grad_(False)
+        self.model = load_weights(model, checkpoint_path, device, dtype)
         if shard_fn is not None:
             self.model = shard_fn(self.model, sync_module_states=False)
         else:
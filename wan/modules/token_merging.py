@@ -0,0 +1,120 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+__all__ = ['LocalTokenMerging', 'merge_candidates']
+
+# maximum number of grid layouts whose merge candidates are kept
+CANDIDATES_CACHE_SIZE = 16
+_CANDIDATES_CACHE = OrderedDict()
+
+
+def merge_candidates(grid, stride=(1, 2, 2), device=None):
+    r"""
+    Candidate merges of `LocalTokenMerging` on the (F, H, W) token grid. They only depend
+    on the grid and the stride, so they are built on the host, without the data-dependent
+    shapes of a mask selection, and cached per layout.
+
+    Args:
+        grid (Tuple[`int`]):
+            (F, H, W) of the token grid
+        stride (Tuple[`int`], *optional*, defaults to (1, 2, 2)):
+            (t, h, w) size of the cells
+        device (`torch.device`, *optional*):
+            Device of the returned indices
+
+    Returns:
+        Tuple[Tensor, Tensor]:
+            The source tokens, i.e. all grid tokens except the first of each cell, and the
+            destination token of the cell of every grid token
+    """
+    key = (tuple(grid), tuple(stride), torch.device(device or 'cpu'))
+    if key in _CANDIDATES_CACHE:
+        _CANDIDATES_CACHE.move_to_end(key)
+        return _CANDIDATES_CACHE[key]
+
+    f, h, w = grid
+    fi, hi, wi = [
+        torch.arange(u).div(s, rounding_mode='floor') * s
+        for u, s in zip(grid, stride)
+    ]
+    dst = (fi.view(-1, 1, 1) * h * w + hi.view(1, -1, 1) * w +
+           wi.view(1, 1, -1)).flatten()
+    src = (dst != torch.arange(f * h * w)).nonzero().squeeze(1)
+
+    _CANDIDATES_CACHE[key] = (src.to(key[-1]), dst.to(key[-1]))
+    if len(_CANDIDATES_CACHE) > CANDIDATES_CACHE_SIZE:
+        _CANDIDATES_CACHE.popitem(last=False)
+    return _CANDIDATES_CACHE[key]
+
+
+class LocalTokenMerging:
+    r"""
+    ToMe-style token merging by local bipartite matching on the (F, H, W) token grid.
+
+    The grid is split into cells of `stride` tokens. The first token of each cell is a
+    destination, all others are sources that may only merge into the destination of their
+    own cell. The `ratio * F * H * W` sources most similar (cosine similarity of `metric`)
+    to their destination are merged into it. Padding tokens after the grid are kept.
+
+    Args:
+        metric (Tensor):
+            Token features of shape [B, L, C] used to measure the similarity
+        ratio (`float`):
+            Fraction of the grid tokens to merge, at most the fraction of source tokens
+        candidates (Tuple[Tensor, Tensor]):
+            Source and destination tokens of the grid of all samples, see
+            `merge_candidates`
+    """
+
+    def __init__(self, metric, ratio, candidates):
+        b, l, device = metric.size(0), metric.size(1), metric.device
+        src, dst = candidates
+        n = dst.numel()
+        self.num_merged = r = min(int(ratio * n), src.numel())
+
+        # merge the most similar sources
+        metric = F.normalize(metric[:, :n].float(), dim=-1)
+        similarity = (metric[:, src] * metric[:, dst[src]]).sum(-1)
+        self.src = src[similarity.topk(r, dim=-1).indices]
+        self.dst = dst[self.src]
+
+        # kept tokens in order, and the index of every token's representative among them
+        keep = torch.ones(b, l, dtype=torch.bool, device=device)
+        keep.scatter_(1, self.src, False)
+        self.kept = torch.argsort((~keep).byte(), dim=1, stable=True)[:, :l - r]
+        target = torch.arange(l, device=device).repeat(b, 1)
+        target.scatter_(1, self.src, self.dst)
+        self.source = (keep.cumsum(1) - 1).gather(1, target)
+
+    @staticmethod
+    def _index(index, x):
+        return index.view(*index.shape,
+                          *[1] * (x.dim() - 2)).expand(-1, -1, *x.shape[2:])
+
+    def merge(self, x):
+        r"""
+        Averages the merged sources into their destinations, [B, L, ...] -> [B, L - r, ...].
+        """
+        x = x.scatter_reduce(
+            1,
+            self._index(self.dst, x),
+            x.gather(1, self._index(self.src, x)),
+            reduce='mean',
+            include_self=True)
+        return self.gather(x)
+
+    def gather(self, x):
+        r"""
+        Drops the merged sources without averaging, e.g. for per-token tables.
+        """
+        return x.gather(1, self._index(self.kept, x))
+
+    def unmerge(self, x):
+        r"""
+        Copies the outputs of the destinations to their merged sources,
+        [B, L - r, ...] -> [B, L, ...].
+        """
+        return x.gather(1, self._index(self.source, x))
@@ -1,10 +1,9 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import torch
-import torch.cuda.amp as amp
 import torch.nn as nn
 from diffusers.configuration_utils import register_to_config
 
-from .model import WanAttentionBlock, WanModel, sinusoidal_embedding_1d
+from .model import WanAttentionBlock, WanModel, rope_cos_sin
 
 
 class VaceWanAttentionBlock(WanAttentionBlock):
@@ -82,10 +81,27 @@ class VaceWanModel(WanModel):
                  window_size=(-1, -1),
                  qk_norm=True,
                  cross_attn_norm=True,
-                 eps=1e-6):
-        super().__init__(model_type, patch_size, text_len, in_dim, dim, ffn_dim,
-                         freq_dim, text_dim, out_dim, num_heads, num_layers,
-                         window_size, qk_norm, cross_attn_norm, eps)
+                 eps=1e-6,
+                 quantization=None):
+        # keyword arguments, positional ones are misaligned with the registered config
+        # since `ignore_for_config` drops some of the parameters
+        super().__init__(
+            model_type=model_type,
+            patch_size=patch_size,
+            text_len=text_len,
+            in_dim=in_dim,
+            dim=dim,
+            ffn_dim=ffn_dim,
+            freq_dim=freq_dim,
+            text_dim=text_dim,
+            out_dim=out_dim,
+            num_heads=num_heads,
+            num_layers=num_layers,
+            window_size=window_size,
+            qk_norm=qk_norm,
+            cross_attn_norm=cross_attn_norm,
+            eps=eps,
+            quantization=quantization)
 
         self.vace_layers = [i for i in range(0, self.num_layers, 2)
                            ] if vace_layers is None else vace_layers
@@ -133,14 +149,28 @@ class VaceWanModel(WanModel):
             kernel_size=self.patch_size,
             stride=self.patch_size)
 
+        # the blocks are rebuilt above, quantize them again
+        if quantization is not None:
+            self._quantize_blocks(convert=False, **quantization)
+
+    def _warmup_inputs(self, shape, batch_size, text_len, device):
+        kwargs = super()._warmup_inputs(shape, batch_size, text_len, device)
+        kwargs['vace_context'] = [
+            torch.zeros(self.vace_in_dim, *shape[1:], device=device)
+        ] * batch_size
+        return kwargs
+
     def forward_vace(self, x, vace_context, seq_len, kwargs):
         # embeddings
         c = [self.vace_patch_embedding(u.unsqueeze(0)) for u in vace_context]
         c = [u.flatten(2).transpose(1, 2) for u in c]
-        c = torch.cat([
-            torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
-                      dim=1) for u in c
-        ])
+        if kwargs['varlen'] is not None:
+            c = torch.cat(c, dim=1)
+        else:
+            c = torch.cat([
+                torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
+                          dim=1) for u in c
+            ])
 
         # arguments
         new_kwargs = dict(x=x)
@@ -162,6 +192,8 @@ class VaceWanModel(WanModel):
         vace_context_scale=1.0,
         clip_fea=None,
         y=None,
+        branch=None,
+        step=None,
     ):
         r"""
         Forward pass through the diffusion model
@@ -179,6 +211,10 @@ class VaceWanModel(WanModel):
                 CLIP image features for image-to-video mode
             y (List[Tensor], *optional*):
                 Conditional video inputs for image-to-video mode, same shape as x
+            branch (List[`str`], *optional*):
+                Per-sample guidance branch labels, used to key the caches of `sampling_session`
+            step (`int`, *optional*):
+                Index of t in the timestep schedule of the current `sampling_session`
 
         Returns:
             List[Tensor]:
@@ -194,37 +230,24 @@ class VaceWanModel(WanModel):
         # if y is not None:
         #     x = [torch.cat([u, v], dim=0) for u, v in zip(x, y)]
 
-        # embeddings
+        # time embeddings
+        e, e0, time_kwargs = self.embed_time(t, step)
+        varlen = self.use_varlen(len(x), bool(time_kwargs))
+
+        # embeddings, packed or padded to seq_len
         x = [self.patch_embedding(u.unsqueeze(0)) for u in x]
         grid_sizes = torch.stack(
             [torch.tensor(u.shape[2:], dtype=torch.long) for u in x])
         x = [u.flatten(2).transpose(1, 2) for u in x]
         seq_lens = torch.tensor([u.size(1) for u in x], dtype=torch.long)
         assert seq_lens.max() <= seq_len
-        x = torch.cat([
-            torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
-                      dim=1) for u in x
-        ])
-
-        # time embeddings
-        with amp.autocast(dtype=torch.float32):
-            e = self.time_embedding(
-                sinusoidal_embedding_1d(self.freq_dim, t).float())
-            e0 = self.time_projection(e).unflatten(1, (6, self.dim))
-            assert e.dtype == torch.float32 and e0.dtype == torch.float32
-
-        # context
-        context_lens = None
-        context = self.text_embedding(
-            torch.stack([
-                torch.cat(
-                    [u, u.new_zeros(self.text_len - u.size(0), u.size(1))])
-                for u in context
-            ]))
-
-        # if clip_fea is not None:
-        #     context_clip = self.img_emb(clip_fea)  # bs x 257 x dim
-        #     context = torch.concat([context_clip, context], dim=1)
+        if varlen:
+            x = torch.cat(x, dim=1)
+        else:
+            x = torch.cat([
+                torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
+                          dim=1) for u in x
+            ])
 
         # arguments
         kwargs = dict(
@@ -232,19 +255,32 @@ class VaceWanModel(WanModel):
             seq_lens=seq_lens,
             grid_sizes=grid_sizes,
             freqs=self.freqs,
-            context=context,
-            context_lens=context_lens)
-
-        hints = self.forward_vace(x, vace_context, seq_len, kwargs)
-        kwargs['hints'] = hints
-        kwargs['context_scale'] = vace_context_scale
-
-        for block in self.blocks:
-            x = block(x, **kwargs)
+            rope=rope_cos_sin(
+                self.freqs, grid_sizes, x.size(1), packed=varlen),
+            **time_kwargs,
+            **self.prepare_context(context, branch=branch))
+        kwargs['varlen'] = self.varlen_args(
+            seq_lens, kwargs['context_lens']) if varlen else None
+
+        cache = self.residual_cache(x, e0, branch, step)
+        if cache is not None and cache['skip']:
+            x = x + cache['residual']
+        else:
+            hints = self.forward_vace(x, vace_context, seq_len, kwargs)
+            kwargs['hints'] = hints
+            kwargs['context_scale'] = vace_context_scale
+
+            x_in = x
+            for block in self.blocks:
+                x = block(x, **kwargs)
+            if cache is not None:
+                cache['residual'] = x - x_in
 
         # head
-        x = self.head(x, e)
+        x = self.head(x, e, **time_kwargs)
 
         # unpatchify
+        if varlen:
+            x = x[0].split(seq_lens.tolist())
         x = self.unpatchify(x, grid_sizes)
         return [u.float() for u in x]
@@ -1,5 +1,5 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
-import logging
+import itertools
 
 import torch
 import torch.cuda.amp as amp
@@ -7,6 +7,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
 
+from .checkpoint import load_weights
+
 __all__ = [
     'WanVAE',
 ]
@@ -36,6 +38,85 @@ class CausalConv3d(nn.Conv3d):
         return super().forward(x)
 
 
+class CausalCache:
+    r"""
+    Causal feature cache of the `CausalConv3d` layers of an encoder or decoder, which run
+    chunk by chunk along time: the last CACHE_T input frames of every layer, kept in a
+    ring buffer per layer. The buffers are allocated on the first chunk and overwritten in
+    place afterwards, and `reset` only rewinds them, so a cache kept across calls of the
+    same resolution allocates nothing.
+
+    Args:
+        num_layers (`int`):
+            Number of cached layers, see `count_conv3d`
+    """
+
+    def __init__(self, num_layers):
+        self.buffers = [None] * num_layers
+        self.reset()
+
+    def reset(self):
+        num_layers = len(self.buffers)
+        # ring position of the oldest frame and number of cached frames per layer
+        self.start = [0] * num_layers
+        self.count = [0] * num_layers
+
+    def empty(self, idx):
+        return self.count[idx] == 0
+
+    def _buffer(self, idx, x):
+        buf = self.buffers[idx]
+        shape = x.shape[:2] + (CACHE_T,) + x.shape[3:]
+        if buf is None or buf.shape != shape or buf.dtype != x.dtype or \
+                buf.device != x.device:
+            buf = self.buffers[idx] = x.new_empty(shape)
+        return buf
+
+    def read(self, idx, frames=CACHE_T):
+        r"""
+        The last (up to) `frames` cached frames of layer idx in time order, None if empty.
+        The result may be a view of the ring buffer, which the next `write` overwrites.
+        """
+        n = min(self.count[idx], frames)
+        if n == 0:
+            return None
+        buf = self.buffers[idx]
+        first = (self.start[idx] + self.count[idx] - n) % CACHE_T
+        if first + n <= CACHE_T:
+            return buf[:, :, first:first + n]
+        return torch.cat(
+            [buf[:, :, first:], buf[:, :, :first + n - CACHE_T]], dim=2)
+
+    def write(self, idx, x):
+        r"""
+        Appends the frames of x to the cache of layer idx, keeping the last CACHE_T.
+        """
+        buf = self._buffer(idx, x)
+        for u in x[:, :, -CACHE_T:].unbind(2):
+            buf[:, :, (self.start[idx] + self.count[idx]) % CACHE_T].copy_(u)
+            if self.count[idx] < CACHE_T:
+                self.count[idx] += 1
+            else:
+                self.start[idx] = (self.start[idx] + 1) % CACHE_T
+
+    def zero(self, idx, x):
+        r"""
+        Fills the cache of layer idx with CACHE_T zero frames shaped like those of x.
+        """
+        self._buffer(idx, x).zero_()
+        self.start[idx], self.count[idx] = 0, CACHE_T
+
+    def conv(self, idx, layer, x):
+        r"""
+        Runs the causal conv layer on x continuing the cached frames, then caches x.
+        """
+        out = layer(x, self.read(idx))
+        # layers without temporal padding never read their cache
+        if layer._padding[4] > 0:
+            self.write(idx, x)
+        return out
+
+
 class RMS_norm(nn.Module):
 
     def __init__(self, dim, channel_first=True, images=True, bias=False):
@@ -103,32 +184,13 @@ class Resample(nn.Module):
         if self.mode == 'upsample3d':
             if feat_cache is not None:
                 idx = feat_idx[0]
-                if feat_cache[idx] is None:
-                    feat_cache[idx] = 'Rep'
+                if feat_cache.empty(idx):
+                    # the first frame is not upsampled in time, the next chunk sees
+                    # zeros before it
+                    feat_cache.zero(idx, x)
                     feat_idx[0] += 1
                 else:
-
-                    cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                    if cache_x.shape[2] < 2 and feat_cache[
-                            idx] is not None and feat_cache[idx] != 'Rep':
-                        # cache last frame of last two chunk
-                        cache_x = torch.cat([
-                            feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                                cache_x.device), cache_x
-                        ],
-                                            dim=2)
-                    if cache_x.shape[2] < 2 and feat_cache[
-                            idx] is not None and feat_cache[idx] == 'Rep':
-                        cache_x = torch.cat([
-                            torch.zeros_like(cache_x).to(cache_x.device),
-                            cache_x
-                        ],
-                                            dim=2)
-                    if feat_cache[idx] == 'Rep':
-                        x = self.time_conv(x)
-                    else:
-                        x = self.time_conv(x, feat_cache[idx])
-                    feat_cache[idx] = cache_x
+                    x = feat_cache.conv(idx, self.time_conv, x)
                     feat_idx[0] += 1
 
                     x = x.reshape(b, 2, c, t, h, w)
@@ -143,19 +205,14 @@ class Resample(nn.Module):
         if self.mode == 'downsample3d':
             if feat_cache is not None:
                 idx = feat_idx[0]
-                if feat_cache[idx] is None:
-                    feat_cache[idx] = x.clone()
+                if feat_cache.empty(idx):
+                    feat_cache.write(idx, x)
                     feat_idx[0] += 1
                 else:
-
-                    cache_x = x[:, :, -1:, :, :].clone()
-                    # if cache_x.shape[2] < 2 and feat_cache[idx] is not None and feat_cache[idx]!='Rep':
-                    #     # cache last frame of last two chunk
-                    #     cache_x = torch.cat([feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(cache_x.device), cache_x], dim=2)
-
+                    cache_x = x
                     x = self.time_conv(
-                        torch.cat([feat_cache[idx][:, :, -1:, :, :], x], 2))
-                    feat_cache[idx] = cache_x
+                        torch.cat([feat_cache.read(idx, 1), x], 2))
+                    feat_cache.write(idx, cache_x)
                     feat_idx[0] += 1
         return x
 
@@ -203,17 +260,7 @@ class ResidualBlock(nn.Module):
         h = self.shortcut(x)
         for layer in self.residual:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat([
-                        feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                            cache_x.device), cache_x
-                    ],
-                                        dim=2)
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
+                x = feat_cache.conv(feat_idx[0], layer, x)
                 feat_idx[0] += 1
             else:
                 x = layer(x)
@@ -317,17 +364,7 @@ class Encoder3d(nn.Module):
 
     def forward(self, x, feat_cache=None, feat_idx=[0]):
         if feat_cache is not None:
-            idx = feat_idx[0]
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                # cache last frame of last two chunk
-                cache_x = torch.cat([
-                    feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                        cache_x.device), cache_x
-                ],
-                                    dim=2)
-            x = self.conv1(x, feat_cache[idx])
-            feat_cache[idx] = cache_x
+            x = feat_cache.conv(feat_idx[0], self.conv1, x)
             feat_idx[0] += 1
         else:
             x = self.conv1(x)
@@ -349,17 +386,7 @@ class Encoder3d(nn.Module):
         ## head
         for layer in self.head:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat([
-                        feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                            cache_x.device), cache_x
-                    ],
-                                        dim=2)
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
+                x = feat_cache.conv(feat_idx[0], layer, x)
                 feat_idx[0] += 1
             else:
                 x = layer(x)
@@ -423,17 +450,7 @@ class Decoder3d(nn.Module):
     def forward(self, x, feat_cache=None, feat_idx=[0]):
         ## conv1
         if feat_cache is not None:
-            idx = feat_idx[0]
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                # cache last frame of last two chunk
-                cache_x = torch.cat([
-                    feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                        cache_x.device), cache_x
-                ],
-                                    dim=2)
-            x = self.conv1(x, feat_cache[idx])
-            feat_cache[idx] = cache_x
+            x = feat_cache.conv(feat_idx[0], self.conv1, x)
             feat_idx[0] += 1
         else:
             x = self.conv1(x)
@@ -455,17 +472,7 @@ class Decoder3d(nn.Module):
         ## head
         for layer in self.head:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat([
-                        feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                            cache_x.device), cache_x
-                    ],
-                                        dim=2)
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
+                x = feat_cache.conv(feat_idx[0], layer, x)
                 feat_idx[0] += 1
             else:
                 x = layer(x)
@@ -480,6 +487,73 @@ def count_conv3d(model):
     return count
 
 
+def _tile_starts(size, tile, overlap):
+    # starts of the tiles covering [0, size), neighbours overlap by at least `overlap`
+    if size <= tile:
+        return [0]
+    return list(range(0, size - tile, tile - overlap)) + [size - tile]
+
+
+def _blend_ramp(length, first, last, overlap, device):
+    # weights of a tile along one axis, linear ramps over the overlaps with neighbours
+    w = torch.ones(length, device=device)
+    ramp = torch.arange(1, overlap + 1, device=device) / (overlap + 1)
+    if not first:
+        w[:overlap] = ramp
+    if not last:
+        w[length - overlap:] = torch.minimum(w[length - overlap:], ramp.flip(0))
+    return w
+
+
+def tiled_apply(fn, x, tile_size, overlap, in_factor=1, out_factor=1):
+    r"""
+    Applies `fn` to overlapping spatial tiles of x and blends the outputs of neighbouring
+    tiles with linear ramps over their overlap. Tiles are laid out on a grid of which one
+    cell is in_factor x in_factor input pixels and out_factor x out_factor output pixels.
+
+    Args:
+        fn (`Callable`):
+            Maps an input tile [B, C, T, h * in_factor, w * in_factor] to an output tile
+            [B, C', T', h * out_factor, w * out_factor]
+        x (Tensor):
+            Input of shape [B, C, T, H, W]
+        tile_size (Tuple[`int`]):
+            (h, w) tile size in grid cells
+        overlap (`int`):
+            Minimal overlap of neighbouring tiles in grid cells
+        in_factor (`int`, *optional*, defaults to 1):
+            Input pixels per grid cell along H and W
+        out_factor (`int`, *optional*, defaults to 1):
+            Output pixels per grid cell along H and W
+
+    Returns:
+        Tensor:
+            Output of shape [B, C', T', H / in_factor * out_factor, W / in_factor * out_factor]
+    """
+    h, w = x.size(3) // in_factor, x.size(4) // in_factor
+    th, tw = min(tile_size[0], h), min(tile_size[1], w)
+    out = weight = None
+    for i in _tile_starts(h, th, overlap):
+        for j in _tile_starts(w, tw, overlap):
+            y = fn(x[:, :, :, i * in_factor:(i + th) * in_factor,
+                     j * in_factor:(j + tw) * in_factor])
+            if out is None:
+                out = y.new_zeros(*y.shape[:3], h * out_factor,
+                                  w * out_factor)
+                weight = y.new_zeros(h * out_factor, w * out_factor)
+            wi = _blend_ramp(th * out_factor, i == 0, i + th == h,
+                             overlap * out_factor, y.device)
+            wj = _blend_ramp(tw * out_factor, j == 0, j + tw == w,
+                             overlap * out_factor, y.device)
+            wij = wi[:, None] * wj[None, :]
+            rows = slice(i * out_factor, (i + th) * out_factor)
+            cols = slice(j * out_factor, (j + tw) * out_factor)
+            out[:, :, :, rows, cols] += y * wij
+            weight[rows, cols] += wij
+            del y
+    return out.div_(weight)
+
+
 class WanVAE_(nn.Module):
 
     def __init__(self,
@@ -507,65 +581,126 @@ class WanVAE_(nn.Module):
         self.decoder = Decoder3d(dim, z_dim, dim_mult, num_res_blocks,
                                  attn_scales, self.temperal_upsample, dropout)
 
+        # keep the causal caches across calls, see `causal_cache`
+        self.keep_cache = False
+        self.clear_cache()
+
     def forward(self, x):
         mu, log_var = self.encode(x)
         z = self.reparameterize(mu, log_var)
         x_recon = self.decode(z)
         return x_recon, mu, log_var
 
-    def encode(self, x, scale):
-        self.clear_cache()
-        ## cache
+    def encode(self, x, scale, zero_tolerance=None):
+        cache = self.causal_cache('encoder', tuple(x.shape[3:]))
         t = x.shape[2]
         iter_ = 1 + (t - 1) // 4
         ## 对encode输入的x，按时间拆分为1、4、4、4....
+        # the latents of a run of all-zero chunks (e.g. the frames after the image of I2V)
+        # converge to a fixed frame as the causal cache forgets the frames before the run:
+        # once two consecutive ones agree within zero_tolerance, the rest of the run reuses
+        # the last one instead of being encoded. Off by default: finding the zero chunks
+        # synchronizes with the host at every chunk
+        zeros, converged = 0, False
         for i in range(iter_):
-            self._enc_conv_idx = [0]
             if i == 0:
-                out = self.encoder(
-                    x[:, :, :1, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx)
+                u = self.encoder(x[:, :, :1], feat_cache=cache, feat_idx=[0])
+                # one latent frame per chunk
+                out = u.new_empty(u.shape[:2] + (iter_,) + u.shape[3:])
             else:
-                out_ = self.encoder(
-                    x[:, :, 1 + 4 * (i - 1):1 + 4 * i, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx)
-                out = torch.cat([out, out_], 2)
+                u = x[:, :, 1 + 4 * (i - 1):1 + 4 * i]
+                zeros = 0 if zero_tolerance is None or u.any() else zeros + 1
+                if zeros == 0:
+                    converged = False
+                if converged:
+                    u = out[:, :, i - 1:i]
+                else:
+                    u = self.encoder(u, feat_cache=cache, feat_idx=[0])
+                    if zeros > 1:
+                        last = out[:, :, i - 1:i]
+                        converged = bool((u - last).abs().max() <=
+                                         zero_tolerance * last.abs().max())
+            out[:, :, i:i + 1] = u
         mu, log_var = self.conv1(out).chunk(2, dim=1)
         if isinstance(scale[0], torch.Tensor):
             mu = (mu - scale[0].view(1, self.z_dim, 1, 1, 1)) * scale[1].view(
                 1, self.z_dim, 1, 1, 1)
         else:
             mu = (mu - scale[0]) * scale[1]
-        self.clear_cache()
         return mu
 
     def decode(self, z, scale):
-        self.clear_cache()
+        return self._collect(self.decode_chunks(z, scale), z.size(2))
+
+    def _collect(self, chunks, t):
+        # writes the chunks of `decode_chunks` into the preallocated video
+        out, i = None, 0
+        for u in chunks:
+            if out is None:
+                t = 1 + (t - 1) * 2**sum(self.temperal_upsample)
+                out = u.new_empty(u.shape[:2] + (t,) + u.shape[3:])
+            out[:, :, i:i + u.size(2)] = u
+            i += u.size(2)
+        return out
+
+    def decode_chunks(self, z, scale, tile_size=None, overlap=0):
+        r"""
+        Decodes z frame by frame of the latent and yields the RGB chunks (1 frame, then 4
+        frames per latent frame) as the causal decoder produces them, so the whole video
+        never has to be held at once.
+
+        With tile_size, every latent frame is decoded on overlapping spatial tiles, see
+        `tiled_apply`, each tile keeping its own causal feature cache across frames.
+        tile_size and overlap are in latent tokens.
+        """
         # z: [b,c,t,h,w]
         if isinstance(scale[0], torch.Tensor):
             z = z / scale[1].view(1, self.z_dim, 1, 1, 1) + scale[0].view(
                 1, self.z_dim, 1, 1, 1)
         else:
             z = z / scale[1] + scale[0]
-        iter_ = z.shape[2]
         x = self.conv2(z)
-        for i in range(iter_):
-            self._conv_idx = [0]
-            if i == 0:
-                out = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
+
+        # causal feature caches, one per tile
+        caches = {}
+
+        def decode_tile(u, tile):
+            if tile not in caches:
+                caches[tile] = self.causal_cache('decoder',
+                                                 (tile,) + tuple(u.shape[3:]))
+            return self.decoder(u, feat_cache=caches[tile], feat_idx=[0])
+
+        for i in range(x.size(2)):
+            if tile_size is None:
+                yield decode_tile(x[:, :, i:i + 1], 0)
             else:
-                out_ = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
-                out = torch.cat([out, out_], 2)
-        self.clear_cache()
-        return out
+                tiles = itertools.count()
+                yield tiled_apply(
+                    lambda u: decode_tile(u, next(tiles)),
+                    x[:, :, i:i + 1],
+                    tile_size,
+                    overlap,
+                    out_factor=8)
+
+    def tiled_encode(self, x, scale, tile_size, overlap, zero_tolerance=None):
+        r"""
+        `encode` on overlapping spatial tiles, see `tiled_apply`. tile_size and overlap are
+        in latent tokens, the tiles are encoded one after another, each over all frames.
+        """
+        return tiled_apply(
+            lambda u: self.encode(u, scale, zero_tolerance),
+            x,
+            tile_size,
+            overlap,
+            in_factor=8)
+
+    def tiled_decode(self, z, scale, tile_size, overlap):
+        r"""
+        `decode` on overlapping spatial tiles, see `decode_chunks`. tile_size and overlap
+        are in latent tokens.
+        """
+        return self._collect(
+            self.decode_chunks(z, scale, tile_size, overlap), z.size(2))
 
     def reparameterize(self, mu, log_var):
         std = torch.exp(0.5 * log_var)
@@ -579,14 +714,23 @@ class WanVAE_(nn.Module):
         std = torch.exp(0.5 * log_var.clamp(-30.0, 20.0))
         return mu + std * torch.randn_like(std)
 
+    def causal_cache(self, name, key):
+        r"""
+        A reset `CausalCache` for the 'encoder' or 'decoder'. With `keep_cache`, the caches
+        are kept per key (tile and resolution) and reused by the next calls, which then
+        allocate nothing, until `clear_cache`; concurrent calls must then not share the
+        model. Otherwise every call makes its own.
+        """
+        if not self.keep_cache:
+            return CausalCache(count_conv3d(getattr(self, name)))
+        key = (name,) + key
+        if key not in self._caches:
+            self._caches[key] = CausalCache(count_conv3d(getattr(self, name)))
+        self._caches[key].reset()
+        return self._caches[key]
+
     def clear_cache(self):
-        self._conv_num = count_conv3d(self.decoder)
-        self._conv_idx = [0]
-        self._feat_map = [None] * self._conv_num
-        #cache encode
-        self._enc_conv_num = count_conv3d(self.encoder)
-        self._enc_conv_idx = [0]
-        self._enc_feat_map = [None] * self._enc_conv_num
+        self._caches = {}
 
 
 def _video_vae(pretrained_path=None, z_dim=None, device='cpu', **kwargs):
@@ -609,11 +753,7 @@ def _video_vae(pretrained_path=None, z_dim=None, device='cpu', **kwargs):
         model = WanVAE_(**cfg)
 
     # load checkpoint
-    logging.info(f'loading {pretrained_path}')
-    model.load_state_dict(
-        torch.load(pretrained_path, map_location=device), assign=True)
-
-    return model
+    return load_weights(model, pretrained_path, device)
 
 
 class WanVAE:
@@ -644,20 +784,121 @@ class WanVAE:
             z_dim=z_dim,
         ).eval().requires_grad_(False).to(device)
 
-    def encode(self, videos):
+        # spatial tiling, see `set_tiling`
+        self.tiling = None
+
+    def set_tiling(self, tile_size=None, overlap=8, memory_budget=None):
+        r"""
+        Encodes and decodes videos on overlapping spatial tiles, see `WanVAE_.tiled_decode`,
+        which bounds the peak memory of the full resolution feature maps by the tile size.
+
+        Args:
+            tile_size (Tuple[`int`], *optional*):
+                (h, w) tile size in latent tokens (8 pixels)
+            overlap (`int`, *optional*, defaults to 8):
+                Overlap of neighbouring tiles in latent tokens, blended linearly
+            memory_budget (`float`, *optional*):
+                Memory in GiB for the feature maps of a tile, used to pick the tile size if
+                tile_size is None. Videos fitting into the budget are not tiled. If both
+                are None, tiling is disabled
+        """
+        assert tile_size is None or min(tile_size) > overlap
+        self.tiling = dict(
+            tile_size=tile_size and tuple(tile_size),
+            overlap=overlap,
+            memory_budget=memory_budget) if (
+                tile_size is not None or memory_budget is not None) else None
+
+    def tile_size(self, h, w, batch_size=1):
+        r"""
+        Tile size of a batch of latents of h x w tokens, None if it is not tiled.
         """
-        videos: A list of videos each with shape [C, T, H, W].
+        if self.tiling is None:
+            return None
+        if self.tiling['tile_size'] is not None:
+            th, tw = self.tiling['tile_size']
+        else:
+            # rough estimate of the live feature maps of a chunk of 4 frames at full
+            # resolution: input, output, residual, causal cache and temporaries
+            bytes_per_pixel = batch_size * self.model.dim * 4 * 8 * (
+                torch.finfo(self.dtype).bits // 8)
+            max_tokens = int(self.tiling['memory_budget'] * 2**30 //
+                             (bytes_per_pixel * 64))
+            if h * w <= max_tokens:
+                return None
+            th = max(min(h, int(max_tokens**0.5)),
+                     2 * self.tiling['overlap'] + 1)
+            tw = max(min(w, max_tokens // th), 2 * self.tiling['overlap'] + 1)
+        if th >= h and tw >= w:
+            return None
+        return th, tw
+
+    @staticmethod
+    def _batches(videos):
+        # indices of the videos of the same shape, which run as one batch
+        batches = {}
+        for i, u in enumerate(videos):
+            batches.setdefault(tuple(u.shape), []).append(i)
+        return batches.values()
+
+    def encode(self, videos, zero_tolerance=None):
+        """
+        videos: A list of videos each with shape [C, T, H, W]. Videos of the same shape are
+        encoded together as a batch.
+        zero_tolerance: Relative tolerance of the latents reused for runs of all-zero frames,
+        e.g. the frames after the image of I2V, None to encode every frame.
         """
         with amp.autocast(dtype=self.dtype):
-            return [
-                self.model.encode(u.unsqueeze(0), self.scale).float().squeeze(0)
-                for u in videos
-            ]
+            out = [None] * len(videos)
+            for batch in self._batches(videos):
+                x = torch.stack([videos[i] for i in batch])
+                tile_size = self.tile_size(
+                    x.size(3) // 8, x.size(4) // 8, len(batch))
+                if tile_size is None:
+                    x = self.model.encode(x, self.scale, zero_tolerance)
+                else:
+                    x = self.model.tiled_encode(x, self.scale, tile_size,
+                                                self.tiling['overlap'],
+                                                zero_tolerance)
+                for i, u in zip(batch, x.float().unbind(0)):
+                    out[i] = u
+            return out
 
     def decode(self, zs):
+        """
+        zs: A list of latents each with shape [C, T, H, W]. Latents of the same shape are
+        decoded together as a batch.
+        """
         with amp.autocast(dtype=self.dtype):
-            return [
-                self.model.decode(u.unsqueeze(0),
-                                  self.scale).float().clamp_(-1, 1).squeeze(0)
-                for u in zs
-            ]
+            out = [None] * len(zs)
+            for batch in self._batches(zs):
+                z = torch.stack([zs[i] for i in batch])
+                tile_size = self.tile_size(z.size(3), z.size(4), len(batch))
+                if tile_size is None:
+                    x = self.model.decode(z, self.scale)
+                else:
+                    x = self.model.tiled_decode(z, self.scale, tile_size,
+                                                self.tiling['overlap'])
+                for i, u in zip(batch, x.float().clamp_(-1, 1).unbind(0)):
+                    out[i] = u
+            return out
+
+    def decode_stream(self, z):
+        r"""
+        Decodes a latent of shape [C, T, H, W] chunk by chunk, see `WanVAE_.decode_chunks`.
+
+        Yields:
+            Tensor:
+                Frames [3, t, H * 8, W * 8] in [-1, 1], 1 frame and then 4 frames per chunk
+        """
+        tile_size = self.tile_size(z.size(2), z.size(3))
+        chunks = self.model.decode_chunks(
+            z.unsqueeze(0), self.scale, tile_size,
+            self.tiling['overlap'] if tile_size is not None else 0)
+        while True:
+            # autocast only while the decoder runs, not while the caller consumes
+            with amp.autocast(dtype=self.dtype):
+                u = next(chunks, None)
+            if u is None:
+                return
+            yield u.float().clamp_(-1, 1).squeeze(0)
@@ -15,7 +15,9 @@ import torch.distributed as dist
 from tqdm import tqdm
 
 from .distributed.fsdp import shard_model
+from .modules.attention import set_attention_backend
 from .modules.model import WanModel
+from .modules.offload import encoder_offload, offload_blocks
 from .modules.t5 import T5EncoderModel
 from .modules.vae import WanVAE
 from .utils.fm_solvers import (
@@ -24,6 +26,11 @@ from .utils.fm_solvers import (
     retrieve_timesteps,
 )
 from .utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .utils.guidance import (
+    GuidanceSchedule,
+    merge_cfg_args,
+    parse_guidance_schedule,
+)
 
 
 class WanT2V:
@@ -38,6 +45,8 @@ class WanT2V:
         dit_fsdp=False,
         use_usp=False,
         t5_cpu=False,
+        compile=False,
+        compile_cache_dir=None,
     ):
         r"""
         Initializes the Wan text-to-video generation model components.
@@ -59,11 +68,16 @@ class WanT2V:
                 Enable distribution strategy of USP.
             t5_cpu (`bool`, *optional*, defaults to False):
                 Whether to place T5 model on CPU. Only works without t5_fsdp.
+            compile (`bool`, *optional*, defaults to False):
+                Compile the DiT blocks with `torch.compile`. Use `warmup` to build the graphs ahead of time.
+            compile_cache_dir (`str`, *optional*, defaults to None):
+                Directory of the persistent compile cache, reused across restarts.
         """
         self.device = torch.device(f"cuda:{device_id}")
         self.config = config
         self.rank = rank
         self.t5_cpu = t5_cpu
+        self.block_offload = config.block_offload is not None
 
         self.num_train_timesteps = config.num_train_timesteps
         self.param_dtype = config.param_dtype
@@ -76,16 +90,41 @@ class WanT2V:
             checkpoint_path=os.path.join(checkpoint_dir, config.t5_checkpoint),
             tokenizer_path=os.path.join(checkpoint_dir, config.t5_tokenizer),
             shard_fn=shard_fn if t5_fsdp else None)
+        if self.block_offload and not t5_cpu:
+            offload_blocks(
+                self.text_encoder.model,
+                self.text_encoder.model.blocks,
+                self.device,
+                **encoder_offload(config.block_offload))
 
         self.vae_stride = config.vae_stride
         self.patch_size = config.patch_size
         self.vae = WanVAE(
             vae_pth=os.path.join(checkpoint_dir, config.vae_checkpoint),
             device=self.device)
+        if config.vae_tiling:
+            self.vae.set_tiling(**config.vae_tiling)
+        self.vae.model.keep_cache = config.vae_keep_cache
 
         logging.info(f"Creating WanModel from {checkpoint_dir}")
-        self.model = WanModel.from_pretrained(checkpoint_dir)
+        self.model = WanModel.load_pretrained(checkpoint_dir)
         self.model.eval().requires_grad_(False)
+        self.model.trim_text_context = config.trim_text_context
+        self.model.varlen = config.varlen
+        if config.fuse_qkv:
+            self.model.fuse_qkv_projections()
+        set_attention_backend(
+            config.attention_backend,
+            autotune=config.attention_autotune,
+            cache_file=config.attention_cache_file)
+        if config.local_attention:
+            self.model.set_local_attention(**config.local_attention)
+        if config.sparse_attention:
+            self.model.set_sparse_attention(**config.sparse_attention)
+        if config.token_merging:
+            self.model.set_token_merging(**config.token_merging)
+        if config.ffn_chunk_size:
+            self.model.set_chunked_ffn(config.ffn_chunk_size)
 
         if use_usp:
             from xfuser.core.distributed import get_sequence_parallel_world_size
@@ -106,11 +145,43 @@ class WanT2V:
             dist.barrier()
         if dit_fsdp:
             self.model = shard_fn(self.model)
+        elif self.block_offload:
+            offload_blocks(self.model, self.model.blocks, self.device,
+                           **config.block_offload)
         else:
             self.model.to(self.device)
 
+        if compile:
+            self.model.compile_blocks(cache_dir=compile_cache_dir)
+
         self.sample_neg_prompt = config.sample_neg_prompt
 
+    def warmup(self, sizes, frame_num=81, batched_cfg=False):
+        r"""
+        Runs dummy DiT steps for the given output sizes, so that the graphs of the compiled
+        blocks are built and the attention backends are autotuned ahead of the first
+        request, see `WanModel.warmup`.
+
+        Args:
+            sizes (List[tuple[`int`]]):
+                Video resolutions (width,height) to warm up, e.g. all `SUPPORTED_SIZES` of the task
+            frame_num (`int`, *optional*, defaults to 81):
+                How many frames the warmed up videos have
+            batched_cfg (`bool`, *optional*, defaults to False):
+                Also warm up the batched classifier-free guidance forwards
+        """
+        shapes = [(self.vae.model.z_dim,
+                   (frame_num - 1) // self.vae_stride[0] + 1,
+                   h // self.vae_stride[1], w // self.vae_stride[2])
+                  for w, h in sizes]
+        if not self.block_offload:
+            self.model.to(self.device)
+        with amp.autocast(dtype=self.param_dtype):
+            self.model.warmup(
+                shapes,
+                sp_size=self.sp_size,
+                batch_sizes=(1, 2) if batched_cfg else (1,))
+
     def generate(self,
                  input_prompt,
                  size=(1280, 720),
@@ -122,7 +193,11 @@ class WanT2V:
                  n_prompt="",
                  seed=-1,
                  offload_model=True,
-                 progress_callback=None):
+                 progress_callback=None,
+                 batched_cfg=False,
+                 cache_threshold=0.,
+                 guide_schedule=None,
+                 video_writer=None):
         r"""
         Generates video frames from text prompt using diffusion process.
 
@@ -150,6 +225,21 @@ class WanT2V:
             progress_callback (`callable`, *optional*, defaults to None):
                 Callback function for progress updates. Should accept (step, total_steps, current_timestep) as arguments.
                 If None, uses default tqdm progress bar.
+            batched_cfg (`bool`, *optional*, defaults to False):
+                If True, evaluates the conditional and unconditional branches in a single batch-2
+                forward per step. Faster, but doubles the activation memory of the DiT
+            cache_threshold (`float`, *optional*, defaults to 0.0):
+                Residual cache threshold. If positive, the DiT skips the block stack on steps
+                whose input changed little since the last computed step and reuses its residual.
+                Larger values skip more steps, 0 disables skipping
+            guide_schedule (`str`, *optional*, defaults to None):
+                Guidance schedule, e.g. 'interval=0:0.6' (guide the first 60% of the steps only),
+                'every=2' (evaluate the unconditional branch on every 2nd step and reuse its
+                guidance direction in between) or 'scales=6,6,5,4' (per-step guidance scales).
+                Options are separated by ';'. Unguided steps only run the conditional branch
+            video_writer (`VideoWriter`, *optional*, defaults to None):
+                If given, the frames are streamed to `video_writer.write` chunk by chunk as the
+                VAE decodes them (see `WanVAE.decode_stream`) and None is returned
 
         Returns:
             torch.Tensor:
@@ -176,10 +266,11 @@ class WanT2V:
         seed_g.manual_seed(seed)
 
         if not self.t5_cpu:
-            self.text_encoder.model.to(self.device)
+            if not self.block_offload:
+                self.text_encoder.model.to(self.device)
             context = self.text_encoder([input_prompt], self.device)
             context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
+            if offload_model and not self.block_offload:
                 self.text_encoder.model.cpu()
         else:
             context = self.text_encoder([input_prompt], torch.device('cpu'))
@@ -231,57 +322,62 @@ class WanT2V:
             # sample videos
             latents = noise
 
-            arg_c = {'context': context, 'seq_len': seq_len}
-            arg_null = {'context': context_null, 'seq_len': seq_len}
-
-            # 使用进度回调或默认tqdm
-            if progress_callback is not None:
-                # 使用自定义进度回调
-                for step, t in enumerate(timesteps):
-                    # 调用进度回调函数
-                    try:
-                        progress_callback(step, len(timesteps), t.item())
-                    except Exception as e:
-                        # 如果回调函数出错，记录错误但继续执行
-                        logging.warning(f"Progress callback error: {e}")
-                    
-                    latent_model_input = latents
-                    timestep = [t]
+            arg_c = {
+                'context': context,
+                'seq_len': seq_len,
+                'branch': ['cond']
+            }
+            arg_null = {
+                'context': context_null,
+                'seq_len': seq_len,
+                'branch': ['uncond']
+            }
+
+            if batched_cfg:
+                arg_cfg = merge_cfg_args(arg_c, arg_null)
+
+            guidance = GuidanceSchedule(
+                guide_scale, len(timesteps),
+                **parse_guidance_schedule(guide_schedule))
+            with self.model.sampling_session(
+                    timesteps, cache_threshold=cache_threshold):
+                # 使用进度回调或默认tqdm
+                for step, t in enumerate(
+                        timesteps if progress_callback is not None else
+                        tqdm(timesteps)):
+                    if progress_callback is not None:
+                        # 调用进度回调函数
+                        try:
+                            progress_callback(step, len(timesteps), t.item())
+                        except Exception as e:
+                            # 如果回调函数出错，记录错误但继续执行
+                            logging.warning(f"Progress callback error: {e}")
 
-                    timestep = torch.stack(timestep)
-
-                    self.model.to(self.device)
-                    noise_pred_cond = self.model(
-                        latent_model_input, t=timestep, **arg_c)[0]
-                    noise_pred_uncond = self.model(
-                        latent_model_input, t=timestep, **arg_null)[0]
-
-                    noise_pred = noise_pred_uncond + guide_scale * (
-                        noise_pred_cond - noise_pred_uncond)
-
-                    temp_x0 = sample_scheduler.step(
-                        noise_pred.unsqueeze(0),
-                        t,
-                        latents[0].unsqueeze(0),
-                        return_dict=False,
-                        generator=seed_g)[0]
-                    latents = [temp_x0.squeeze(0)]
-            else:
-                # 使用默认的tqdm进度条（保持向后兼容）
-                for _, t in enumerate(tqdm(timesteps)):
                     latent_model_input = latents
                     timestep = [t]
 
                     timestep = torch.stack(timestep)
 
-                    self.model.to(self.device)
-                    noise_pred_cond = self.model(
-                        latent_model_input, t=timestep, **arg_c)[0]
-                    noise_pred_uncond = self.model(
-                        latent_model_input, t=timestep, **arg_null)[0]
-
-                    noise_pred = noise_pred_uncond + guide_scale * (
-                        noise_pred_cond - noise_pred_uncond)
+                    if not self.block_offload:
+                        self.model.to(self.device)
+                    if batched_cfg and guidance.needs_uncond(step):
+                        noise_pred_cond, noise_pred_uncond = self.model(
+                            latent_model_input * 2,
+                            t=timestep.repeat(2),
+                            step=step,
+                            **arg_cfg)
+                    else:
+                        noise_pred_cond = self.model(
+                            latent_model_input, t=timestep, step=step,
+                            **arg_c)[0]
+                        noise_pred_uncond = None
+                        if guidance.needs_uncond(step):
+                            noise_pred_uncond = self.model(
+                                latent_model_input, t=timestep, step=step,
+                                **arg_null)[0]
+
+                    noise_pred = guidance(step, noise_pred_cond,
+                                          noise_pred_uncond)
 
                     temp_x0 = sample_scheduler.step(
                         noise_pred.unsqueeze(0),
@@ -293,10 +389,16 @@ class WanT2V:
 
             x0 = latents
             if offload_model:
-                self.model.cpu()
+                if not self.block_offload:
+                    self.model.cpu()
                 torch.cuda.empty_cache()
             if self.rank == 0:
-                videos = self.vae.decode(x0)
+                if video_writer is None:
+                    videos = self.vae.decode(x0)
+                else:
+                    for chunk in self.vae.decode_stream(x0[0]):
+                        video_writer.write(chunk)
+                    videos = [None]
 
         del noise, latents
         del sample_scheduler
@@ -4,10 +4,12 @@ from .fm_solvers import (
     retrieve_timesteps,
 )
 from .fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .guidance import GuidanceSchedule, merge_cfg_args, parse_guidance_schedule
 from .vace_processor import VaceVideoProcessor
 
 __all__ = [
     'HuggingfaceTokenizer', 'get_sampling_sigmas', 'retrieve_timesteps',
     'FlowDPMSolverMultistepScheduler', 'FlowUniPCMultistepScheduler',
-    'VaceVideoProcessor'
+    'VaceVideoProcessor', 'merge_cfg_args', 'GuidanceSchedule',
+    'parse_guidance_schedule'
 ]
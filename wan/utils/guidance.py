@@ -0,0 +1,143 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import torch
+
+from .utils import _parse_options, _values
+
+__all__ = ['merge_cfg_args', 'GuidanceSchedule', 'parse_guidance_schedule']
+
+
+def merge_cfg_args(arg_c, arg_null):
+    r"""
+    Packs the conditional and unconditional model arguments into a single
+    argument dict, so that both classifier-free guidance branches can be
+    evaluated in one batched forward.
+
+    Args:
+        arg_c (`dict`):
+            Keyword arguments of the conditional forward
+        arg_null (`dict`):
+            Keyword arguments of the unconditional forward, same keys as arg_c
+
+    Returns:
+        `dict`:
+            Merged arguments. Lists are concatenated, tensors are concatenated
+            along the batch dimension and all other values must be identical
+            in both branches. The conditional samples come first.
+    """
+    assert arg_c.keys() == arg_null.keys()
+    merged = {}
+    for key, cond in arg_c.items():
+        uncond = arg_null[key]
+        if isinstance(cond, list):
+            merged[key] = cond + uncond
+        elif isinstance(cond, torch.Tensor):
+            merged[key] = torch.cat([cond, uncond])
+        else:
+            assert cond == uncond, f'Cannot batch different `{key}` values.'
+            merged[key] = cond
+    return merged
+
+
+class GuidanceSchedule:
+    r"""
+    Per-step classifier-free guidance of one sampling run. On steps without guidance only
+    the conditional branch needs to be evaluated.
+
+    Args:
+        guide_scale (`float`):
+            Guidance scale of the steps not covered by `scales`
+        num_steps (`int`):
+            Number of sampling steps
+        interval (Tuple[`int` or `float`, `int` or `float`], *optional*):
+            Guidance is only applied on the steps in [start, end). Integers are step indices,
+            floats are fractions of `num_steps`. If None, all steps are guided
+        every (`int`, *optional*, defaults to 1):
+            Only evaluate the unconditional branch on every k-th guided step. The other
+            guided steps reuse the guidance direction (cond - uncond) of the last evaluated one
+        scales (List[`float`], *optional*):
+            Per-step guidance scales, the last one is repeated for the remaining steps.
+            Steps with scale 1 are not guided
+    """
+
+    def __init__(self,
+                 guide_scale,
+                 num_steps,
+                 interval=None,
+                 every=1,
+                 scales=None):
+        assert every >= 1, f'Unsupported guidance period {every}.'
+        if interval is None:
+            interval = (0, num_steps)
+        self.start, self.end = [
+            round(u * num_steps) if isinstance(u, float) else u
+            for u in interval
+        ]
+        self.every = every
+        self.scales = [guide_scale] * num_steps
+        if scales:
+            self.scales = list(scales) + [scales[-1]] * (
+                num_steps - len(scales))
+        # index of every step among the guided ones, the period of `every` counts
+        # guided steps only
+        self.guided_index, index = [], 0
+        for step in range(num_steps):
+            self.guided_index.append(index)
+            index += self.guided(step)
+        self.delta = None
+
+    def guided(self, step):
+        return self.start <= step < self.end and self.scales[step] != 1
+
+    def needs_uncond(self, step):
+        r"""
+        Whether the unconditional branch has to be evaluated at the given step.
+        """
+        return self.guided(step) and (
+            self.delta is None or self.guided_index[step] % self.every == 0)
+
+    def __call__(self, step, noise_pred_cond, noise_pred_uncond=None):
+        r"""
+        Combines the branch predictions of the given step.
+
+        Args:
+            step (`int`):
+                Index of the sampling step
+            noise_pred_cond (Tensor):
+                Prediction of the conditional branch
+            noise_pred_uncond (Tensor, *optional*):
+                Prediction of the unconditional branch, required if `needs_uncond(step)`
+
+        Returns:
+            Tensor:
+                The guided prediction
+        """
+        if not self.guided(step):
+            return noise_pred_cond
+        if noise_pred_uncond is not None:
+            self.delta = noise_pred_cond - noise_pred_uncond
+            return noise_pred_uncond + self.scales[step] * self.delta
+        return noise_pred_cond + (self.scales[step] - 1) * self.delta
+
+
+def parse_guidance_schedule(spec):
+    r"""
+    Parses a guidance schedule specification, e.g. 'interval=0:0.6', 'every=2',
+    'interval=0:30;every=3' or 'scales=6,6,5,4'.
+
+    Args:
+        spec (`str`):
+            Semicolon separated `key=value` options of `GuidanceSchedule`. Interval bounds
+            containing a '.' are fractions of the sampling steps, otherwise step indices
+
+    Returns:
+        `dict`:
+            Keyword arguments of `GuidanceSchedule`
+    """
+    return _parse_options(
+        spec,
+        dict(
+            interval=_values(lambda u: float(u) if '.' in u else int(u), ':',
+                             2),
+            every=int,
+            scales=lambda value: list(_values(float)(value))),
+        'guidance schedule')
@@ -3,12 +3,18 @@ import argparse
 import binascii
 import os
 import os.path as osp
+import queue
+import threading
 
 import imageio
 import torch
 import torchvision
 
-__all__ = ['cache_video', 'cache_image', 'str2bool']
+__all__ = [
+    'cache_video', 'cache_image', 'VideoWriter', 'str2bool',
+    'parse_local_attention',
+    'parse_token_merging', 'parse_block_offload', 'parse_vae_tiling'
+]
 
 
 def rand_name(length=8, suffix=''):
@@ -61,6 +67,74 @@ def cache_video(tensor,
         return None
 
 
+class VideoWriter:
+    """
+    Writes a video chunk by chunk, e.g. the chunks of `WanVAE.decode_stream`. The
+    frames are encoded in a background thread, so encoding overlaps with producing
+    the next chunks. The frames match those of `cache_video` for a single video.
+
+    Args:
+        save_file (str): Path of the video file.
+        fps (int): Frames per second.
+        value_range (tuple): Range of the chunk values, clamped to it.
+        max_pending (int): Number of chunks waiting for the encoder before
+            `write` blocks.
+    """
+
+    def __init__(self, save_file, fps=30, value_range=(-1, 1), max_pending=4):
+        self.save_file = save_file
+        self.value_range = value_range
+        self.writer = imageio.get_writer(
+            save_file, fps=fps, codec='libx264', quality=8)
+        self.queue = queue.Queue(max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._encode, daemon=True)
+        self.thread.start()
+
+    def _encode(self):
+        while True:
+            frames = self.queue.get()
+            if frames is None:
+                return
+            if self.error is None:
+                try:
+                    for frame in frames:
+                        self.writer.append_data(frame)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, chunk):
+        """
+        Appends the frames of a chunk of shape [C, T, H, W].
+        """
+        if self.error is not None:
+            raise self.error
+        low, high = min(self.value_range), max(self.value_range)
+        chunk = chunk.clamp(low, high).sub(low).div(max(high - low, 1e-5))
+        frames = (chunk.permute(1, 2, 3, 0) * 255).type(torch.uint8).cpu()
+        self.queue.put(frames.numpy())
+
+    def close(self):
+        """
+        Waits for the pending frames and closes the file.
+
+        Returns:
+            str: Path of the video file.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
+        return self.save_file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def cache_image(tensor,
                 save_file,
                 nrow=8,
@@ -116,3 +190,156 @@ def str2bool(v):
         return False
     else:
         raise argparse.ArgumentTypeError('Boolean value expected (True/False)')
+
+
+def _values(cast, sep=',', length=None):
+    """
+    Value type of `_parse_options` for `sep` separated values, e.g. '3,15,15'.
+
+    Args:
+        cast (callable): Type of the values.
+        sep (str): Separator of the values.
+        length (int or tuple, optional): Supported number(s) of values.
+
+    Returns:
+        callable: Parser of the value string into a tuple.
+    """
+    lengths = (length,) if isinstance(length, int) else length
+
+    def parse(value):
+        values = tuple(cast(u) for u in value.split(sep))
+        if lengths is not None and len(values) not in lengths:
+            raise ValueError(f'Expected {length} values, got {len(values)}.')
+        return values
+
+    return parse
+
+
+def _parse_options(spec, types, name, keys=None):
+    """
+    Parses semicolon separated `key=value` options, e.g. 'window=3,15,15;tile=1,5,5'.
+
+    Args:
+        spec (str): The options, None or '' for none.
+        types (dict): Type of the value of every supported key, a callable
+            parsing the value string, see `_values`.
+        name (str): Name of the options in error messages.
+        keys (dict, optional): Keyword argument names of the keys, by default
+            the keys themselves.
+
+    Returns:
+        dict: The parsed values by keyword argument name.
+    """
+    kwargs = {}
+    for option in filter(None, [u.strip() for u in (spec or '').split(';')]):
+        key, _, value = option.partition('=')
+        key, value = key.strip(), value.strip()
+        if key not in types:
+            raise ValueError(f'Unsupported {name} option {key}.')
+        try:
+            kwargs[(keys or {}).get(key, key)] = types[key](value)
+        except (ValueError, argparse.ArgumentTypeError) as e:
+            raise ValueError(f'Unsupported {name} {key} {value}: {e}') from e
+    return kwargs
+
+
+def parse_local_attention(spec):
+    """
+    Parses a local attention specification, e.g. 'window=3,15,15',
+    'window=3,15,15;tile=1,5,5;global_layers=0,39;global_steps=0:5'.
+
+    Args:
+        spec (str): Semicolon separated `key=value` options of
+            `WanModel.set_local_attention`.
+
+    Returns:
+        dict: Keyword arguments of `WanModel.set_local_attention`, None if
+            the spec is empty.
+    """
+    kwargs = _parse_options(
+        spec,
+        dict(
+            window=_values(int, ',', 3),
+            tile=_values(int, ',', 3),
+            global_layers=lambda value: list(_values(int)(value)),
+            global_steps=_values(int, ':', 2)), 'local attention')
+    if not kwargs:
+        return None
+    if 'window' not in kwargs:
+        raise ValueError('Local attention requires a window.')
+    return kwargs
+
+
+def parse_token_merging(spec):
+    """
+    Parses a token merging specification, e.g. 'ratio=0.5',
+    'ratio=0.5;stride=1,2,2;layers=0:30;steps=10:50;whole_block=true'.
+
+    Args:
+        spec (str): Semicolon separated `key=value` options of
+            `WanModel.set_token_merging`.
+
+    Returns:
+        dict: Keyword arguments of `WanModel.set_token_merging`, None if the
+            spec is empty.
+    """
+    kwargs = _parse_options(
+        spec,
+        dict(
+            ratio=float,
+            stride=_values(int, ',', 3),
+            layers=_values(int, ':', 2),
+            steps=_values(int, ':', 2),
+            whole_block=str2bool), 'token merging')
+    if not kwargs:
+        return None
+    if 'ratio' not in kwargs:
+        raise ValueError('Token merging requires a ratio.')
+    return kwargs
+
+
+def parse_block_offload(spec):
+    """
+    Parses a block offload specification, e.g. 'resident=10', 'budget=12' or
+    'resident=0;prefetch=2;pin_memory=false'.
+
+    Args:
+        spec (str): Semicolon separated `key=value` options of
+            `BlockOffloader`. 'resident' is the number of DiT blocks kept on
+            the device, 'budget' the device memory in GiB for the DiT block
+            weights.
+
+    Returns:
+        dict: Keyword arguments of `BlockOffloader`, None if the spec is
+            empty.
+    """
+    return _parse_options(
+        spec,
+        dict(resident=int, budget=float, prefetch=int, pin_memory=str2bool),
+        'block offload',
+        keys=dict(resident='num_resident', budget='memory_budget')) or None
+
+
+def parse_vae_tiling(spec):
+    """
+    Parses a VAE tiling specification, e.g. 'tile=32,48;overlap=8' or
+    'budget=8'.
+
+    Args:
+        spec (str): Semicolon separated `key=value` options of
+            `WanVAE.set_tiling`. 'tile' is the (h, w) tile size in latent
+            tokens, a single value for square tiles, 'budget' the memory in
+            GiB for the feature maps of a tile.
+
+    Returns:
+        dict: Keyword arguments of `WanVAE.set_tiling`, None if the spec is
+            empty.
+    """
+    kwargs = _parse_options(
+        spec,
+        dict(tile=_values(int, ',', (1, 2)), overlap=int, budget=float),
+        'VAE tiling',
+        keys=dict(tile='tile_size', budget='memory_budget'))
+    if len(kwargs.get('tile_size', ())) == 1:
+        kwargs['tile_size'] *= 2
+    return kwargs or None
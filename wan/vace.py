@@ -20,6 +20,8 @@ import torchvision.transforms.functional as TF
 from PIL import Image
 from tqdm import tqdm
 
+from .modules.attention import set_attention_backend
+from .modules.offload import encoder_offload, offload_blocks
 from .modules.vace_model import VaceWanModel
 from .text2video import (
     FlowDPMSolverMultistepScheduler,
@@ -31,6 +33,11 @@ from .text2video import (
     retrieve_timesteps,
     shard_model,
 )
+from .utils.guidance import (
+    GuidanceSchedule,
+    merge_cfg_args,
+    parse_guidance_schedule,
+)
 from .utils.vace_processor import VaceVideoProcessor
 
 
@@ -46,6 +53,8 @@ class WanVace(WanT2V):
         dit_fsdp=False,
         use_usp=False,
         t5_cpu=False,
+        compile=False,
+        compile_cache_dir=None,
     ):
         r"""
         Initializes the Wan text-to-video generation model components.
@@ -67,11 +76,16 @@ class WanVace(WanT2V):
                 Enable distribution strategy of USP.
             t5_cpu (`bool`, *optional*, defaults to False):
                 Whether to place T5 model on CPU. Only works without t5_fsdp.
+            compile (`bool`, *optional*, defaults to False):
+                Compile the DiT blocks with `torch.compile`. Use `warmup` to build the graphs ahead of time.
+            compile_cache_dir (`str`, *optional*, defaults to None):
+                Directory of the persistent compile cache, reused across restarts.
         """
         self.device = torch.device(f"cuda:{device_id}")
         self.config = config
         self.rank = rank
         self.t5_cpu = t5_cpu
+        self.block_offload = config.block_offload is not None
 
         self.num_train_timesteps = config.num_train_timesteps
         self.param_dtype = config.param_dtype
@@ -84,16 +98,41 @@ class WanVace(WanT2V):
             checkpoint_path=os.path.join(checkpoint_dir, config.t5_checkpoint),
             tokenizer_path=os.path.join(checkpoint_dir, config.t5_tokenizer),
             shard_fn=shard_fn if t5_fsdp else None)
+        if self.block_offload and not t5_cpu:
+            offload_blocks(
+                self.text_encoder.model,
+                self.text_encoder.model.blocks,
+                self.device,
+                **encoder_offload(config.block_offload))
 
         self.vae_stride = config.vae_stride
         self.patch_size = config.patch_size
         self.vae = WanVAE(
             vae_pth=os.path.join(checkpoint_dir, config.vae_checkpoint),
             device=self.device)
+        if config.vae_tiling:
+            self.vae.set_tiling(**config.vae_tiling)
+        self.vae.model.keep_cache = config.vae_keep_cache
 
         logging.info(f"Creating VaceWanModel from {checkpoint_dir}")
-        self.model = VaceWanModel.from_pretrained(checkpoint_dir)
+        self.model = VaceWanModel.load_pretrained(checkpoint_dir)
         self.model.eval().requires_grad_(False)
+        self.model.trim_text_context = config.trim_text_context
+        self.model.varlen = config.varlen
+        if config.fuse_qkv:
+            self.model.fuse_qkv_projections()
+        set_attention_backend(
+            config.attention_backend,
+            autotune=config.attention_autotune,
+            cache_file=config.attention_cache_file)
+        if config.local_attention:
+            self.model.set_local_attention(**config.local_attention)
+        if config.sparse_attention:
+            self.model.set_sparse_attention(**config.sparse_attention)
+        if config.token_merging:
+            self.model.set_token_merging(**config.token_merging)
+        if config.ffn_chunk_size:
+            self.model.set_chunked_ffn(config.ffn_chunk_size)
 
         if use_usp:
             from xfuser.core.distributed import get_sequence_parallel_world_size
@@ -120,9 +159,18 @@ class WanVace(WanT2V):
             dist.barrier()
         if dit_fsdp:
             self.model = shard_fn(self.model)
+        elif self.block_offload:
+            # the VACE blocks run before the main blocks
+            offload_blocks(
+                self.model,
+                list(self.model.vace_blocks) + list(self.model.blocks),
+                self.device, **config.block_offload)
         else:
             self.model.to(self.device)
 
+        if compile:
+            self.model.compile_blocks(cache_dir=compile_cache_dir)
+
         self.sample_neg_prompt = config.sample_neg_prompt
 
         self.vid_proc = VaceVideoProcessor(
@@ -143,25 +191,34 @@ class WanVace(WanT2V):
         else:
             assert len(frames) == len(ref_images)
 
+        # a single encode call, which batches the same-shape videos and ref images
         if masks is None:
-            latents = vae.encode(frames)
+            videos = list(frames)
         else:
             masks = [torch.where(m > 0.5, 1.0, 0.0) for m in masks]
             inactive = [i * (1 - m) + 0 * m for i, m in zip(frames, masks)]
             reactive = [i * m + 0 * (1 - m) for i, m in zip(frames, masks)]
-            inactive = vae.encode(inactive)
-            reactive = vae.encode(reactive)
+            videos = inactive + reactive
+        refs_start = len(videos)
+        for refs in ref_images:
+            if refs is not None:
+                videos.extend(refs)
+        encoded = vae.encode(videos)
+
+        if masks is None:
+            latents = encoded[:len(frames)]
+        else:
             latents = [
-                torch.cat((u, c), dim=0) for u, c in zip(inactive, reactive)
+                torch.cat((u, c), dim=0) for u, c in zip(
+                    encoded[:len(frames)], encoded[len(frames):refs_start])
             ]
 
         cat_latents = []
         for latent, refs in zip(latents, ref_images):
             if refs is not None:
-                if masks is None:
-                    ref_latent = vae.encode(refs)
-                else:
-                    ref_latent = vae.encode(refs)
+                ref_latent = encoded[refs_start:refs_start + len(refs)]
+                refs_start += len(refs)
+                if masks is not None:
                     ref_latent = [
                         torch.cat((u, torch.zeros_like(u)), dim=0)
                         for u in ref_latent
@@ -277,7 +334,7 @@ class WanVace(WanT2V):
                         src_ref_images[i][j] = ref_img.to(device)
         return src_video, src_mask, src_ref_images
 
-    def decode_latent(self, zs, ref_images=None, vae=None):
+    def decode_latent(self, zs, ref_images=None, vae=None, video_writer=None):
         vae = self.vae if vae is None else vae
         if ref_images is None:
             ref_images = [None] * len(zs)
@@ -290,6 +347,12 @@ class WanVace(WanT2V):
                 z = z[:, len(refs):, :, :]
             trimed_zs.append(z)
 
+        if video_writer is not None:
+            # stream the frames, see `WanVAE.decode_stream`
+            for z in trimed_zs:
+                for chunk in vae.decode_stream(z):
+                    video_writer.write(chunk)
+            return [None] * len(trimed_zs)
         return vae.decode(trimed_zs)
 
     def generate(self,
@@ -306,7 +369,11 @@ class WanVace(WanT2V):
                  guide_scale=5.0,
                  n_prompt="",
                  seed=-1,
-                 offload_model=True):
+                 offload_model=True,
+                 batched_cfg=False,
+                 cache_threshold=0.,
+                 guide_schedule=None,
+                 video_writer=None):
         r"""
         Generates video frames from text prompt using diffusion process.
 
@@ -331,6 +398,21 @@ class WanVace(WanT2V):
                 Random seed for noise generation. If -1, use random seed.
             offload_model (`bool`, *optional*, defaults to True):
                 If True, offloads models to CPU during generation to save VRAM
+            batched_cfg (`bool`, *optional*, defaults to False):
+                If True, evaluates the conditional and unconditional branches in a single batch-2
+                forward per step. Faster, but doubles the activation memory of the DiT
+            cache_threshold (`float`, *optional*, defaults to 0.0):
+                Residual cache threshold. If positive, the DiT skips the block stack on steps
+                whose input changed little since the last computed step and reuses its residual.
+                Larger values skip more steps, 0 disables skipping
+            guide_schedule (`str`, *optional*, defaults to None):
+                Guidance schedule, e.g. 'interval=0:0.6' (guide the first 60% of the steps only),
+                'every=2' (evaluate the unconditional branch on every 2nd step and reuse its
+                guidance direction in between) or 'scales=6,6,5,4' (per-step guidance scales).
+                Options are separated by ';'. Unguided steps only run the conditional branch
+            video_writer (`VideoWriter`, *optional*, defaults to None):
+                If given, the frames are streamed to `video_writer.write` chunk by chunk as the
+                VAE decodes them (see `WanVAE.decode_stream`) and None is returned
 
         Returns:
             torch.Tensor:
@@ -357,10 +439,11 @@ class WanVace(WanT2V):
         seed_g.manual_seed(seed)
 
         if not self.t5_cpu:
-            self.text_encoder.model.to(self.device)
+            if not self.block_offload:
+                self.text_encoder.model.to(self.device)
             context = self.text_encoder([input_prompt], self.device)
             context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
+            if offload_model and not self.block_offload:
                 self.text_encoder.model.cpu()
         else:
             context = self.text_encoder([input_prompt], torch.device('cpu'))
@@ -423,46 +506,71 @@ class WanVace(WanT2V):
             # sample videos
             latents = noise
 
-            arg_c = {'context': context, 'seq_len': seq_len}
-            arg_null = {'context': context_null, 'seq_len': seq_len}
-
-            for _, t in enumerate(tqdm(timesteps)):
-                latent_model_input = latents
-                timestep = [t]
-
-                timestep = torch.stack(timestep)
-
-                self.model.to(self.device)
-                noise_pred_cond = self.model(
-                    latent_model_input,
-                    t=timestep,
-                    vace_context=z,
-                    vace_context_scale=context_scale,
-                    **arg_c)[0]
-                noise_pred_uncond = self.model(
-                    latent_model_input,
-                    t=timestep,
-                    vace_context=z,
-                    vace_context_scale=context_scale,
-                    **arg_null)[0]
-
-                noise_pred = noise_pred_uncond + guide_scale * (
-                    noise_pred_cond - noise_pred_uncond)
-
-                temp_x0 = sample_scheduler.step(
-                    noise_pred.unsqueeze(0),
-                    t,
-                    latents[0].unsqueeze(0),
-                    return_dict=False,
-                    generator=seed_g)[0]
-                latents = [temp_x0.squeeze(0)]
+            arg_c = {
+                'context': context,
+                'seq_len': seq_len,
+                'vace_context': z,
+                'vace_context_scale': context_scale,
+                'branch': ['cond']
+            }
+            arg_null = {
+                'context': context_null,
+                'seq_len': seq_len,
+                'vace_context': z,
+                'vace_context_scale': context_scale,
+                'branch': ['uncond']
+            }
+            if batched_cfg:
+                arg_cfg = merge_cfg_args(arg_c, arg_null)
+
+            guidance = GuidanceSchedule(
+                guide_scale, len(timesteps),
+                **parse_guidance_schedule(guide_schedule))
+            with self.model.sampling_session(
+                    timesteps, cache_threshold=cache_threshold):
+                for step, t in enumerate(tqdm(timesteps)):
+                    latent_model_input = latents
+                    timestep = [t]
+
+                    timestep = torch.stack(timestep)
+
+                    if not self.block_offload:
+                        self.model.to(self.device)
+                    if batched_cfg and guidance.needs_uncond(step):
+                        noise_pred_cond, noise_pred_uncond = self.model(
+                            latent_model_input * 2,
+                            t=timestep.repeat(2),
+                            step=step,
+                            **arg_cfg)
+                    else:
+                        noise_pred_cond = self.model(
+                            latent_model_input, t=timestep, step=step,
+                            **arg_c)[0]
+                        noise_pred_uncond = None
+                        if guidance.needs_uncond(step):
+                            noise_pred_uncond = self.model(
+                                latent_model_input, t=timestep, step=step,
+                                **arg_null)[0]
+
+                    noise_pred = guidance(step, noise_pred_cond,
+                                          noise_pred_uncond)
+
+                    temp_x0 = sample_scheduler.step(
+                        noise_pred.unsqueeze(0),
+                        t,
+                        latents[0].unsqueeze(0),
+                        return_dict=False,
+                        generator=seed_g)[0]
+                    latents = [temp_x0.squeeze(0)]
 
             x0 = latents
             if offload_model:
-                self.model.cpu()
+                if not self.block_offload:
+                    self.model.cpu()
                 torch.cuda.empty_cache()
             if self.rank == 0:
-                videos = self.decode_latent(x0, input_ref_images)
+                videos = self.decode_latent(
+                    x0, input_ref_images, video_writer=video_writer)
 
         del noise, latents
         del sample_scheduler
@@ -482,10 +590,14 @@ class WanVaceMP(WanVace):
                  checkpoint_dir,
                  use_usp=False,
                  ulysses_size=None,
-                 ring_size=None):
+                 ring_size=None,
+                 compile=False,
+                 compile_cache_dir=None):
         self.config = config
         self.checkpoint_dir = checkpoint_dir
         self.use_usp = use_usp
+        self.compile = compile
+        self.compile_cache_dir = compile_cache_dir
         os.environ['MASTER_ADDR'] = 'localhost'
         os.environ['MASTER_PORT'] = '12345'
         os.environ['RANK'] = '0'
@@ -604,9 +716,28 @@ class WanVaceMP(WanVace):
                 vae_pth=os.path.join(self.checkpoint_dir,
                                      self.config.vae_checkpoint),
                 device=gpu)
+            if self.config.vae_tiling:
+                vae.set_tiling(**self.config.vae_tiling)
+            vae.model.keep_cache = self.config.vae_keep_cache
             logging.info(f"Creating VaceWanModel from {self.checkpoint_dir}")
-            model = VaceWanModel.from_pretrained(self.checkpoint_dir)
+            model = VaceWanModel.load_pretrained(self.checkpoint_dir)
             model.eval().requires_grad_(False)
+            model.trim_text_context = self.config.trim_text_context
+            model.varlen = self.config.varlen
+            if self.config.fuse_qkv:
+                model.fuse_qkv_projections()
+            set_attention_backend(
+                self.config.attention_backend,
+                autotune=self.config.attention_autotune,
+                cache_file=self.config.attention_cache_file)
+            if self.config.local_attention:
+                model.set_local_attention(**self.config.local_attention)
+            if self.config.sparse_attention:
+                model.set_sparse_attention(**self.config.sparse_attention)
+            if self.config.token_merging:
+                model.set_token_merging(**self.config.token_merging)
+            if self.config.ffn_chunk_size:
+                model.set_chunked_ffn(self.config.ffn_chunk_size)
 
             if self.use_usp:
                 from xfuser.core.distributed import get_sequence_parallel_world_size
@@ -631,6 +762,8 @@ class WanVaceMP(WanVace):
 
             dist.barrier()
             model = shard_fn(model)
+            if self.compile:
+                model.compile_blocks(cache_dir=self.compile_cache_dir)
             sample_neg_prompt = self.config.sample_neg_prompt
 
             torch.cuda.empty_cache()
@@ -641,7 +774,8 @@ class WanVaceMP(WanVace):
             while True:
                 item = in_q.get()
                 input_prompt, input_frames, input_masks, input_ref_images, size, frame_num, context_scale, \
-                shift, sample_solver, sampling_steps, guide_scale, n_prompt, seed, offload_model = item
+                shift, sample_solver, sampling_steps, guide_scale, n_prompt, seed, offload_model, \
+                batched_cfg, cache_threshold, guide_schedule = item
                 input_frames = self.transfer_data_to_cuda(input_frames, gpu)
                 input_masks = self.transfer_data_to_cuda(input_masks, gpu)
                 input_ref_images = self.transfer_data_to_cuda(
@@ -714,39 +848,63 @@ class WanVaceMP(WanVace):
                     # sample videos
                     latents = noise
 
-                    arg_c = {'context': context, 'seq_len': seq_len}
-                    arg_null = {'context': context_null, 'seq_len': seq_len}
-
-                    for _, t in enumerate(tqdm(timesteps)):
-                        latent_model_input = latents
-                        timestep = [t]
-
-                        timestep = torch.stack(timestep)
-
-                        model.to(gpu)
-                        noise_pred_cond = model(
-                            latent_model_input,
-                            t=timestep,
-                            vace_context=z,
-                            vace_context_scale=context_scale,
-                            **arg_c)[0]
-                        noise_pred_uncond = model(
-                            latent_model_input,
-                            t=timestep,
-                            vace_context=z,
-                            vace_context_scale=context_scale,
-                            **arg_null)[0]
-
-                        noise_pred = noise_pred_uncond + guide_scale * (
-                            noise_pred_cond - noise_pred_uncond)
-
-                        temp_x0 = sample_scheduler.step(
-                            noise_pred.unsqueeze(0),
-                            t,
-                            latents[0].unsqueeze(0),
-                            return_dict=False,
-                            generator=seed_g)[0]
-                        latents = [temp_x0.squeeze(0)]
+                    arg_c = {
+                        'context': context,
+                        'seq_len': seq_len,
+                        'vace_context': z,
+                        'vace_context_scale': context_scale,
+                        'branch': ['cond']
+                    }
+                    arg_null = {
+                        'context': context_null,
+                        'seq_len': seq_len,
+                        'vace_context': z,
+                        'vace_context_scale': context_scale,
+                        'branch': ['uncond']
+                    }
+                    if batched_cfg:
+                        arg_cfg = merge_cfg_args(arg_c, arg_null)
+
+                    guidance = GuidanceSchedule(
+                        guide_scale, len(timesteps),
+                        **parse_guidance_schedule(guide_schedule))
+                    with model.sampling_session(
+                            timesteps, cache_threshold=cache_threshold):
+                        for step, t in enumerate(tqdm(timesteps)):
+                            latent_model_input = latents
+                            timestep = [t]
+
+                            timestep = torch.stack(timestep)
+
+                            model.to(gpu)
+                            if batched_cfg and guidance.needs_uncond(step):
+                                noise_pred_cond, noise_pred_uncond = model(
+                                    latent_model_input * 2,
+                                    t=timestep.repeat(2),
+                                    step=step,
+                                    **arg_cfg)
+                            else:
+                                noise_pred_cond = model(
+                                    latent_model_input, t=timestep, step=step,
+                                    **arg_c)[0]
+                                noise_pred_uncond = None
+                                if guidance.needs_uncond(step):
+                                    noise_pred_uncond = model(
+                                        latent_model_input,
+                                        t=timestep,
+                                        step=step,
+                                        **arg_null)[0]
+
+                            noise_pred = guidance(step, noise_pred_cond,
+                                                  noise_pred_uncond)
+
+                            temp_x0 = sample_scheduler.step(
+                                noise_pred.unsqueeze(0),
+                                t,
+                                latents[0].unsqueeze(0),
+                                return_dict=False,
+                                generator=seed_g)[0]
+                            latents = [temp_x0.squeeze(0)]
 
                     torch.cuda.empty_cache()
                     x0 = latents
@@ -784,12 +942,16 @@ class WanVaceMP(WanVace):
                  guide_scale=5.0,
                  n_prompt="",
                  seed=-1,
-                 offload_model=True):
+                 offload_model=True,
+                 batched_cfg=False,
+                 cache_threshold=0.,
+                 guide_schedule=None):
 
         input_data = (input_prompt, input_frames, input_masks, input_ref_images,
                       size, frame_num, context_scale, shift, sample_solver,
                       sampling_steps, guide_scale, n_prompt, seed,
-                      offload_model)
+                      offload_model, batched_cfg, cache_threshold,
+                      guide_schedule)
         for in_q in self.in_q_list:
             in_q.put(input_data)
         value_output = self.out_q.get()